@@ -0,0 +1,380 @@
+import os
+import io
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import platform
+import contextlib
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+import main
+import evaluate
+import distancias
+
+# --- CONFIGURAÇÕES DO BENCHMARK ---
+BENCH_BASE_PATH = 'bench/'
+BENCH_OUTPUT_FILE = 'bench_output.json'
+
+# Centro aproximado do Rio de Janeiro, onde as rotas sintéticas são geradas
+SYNTHETIC_CENTER = (-22.90, -43.30)
+METERS_PER_DEGREE_LAT = 111_320.0
+
+
+# --- GERADOR DE DADOS SINTÉTICOS ---
+
+def _format_coordinate(value):
+    """Formata uma coordenada como nos dados brutos da API ('-22,91234')."""
+    return f"{value:.5f}".replace('.', ',')
+
+
+def _build_synthetic_route(rng, n_vertices=40, step_m=400.0):
+    """Gera uma rota (polilinha) por passeio aleatório com direção suave. Retorna (lats, lons, distância acumulada)."""
+    lats = [SYNTHETIC_CENTER[0] + rng.uniform(-0.08, 0.08)]
+    lons = [SYNTHETIC_CENTER[1] + rng.uniform(-0.15, 0.15)]
+    heading = rng.uniform(0, 2 * math.pi)
+    for _ in range(n_vertices - 1):
+        heading += rng.uniform(-0.5, 0.5)
+        meters_per_degree_lon = METERS_PER_DEGREE_LAT * math.cos(math.radians(lats[-1]))
+        lats.append(lats[-1] + step_m * math.cos(heading) / METERS_PER_DEGREE_LAT)
+        lons.append(lons[-1] + step_m * math.sin(heading) / meters_per_degree_lon)
+    lats, lons = np.array(lats), np.array(lons)
+    segment_lengths = distancias.haversine_meters(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    return lats, lons, np.r_[0.0, np.cumsum(segment_lengths)]
+
+
+def _bus_position(bus, timestamp_ms):
+    """Posição verdadeira de um ônibus sintético: vai e volta na rota da sua linha com velocidade constante."""
+    route_lats, route_lons, cumulative = bus['rota']
+    route_length = cumulative[-1]
+    travelled = (bus['fase_m'] + bus['velocidade_ms'] * timestamp_ms / 1000.0) % (2 * route_length)
+    along = travelled if travelled <= route_length else 2 * route_length - travelled
+    lat = np.interp(along, cumulative, route_lats)
+    lon = np.interp(along, cumulative, route_lons)
+    return float(lat), float(lon)
+
+
+def generate_synthetic_dataset(base_path, n_days=2, n_buses=200, n_lines=20, pings_per_minute=1.0,
+                               queries_per_file=500, test_hours=(10, 15, 20), other_lines_fraction=0.3,
+                               duplicate_fraction=0.05, start_date="2024-05-15", seed=42):
+    """
+    Gera uma árvore data/ sintética com o mesmo formato da real:
+    historical/YYYY-MM-DD/YYYY-MM-DD_HH.json, test/YYYY-MM-DD/treino-*.json e final/final-YYYY-MM-DD/resposta-*.json.
+    Os ônibus percorrem rotas sintéticas por linha; o gabarito é a posição/instante verdadeiro do movimento.
+    Uma fração dos ônibus pertence a linhas fora de LINHAS_INTERESSE (para exercitar os filtros de ingestão).
+    Retorna um dicionário com a contagem de registros e queries gerados.
+    """
+    rng = random.Random(seed)
+    if os.path.isdir(base_path):
+        shutil.rmtree(base_path)
+
+    lines = main.LINHAS_INTERESSE[:n_lines]
+    other_lines = [f"9{i:04d}" for i in range(max(1, n_lines // 2))]
+    routes = {linha: _build_synthetic_route(rng) for linha in lines + other_lines}
+
+    buses = []
+    for i in range(n_buses):
+        linha = rng.choice(other_lines) if rng.random() < other_lines_fraction else rng.choice(lines)
+        buses.append({
+            'ordem': f"B{i:05d}",
+            'linha': linha,
+            'rota': routes[linha],
+            'fase_m': rng.uniform(0, 2 * routes[linha][2][-1]),
+            'velocidade_ms': rng.uniform(4.0, 11.0),
+        })
+
+    start_day = datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    ping_interval_ms = 60_000 / pings_per_minute
+    counts = {'registros_historicos': 0, 'arquivos_historicos': 0, 'queries': 0, 'arquivos_teste': 0}
+    query_id = 0
+
+    for day_offset in range(n_days):
+        day = start_day + timedelta(days=day_offset)
+        day_str = day.strftime("%Y-%m-%d")
+        historical_folder = os.path.join(base_path, 'historical', day_str)
+        os.makedirs(historical_folder, exist_ok=True)
+
+        for hour in range(24):
+            hour_start_ms = int((day + timedelta(hours=hour)).timestamp() * 1000)
+            records = []
+            for bus in buses:
+                timestamp_ms = hour_start_ms + rng.uniform(0, ping_interval_ms)
+                while timestamp_ms < hour_start_ms + 3_600_000:
+                    lat, lon = _bus_position(bus, timestamp_ms)
+                    ts = int(timestamp_ms)
+                    record = {
+                        "ordem": bus['ordem'], "latitude": _format_coordinate(lat), "longitude": _format_coordinate(lon),
+                        "datahora": str(ts - rng.randint(0, 5000)), "velocidade": str(int(bus['velocidade_ms'] * 3.6 + rng.uniform(-5, 5))),
+                        "linha": bus['linha'], "datahoraenvio": str(ts), "datahoraservidor": str(ts),
+                    }
+                    records.append(record)
+                    if rng.random() < duplicate_fraction:
+                        records.append(dict(record))
+                    timestamp_ms += ping_interval_ms * rng.uniform(0.7, 1.3)
+            with open(os.path.join(historical_folder, f"{day_str}_{hour:02d}.json"), 'w', encoding='utf-8') as f:
+                json.dump(records, f)
+            counts['registros_historicos'] += len(records)
+            counts['arquivos_historicos'] += 1
+
+        test_folder = os.path.join(base_path, 'test', day_str)
+        final_folder = os.path.join(base_path, 'final', f"final-{day_str}")
+        os.makedirs(test_folder, exist_ok=True)
+        os.makedirs(final_folder, exist_ok=True)
+        interest_buses = [bus for bus in buses if bus['linha'] in lines]
+
+        for hour in test_hours:
+            hour_start_ms = int((day + timedelta(hours=hour)).timestamp() * 1000)
+            queries, answers = [], []
+            for k in range(queries_per_file):
+                bus = rng.choice(interest_buses)
+                query_id += 1
+                if k % 2 == 0:
+                    # Query de tempo: onde o ônibus está em um instante da hora
+                    timestamp_ms = hour_start_ms + rng.randint(0, 3_599_999)
+                    lat, lon = _bus_position(bus, timestamp_ms)
+                    queries.append({"id": query_id, "ordem": bus['ordem'], "linha": bus['linha'], "datahora": timestamp_ms})
+                    answers.append([query_id, round(lat, 5), round(lon, 5)])
+                else:
+                    # Query de chegada: quando o ônibus passa por um ponto da sua rota dentro da hora do arquivo
+                    arrival_ms = hour_start_ms + rng.randint(0, 3_599_999)
+                    lat, lon = _bus_position(bus, arrival_ms)
+                    queries.append({"id": query_id, "ordem": bus['ordem'], "linha": bus['linha'],
+                                    "latitude": _format_coordinate(lat), "longitude": _format_coordinate(lon)})
+                    answers.append([query_id, arrival_ms])
+            with open(os.path.join(test_folder, f"treino-{day_str}_{hour:02d}.json"), 'w', encoding='utf-8') as f:
+                json.dump(queries, f)
+            with open(os.path.join(final_folder, f"resposta-{day_str}_{hour:02d}.json"), 'w', encoding='utf-8') as f:
+                json.dump({"previsoes": answers}, f)
+            counts['queries'] += len(queries)
+            counts['arquivos_teste'] += 1
+
+    return counts
+
+
+# --- EXECUÇÃO DAS ETAPAS ---
+
+class StageTimer:
+    """Acumula o tempo (perf_counter) e o número de itens processados de cada etapa do benchmark."""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, items=None):
+        start = time.perf_counter()
+        result = {'itens': items}
+        yield result
+        elapsed = time.perf_counter() - start
+        items = result['itens']
+        self.stages[name] = {
+            'segundos': round(elapsed, 6),
+            'itens': items,
+            'itens_por_segundo': round(items / elapsed, 2) if items and elapsed > 0 else None,
+        }
+
+
+def _reset_main_state():
+    main.HISTORICAL_RAW_FILE_PATH_CACHE.clear()
+    main.HOUR_DATA_LRU_CACHE.clear()
+    main.ROUTE_CACHE.clear()
+    main.PROFILE_CACHE.clear()
+    main.FLEET_INDEX_CACHE.clear()
+    for counter in main.HOUR_CACHE_STATS:
+        main.HOUR_CACHE_STATS[counter] = 0
+    main.CURRENT_TEST_DAY_WINDOW = None
+
+
+def run_benchmark(base_path, verbose=False):
+    """
+    Roda as etapas do pipeline real sobre a árvore sintética em base_path e retorna os tempos por etapa:
+    cache de caminhos, carga de horas (fria e com cache em disco), busca de histórico por query,
+    predict_location, predict_arrival_time, construção de rotas, perfis de tempo de viagem e índice da frota, previsão com
+    rota e perfil, avaliação MVP e avaliação final.
+    """
+    data_path = os.path.join(base_path, 'data')
+    main.BASE_DATA_PATH = data_path
+    main.set_cache_path(os.path.join(base_path, 'cache'))
+    evaluate.TRUE_RESULTS_INDEX_PATH = os.path.join(base_path, 'cache', 'gabarito')
+    if os.path.isfile(main.HISTORICAL_MANIFEST_PATH):
+        os.remove(main.HISTORICAL_MANIFEST_PATH)
+    for cache_path in (main.PREPROCESSED_CACHE_PATH, evaluate.TRUE_RESULTS_INDEX_PATH, main.ROUTES_PATH, main.PROFILES_PATH,
+                       main.FLEET_INDEX_PATH, main.CHECKPOINT_PATH):
+        if os.path.isdir(cache_path):
+            shutil.rmtree(cache_path)
+    _reset_main_state()
+
+    timer = StageTimer()
+    output = sys.stdout if verbose else io.StringIO()
+    test_days = sorted(os.listdir(os.path.join(data_path, 'test')))
+    first_day = datetime.strptime(test_days[0], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+    with contextlib.redirect_stdout(output):
+        with timer.stage('cache_de_caminhos') as stage:
+            main.build_historical_file_path_cache(os.path.join(data_path, 'historical'))
+            stage['itens'] = sum(len(paths) for paths in main.HISTORICAL_RAW_FILE_PATH_CACHE.values())
+
+        main.HISTORICAL_RAW_FILE_PATH_CACHE.clear()
+        with timer.stage('cache_de_caminhos_manifesto') as stage:
+            main.build_historical_file_path_cache(os.path.join(data_path, 'historical'))
+            stage['itens'] = sum(len(paths) for paths in main.HISTORICAL_RAW_FILE_PATH_CACHE.values())
+
+        with timer.stage('carga_horas_fria') as stage:
+            main.load_historical_data_for_test_day_window(first_day)
+            stage['itens'] = sum(len(df) for df in main.CURRENT_TEST_DAY_DATA_CACHE.values())
+
+        main.HOUR_DATA_LRU_CACHE.clear()
+        with timer.stage('carga_horas_cache_disco') as stage:
+            main.load_historical_data_for_test_day_window(first_day)
+            stage['itens'] = sum(len(df) for df in main.CURRENT_TEST_DAY_DATA_CACHE.values())
+
+        queries = []
+        query_datetimes = {}
+        planned_queries = []
+        test_day_path = os.path.join(data_path, 'test', test_days[0])
+        for test_filename in sorted(os.listdir(test_day_path)):
+            # Queries de chegada não têm datahora: a referência é a hora do arquivo, como em main.py
+            file_hour = datetime.strptime(test_filename[len('treino-'):-len('.json')], "%Y-%m-%d_%H").replace(tzinfo=timezone.utc)
+            for query in main.load_test_queries_file(os.path.join(test_day_path, test_filename)):
+                query_datetimes[id(query)] = query.get('datahora_dt') or file_hour
+                queries.append(query)
+                planned_queries.append((query, test_filename))
+        time_queries = [q for q in queries if 'datahora' in q]
+        arrival_queries = [q for q in queries if 'datahora' not in q]
+
+        histories = []
+        with timer.stage('busca_historico_query', len(queries)):
+            for query in queries:
+                histories.append(main.get_recent_historical_data_for_query_from_cache(
+                    query['ordem'], query['linha'], query_datetimes[id(query)]))
+        histories_by_query = {id(query): history for query, history in zip(queries, histories)}
+
+        with timer.stage('predict_location', len(time_queries)):
+            for query in time_queries:
+                main.predict_location(histories_by_query[id(query)], query['datahora'])
+
+        with timer.stage('predict_locations_batch', len(time_queries)):
+            main.predict_locations_batch([(q['ordem'], q['linha']) for q in time_queries],
+                                         [q['datahora'] for q in time_queries])
+
+        with timer.stage('predict_arrival_time', len(arrival_queries)):
+            for query in arrival_queries:
+                main.predict_arrival_time(histories_by_query[id(query)],
+                                          {'latitude': query['latitude'], 'longitude': query['longitude']})
+
+        # A partir daqui as previsões usam as rotas e os perfis construídos sobre o histórico sintético
+        with timer.stage('construcao_rotas') as stage:
+            stage['itens'] = main.build_route_geometries()
+
+        with timer.stage('construcao_perfis') as stage:
+            stage['itens'] = main.build_travel_time_profiles()
+
+        with timer.stage('construcao_indice_frota') as stage:
+            stage['itens'] = main.build_fleet_index()
+
+        with timer.stage('predict_batch_perfil', len(time_queries)):
+            main.predict_locations_batch([(q['ordem'], q['linha']) for q in time_queries],
+                                         [q['datahora'] for q in time_queries])
+
+        with timer.stage('predict_arrival_rota', len(arrival_queries)):
+            for query in arrival_queries:
+                main.predict_arrival_time_with_route(histories_by_query[id(query)],
+                                                     {'latitude': query['latitude'], 'longitude': query['longitude']},
+                                                     query['linha'])
+
+        # Mesmas queries do dia, agrupadas por ônibus (um recorte de histórico por ônibus, previsões em lote)
+        with timer.stage('queries_agrupadas_onibus', len(queries)):
+            main.answer_queries_by_bus(planned_queries)
+
+        with timer.stage('pipeline_completo') as stage:
+            previsoes, all_queries = main.run_test_days(test_days)
+            stage['itens'] = len(previsoes)
+
+        with timer.stage('avaliacao_mvp', len(previsoes)):
+            mvp_report = main.evaluate_predictions_mvp(previsoes, all_queries)
+
+        with timer.stage('carga_gabarito_fria') as stage:
+            true_results = evaluate.load_all_true_results(os.path.join(data_path, 'final'))
+            stage['itens'] = len(true_results)
+
+        with timer.stage('carga_gabarito_indice') as stage:
+            true_results = evaluate.load_all_true_results(os.path.join(data_path, 'final'))
+            stage['itens'] = len(true_results)
+
+        with timer.stage('avaliacao_final', len(previsoes)):
+            loc_errors, time_errors = evaluate.calculate_errors(previsoes, true_results)
+
+    return {
+        'etapas': timer.stages,
+        'cache_de_horas': dict(main.HOUR_CACHE_STATS),
+        'resultado': {
+            'previsoes': len(previsoes),
+            'mae_posicao_m': float(np.mean(loc_errors)) if len(loc_errors) else None,
+            'mae_tempo_s': float(np.mean(time_errors)) if len(time_errors) else None,
+            'relatorio_mvp': mvp_report,
+        },
+    }
+
+
+# --- INÍCIO DO SCRIPT DE BENCHMARK ---
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Benchmark do pipeline (main.py / evaluate.py) sobre dados sintéticos.")
+    parser.add_argument('--base-path', default=BENCH_BASE_PATH, help="Pasta onde os dados sintéticos e o cache são gerados.")
+    parser.add_argument('--output', default=BENCH_OUTPUT_FILE, help="Arquivo JSON com os resultados.")
+    parser.add_argument('--days', type=int, default=2)
+    parser.add_argument('--buses', type=int, default=200)
+    parser.add_argument('--lines', type=int, default=20)
+    parser.add_argument('--pings-per-minute', type=float, default=1.0)
+    parser.add_argument('--queries', type=int, default=500, help="Queries por arquivo treino-*.json.")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reuse-data', action='store_true', help="Não regera os dados se a pasta já existir.")
+    parser.add_argument('--verbose', action='store_true', help="Mostra a saída das funções do pipeline.")
+    return parser
+
+
+def run(args):
+    """Gera (ou reaproveita) os dados sintéticos, mede as etapas e grava os resultados em args.output."""
+    config = {
+        'n_days': args.days, 'n_buses': args.buses, 'n_lines': args.lines,
+        'pings_per_minute': args.pings_per_minute, 'queries_per_file': args.queries, 'seed': args.seed,
+    }
+    data_path = os.path.join(args.base_path, 'data')
+
+    generation = None
+    if not (args.reuse_data and os.path.isdir(data_path)):
+        print(f"Gerando dados sintéticos em {data_path}...")
+        start = time.perf_counter()
+        generation = generate_synthetic_dataset(data_path, **config)
+        generation['segundos'] = round(time.perf_counter() - start, 3)
+        print(f"Dados gerados: {generation}")
+
+    print("Executando as etapas do benchmark...")
+    results = run_benchmark(args.base_path, verbose=args.verbose)
+    results = {
+        'data_execucao': datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC"),
+        'ambiente': {
+            'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'plataforma': platform.platform(), 'cpus': os.cpu_count(),
+        },
+        'configuracao': config,
+        'geracao': generation,
+        **results,
+    }
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    print(f"\n{'Etapa':<28}{'Segundos':>12}{'Itens':>10}{'Itens/s':>14}")
+    for name, stage in results['etapas'].items():
+        rate = f"{stage['itens_por_segundo']:.1f}" if stage['itens_por_segundo'] else '-'
+        print(f"{name:<28}{stage['segundos']:>12.4f}{stage['itens'] if stage['itens'] is not None else '-':>10}{rate:>14}")
+    print(f"\nResultados salvos em '{args.output}'.")
+
+
+if __name__ == "__main__":
+    run(build_arg_parser().parse_args())
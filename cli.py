@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import argparse
+
+# --- PONTO DE ENTRADA DE LINHA DE COMANDO ---
+# python cli.py [--config arquivo.json] [--data-path ...] [--linhas ...] [--hours-before N] <comando> [opções do comando]
+#   predict   gera o resposta.json (opções de main.py)
+#   evaluate  compara o resposta.json com o gabarito (opções de evaluate.py)
+#   index     atualiza o índice de arquivos históricos e, opcionalmente, as rotas, os perfis e o índice da frota
+#   bench     roda o benchmark sintético (opções de benchmark.py; usa os próprios dados e linhas)
+#   serve     sobe o serviço local de previsão (opções de servico.py)
+# Aqui só a biblioteca padrão é importada: main.py, evaluate.py, benchmark.py e servico.py (e com eles pandas,
+# NumPy e geopy) são importados apenas pelo comando que os usa, então --help e erros de configuração saem sem esse custo.
+# main.py importa pandas e NumPy no topo, pois quase todas as funções (inclusive o caminho de cada query) os
+# usam; evaluate.py só importa pandas ao montar as tabelas, então 'evaluate --help' carrega apenas o NumPy.
+
+# Chaves aceitas no arquivo de configuração (JSON); as flags globais têm precedência sobre o arquivo
+CONFIG_KEYS = {
+    'base_data_path': str,      # main.BASE_DATA_PATH / evaluate.BASE_DATA_PATH
+    'cache_path': str,          # main.set_cache_path / evaluate.TRUE_RESULTS_INDEX_PATH (padrão: <base_data_path>/cache)
+    'linhas_interesse': list,   # main.LINHAS_INTERESSE
+    'hours_before': int,        # main.QUERY_HOURS_BEFORE
+    'eval_hours_before': int,   # main.EVAL_HOURS_BEFORE
+}
+
+COMMANDS = ['predict', 'evaluate', 'index', 'bench', 'serve']
+
+
+def load_config(file_path):
+    """Lê o arquivo de configuração; chaves desconhecidas ou de tipo errado são erro (ValueError)."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f"{file_path}: o arquivo de configuração deve ser um objeto JSON.")
+    for key, value in config.items():
+        if key not in CONFIG_KEYS:
+            raise ValueError(f"{file_path}: chave desconhecida '{key}' (aceitas: {', '.join(sorted(CONFIG_KEYS))}).")
+        if not isinstance(value, CONFIG_KEYS[key]) or isinstance(value, bool):
+            raise ValueError(f"{file_path}: '{key}' deve ser do tipo {CONFIG_KEYS[key].__name__}.")
+    if 'linhas_interesse' in config:
+        config['linhas_interesse'] = [str(linha) for linha in config['linhas_interesse']]
+    return config
+
+
+def resolve_config(args):
+    """Configuração efetiva: arquivo de --config sobreposto pelas flags globais."""
+    config = load_config(args.config) if args.config else {}
+    if args.data_path is not None:
+        config['base_data_path'] = args.data_path
+    if args.linhas is not None:
+        config['linhas_interesse'] = [linha.strip() for linha in args.linhas.split(',') if linha.strip()]
+    if args.hours_before is not None:
+        config['hours_before'] = args.hours_before
+    if args.eval_hours_before is not None:
+        config['eval_hours_before'] = args.eval_hours_before
+    if args.cache_path is not None:
+        config['cache_path'] = args.cache_path
+    if 'base_data_path' in config and 'cache_path' not in config:
+        # Caches de outra pasta de dados não se misturam com os de data/
+        config['cache_path'] = os.path.join(config['base_data_path'], 'cache')
+    return config
+
+
+def apply_config_to_main(main, config):
+    if 'base_data_path' in config:
+        main.BASE_DATA_PATH = config['base_data_path']
+    if 'linhas_interesse' in config:
+        main.LINHAS_INTERESSE = config['linhas_interesse']
+    if 'hours_before' in config:
+        main.QUERY_HOURS_BEFORE = config['hours_before']
+    if 'eval_hours_before' in config:
+        main.EVAL_HOURS_BEFORE = config['eval_hours_before']
+    if 'cache_path' in config:
+        main.set_cache_path(config['cache_path'])
+
+
+def apply_config_to_evaluate(evaluate, config):
+    if 'base_data_path' in config:
+        evaluate.BASE_DATA_PATH = config['base_data_path']
+        evaluate.TRUE_RESULTS_BASE_PATH = os.path.join(config['base_data_path'], 'final/')
+    if 'cache_path' in config:
+        evaluate.TRUE_RESULTS_INDEX_PATH = os.path.join(config['cache_path'], 'gabarito/')
+
+
+def _forwarded_args(parser, command, command_args):
+    parser.prog = f"{os.path.basename(sys.argv[0])} {command}"
+    return parser.parse_args(command_args)
+
+
+def command_predict(config, command_args):
+    import main
+    apply_config_to_main(main, config)
+    main.run(_forwarded_args(main.build_arg_parser(), 'predict', command_args))
+
+
+def command_evaluate(config, command_args):
+    import evaluate
+    apply_config_to_evaluate(evaluate, config)
+    evaluate.run(_forwarded_args(evaluate.build_arg_parser(), 'evaluate', command_args))
+
+
+def build_index_arg_parser():
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} index",
+                                     description="Atualiza o índice (manifesto) de arquivos históricos e, opcionalmente, as rotas, "
+                                                 "os perfis e o índice da frota.")
+    parser.add_argument('--routes', action='store_true', help="Também constrói as rotas de referência por linha.")
+    parser.add_argument('--profiles', action='store_true', help="Também constrói os perfis de tempo de viagem (requer rotas).")
+    parser.add_argument('--fleet', action='store_true', help="Também constrói o índice histórico da frota por (linha, dia da semana, hora).")
+    return parser
+
+
+def command_index(config, command_args):
+    index_args = build_index_arg_parser().parse_args(command_args)
+    import main
+    apply_config_to_main(main, config)
+    latest_hist_date = main.build_historical_file_path_cache(os.path.join(main.BASE_DATA_PATH, 'historical'))
+    if index_args.routes:
+        main.build_route_geometries()
+    if index_args.profiles:
+        main.build_travel_time_profiles()
+    if index_args.fleet:
+        main.build_fleet_index()
+    main.save_historical_manifest()
+    hours = len(main.HISTORICAL_RAW_FILE_PATH_CACHE)
+    files = sum(len(paths) for paths in main.HISTORICAL_RAW_FILE_PATH_CACHE.values())
+    last_day = latest_hist_date.strftime('%Y-%m-%d') if latest_hist_date else '-'
+    print(f"INFO_INDEX: {files} arquivos históricos em {hours} horas indexados (último dia: {last_day}).")
+
+
+def command_bench(config, command_args):
+    # O benchmark gera os próprios dados e linhas sintéticos; a configuração de dados não se aplica
+    import benchmark
+    benchmark.run(_forwarded_args(benchmark.build_arg_parser(), 'bench', command_args))
+
+
+def command_serve(config, command_args):
+    import main
+    import servico
+    apply_config_to_main(main, config)
+    servico.run(_forwarded_args(servico.build_arg_parser(), 'serve', command_args))
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Previsão de posição/chegada de ônibus: previsões, avaliação, índice histórico, benchmark e serviço local.",
+        epilog="As opções de cada comando vêm depois dele (ex.: cli.py predict --workers 4; cli.py predict --help).")
+    parser.add_argument('--config', help="Arquivo JSON de configuração (chaves: " + ", ".join(sorted(CONFIG_KEYS)) + ").")
+    parser.add_argument('--data-path', help="Pasta de dados com historical/, test/ e final/ (padrão: data/).")
+    parser.add_argument('--cache-path', help="Pasta dos caches em disco (padrão: cache/, ou <data-path>/cache com --data-path).")
+    parser.add_argument('--linhas', help="Linhas de interesse separadas por vírgula (padrão: as de main.LINHAS_INTERESSE).")
+    parser.add_argument('--hours-before', type=int, help="Horas de histórico antes de cada query (padrão: 5).")
+    parser.add_argument('--eval-hours-before', type=int, help="Horas de histórico da avaliação interna (padrão: 5).")
+    parser.add_argument('command', choices=COMMANDS, metavar='comando', help=" | ".join(COMMANDS))
+    parser.add_argument('command_args', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    return parser
+
+
+def run_cli(argv=None):
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    try:
+        config = resolve_config(args)
+    except (OSError, ValueError) as e:
+        parser.error(f"configuração inválida: {e}")
+
+    handlers = {'predict': command_predict, 'evaluate': command_evaluate, 'index': command_index, 'bench': command_bench,
+                'serve': command_serve}
+    handlers[args.command](config, args.command_args)
+
+
+if __name__ == "__main__":
+    run_cli()
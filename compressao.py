@@ -0,0 +1,151 @@
+import numpy as np
+
+import rotas
+
+# --- COMPRESSÃO DE TRAJETÓRIAS NA INGESTÃO ---
+# Cada hora carregada é comprimida por ônibus (ordem, linha), em ordem de tempo, em três passos:
+# 1. duplicatas exatas (mesmo timestamp e mesma posição) são removidas;
+# 2. sequências de pings parados (garagem, terminal), em que cada passo e a distância ao primeiro ping da
+#    sequência ficam dentro de COMPRESSION_STATIONARY_RADIUS_M, mantêm só o primeiro e o último ping;
+# 3. Douglas-Peucker temporal: o erro de um ping é a distância até a posição interpolada no tempo entre as
+#    extremidades do trecho (distância euclidiana sincronizada), a mesma interpolação de predict_location.
+#    Pings com erro até COMPRESSION_TOLERANCE_M são descartados.
+# O primeiro e o último ping de cada ônibus são sempre mantidos. Interpolar no tempo entre os pings que
+# restaram erra no máximo COMPRESSION_TOLERANCE_M + 2 * COMPRESSION_STATIONARY_RADIUS_M em relação aos
+# pings originais.
+
+COMPRESSION_TOLERANCE_M = 10.0
+COMPRESSION_STATIONARY_RADIUS_M = 5.0
+
+COORDINATE_SCALE = 10_000_000
+
+
+def new_compression_stats():
+    return {'entrada': 0, 'duplicatas': 0, 'parados': 0, 'simplificados': 0, 'saida': 0}
+
+
+def _bus_starts(bus_ids):
+    """Máscara do primeiro ping de cada ônibus (bus_ids agrupados, um id por ping)."""
+    return np.r_[True, bus_ids[1:] != bus_ids[:-1]] if len(bus_ids) else np.zeros(0, dtype=bool)
+
+
+def _expand_ranges(starts, lengths):
+    """Índices starts[i] .. starts[i] + lengths[i] - 1 de todos os intervalos, e o intervalo de cada um."""
+    offsets = np.cumsum(lengths) - lengths
+    range_of_index = np.repeat(np.arange(len(starts)), lengths)
+    return starts[range_of_index] + np.arange(lengths.sum()) - offsets[range_of_index], range_of_index, offsets
+
+
+def stationary_runs_mask(x, y, bus_ids, radius_m=COMPRESSION_STATIONARY_RADIUS_M):
+    """
+    Máscara dos pings mantidos depois de colapsar as sequências paradas. Arrays em metros, agrupados por
+    ônibus (bus_ids) e ordenados no tempo dentro de cada ônibus.
+    """
+    keep = np.ones(len(x), dtype=bool)
+    if len(x) < 3:
+        return keep
+
+    # Sequências de passos curtos dentro do mesmo ônibus: passos [start, end) ligam os pings start..end
+    still = np.r_[False, (np.hypot(np.diff(x), np.diff(y)) <= radius_m) & ~_bus_starts(bus_ids)[1:], False]
+    changes = np.flatnonzero(still[1:] != still[:-1])
+    starts, ends = changes[0::2], changes[1::2]
+    long_runs = ends - starts >= 2
+    starts, ends = starts[long_runs], ends[long_runs]
+    if len(starts) == 0:
+        return keep
+
+    # Sequências que andam aos poucos (soma de passos curtos) não são paradas: a deriva em relação ao
+    # primeiro ping também tem de ficar dentro do raio
+    points, run_of_point, offsets = _expand_ranges(starts, ends - starts + 1)
+    drift = np.hypot(x[points] - x[starts][run_of_point], y[points] - y[starts][run_of_point])
+    stationary = np.maximum.reduceat(drift, offsets) <= radius_m
+
+    interior = stationary[run_of_point] & (points != starts[run_of_point]) & (points != ends[run_of_point])
+    keep[points[interior]] = False
+    return keep
+
+
+def time_aware_douglas_peucker_mask(timestamps_ms, x, y, bus_ids, tolerance_m=COMPRESSION_TOLERANCE_M):
+    """
+    Máscara dos pings mantidos pelo Douglas-Peucker temporal: um trecho é aceito quando todos os pings
+    internos estão a até tolerance_m da posição interpolada no tempo entre as extremidades. Os trechos
+    de todos os ônibus (bus_ids) são processados juntos, um nível da recursão por iteração.
+    """
+    n = len(timestamps_ms)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    firsts = np.flatnonzero(_bus_starts(bus_ids))
+    lasts = np.r_[firsts[1:], n] - 1
+    keep[firsts] = keep[lasts] = True
+
+    timestamps_ms = np.asarray(timestamps_ms, dtype=np.float64)
+    while True:
+        splittable = lasts - firsts >= 2
+        firsts, lasts = firsts[splittable], lasts[splittable]
+        if len(firsts) == 0:
+            return keep
+
+        inner, segment_of_point, offsets = _expand_ranges(firsts + 1, lasts - firsts - 1)
+        first, last = firsts[segment_of_point], lasts[segment_of_point]
+        span = timestamps_ms[last] - timestamps_ms[first]
+        ratio = np.where(span > 0, (timestamps_ms[inner] - timestamps_ms[first]) / np.where(span > 0, span, 1.0), 0.0)
+        errors = np.hypot(x[inner] - (x[first] + ratio * (x[last] - x[first])),
+                          y[inner] - (y[first] + ratio * (y[last] - y[first])))
+
+        # Pior ping de cada trecho (o primeiro, em caso de empate)
+        worst_error = np.maximum.reduceat(errors, offsets)
+        is_worst = errors == worst_error[segment_of_point]
+        worst = np.minimum.reduceat(np.where(is_worst, inner, n), offsets)
+
+        split = worst_error > tolerance_m
+        keep[worst[split]] = True
+        firsts, lasts = np.r_[firsts[split], worst[split]], np.r_[worst[split], lasts[split]]
+
+
+def compress_hour_dataframe(df, tolerance_m=COMPRESSION_TOLERANCE_M, stationary_radius_m=COMPRESSION_STATIONARY_RADIUS_M):
+    """
+    Comprime uma hora no layout compacto (ordem, linha, latitude_e7, longitude_e7, velocidade, timestamp_ms).
+    Os pings mantidos continuam na ordem original do DataFrame. Retorna (DataFrame, estatísticas).
+    """
+    stats = new_compression_stats()
+    stats['entrada'] = stats['saida'] = len(df)
+    if df.empty:
+        return df, stats
+
+    ordem_codes = df['ordem'].cat.codes.to_numpy()
+    linha_codes = df['linha'].cat.codes.to_numpy()
+    lat_e7 = df['latitude_e7'].to_numpy()
+    lon_e7 = df['longitude_e7'].to_numpy()
+    timestamps = df['timestamp_ms'].to_numpy()
+
+    # Ordem por ônibus e tempo; a posição entra na chave para deixar duplicatas exatas lado a lado
+    order = np.lexsort((lon_e7, lat_e7, timestamps, linha_codes, ordem_codes))
+    bus = ordem_codes[order].astype(np.int64) * (int(linha_codes.max()) + 1) + linha_codes[order]
+    ts, lat, lon = timestamps[order], lat_e7[order], lon_e7[order]
+
+    duplicate = np.r_[False, (bus[1:] == bus[:-1]) & (ts[1:] == ts[:-1]) & (lat[1:] == lat[:-1]) & (lon[1:] == lon[:-1])]
+    stats['duplicatas'] = int(duplicate.sum())
+    order, bus, ts, lat, lon = order[~duplicate], bus[~duplicate], ts[~duplicate], lat[~duplicate], lon[~duplicate]
+
+    # Um único plano local para a hora inteira (a distorção em uma cidade é desprezível para a tolerância)
+    lats, lons = lat / COORDINATE_SCALE, lon / COORDINATE_SCALE
+    x, y = rotas.to_local_xy(lats, lons, (float(lats[0]), float(lons[0])))
+
+    moving = stationary_runs_mask(x, y, bus, stationary_radius_m)
+    stats['parados'] = int((~moving).sum())
+    order, bus, ts, x, y = order[moving], bus[moving], ts[moving], x[moving], y[moving]
+
+    simplified = time_aware_douglas_peucker_mask(ts, x, y, bus, tolerance_m)
+    stats['simplificados'] = int((~simplified).sum())
+
+    keep = np.zeros(len(df), dtype=bool)
+    keep[order[simplified]] = True
+    stats['saida'] = int(keep.sum())
+    return df[keep].reset_index(drop=True), stats
+
+
+def format_compression_stats(stats):
+    ratio = stats['entrada'] / stats['saida'] if stats['saida'] else 0.0
+    return (f"{stats['entrada']} pings -> {stats['saida']} ({ratio:.2f}:1; {stats['duplicatas']} duplicatas, "
+            f"{stats['parados']} parados, {stats['simplificados']} simplificados)")
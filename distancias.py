@@ -0,0 +1,70 @@
+import numpy as np
+
+# --- DISTÂNCIAS ENTRE COORDENADAS ---
+# Distâncias vetorizadas com NumPy entre pares (lat, lon) em graus, com broadcasting: a haversine na esfera
+# (rápida, usada como pré-filtro e nas estatísticas aproximadas) e a geodésica no elipsoide WGS-84 (a mesma
+# do geopy.distance.geodesic, usada para medir os erros das previsões).
+
+# Raio médio da Terra usado na haversine e nas projeções locais (rotas.py)
+EARTH_RADIUS_M = 6371008.8
+
+# Elipsoide WGS-84 (o mesmo do geopy.distance.geodesic) e parâmetros da fórmula de Vincenty
+WGS84_SEMI_MAJOR_AXIS = 6378137.0
+WGS84_FLATTENING = 1 / 298.257223563
+VINCENTY_MAX_ITERATIONS = 200
+VINCENTY_TOLERANCE = 1e-12
+
+
+def haversine_meters(lat1, lon1, lat2, lon2):
+    """Distância haversine em metros, vetorizada (aceita arrays com broadcasting)."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def geodesic_meters(lat1, lon1, lat2, lon2):
+    """
+    Distância geodésica no elipsoide WGS-84 (fórmula inversa de Vincenty), vetorizada com NumPy.
+    Concorda com geopy.distance.geodesic em frações de milímetro; os pares em que a iteração não
+    converge (pontos quase antípodas) são recalculados com o geopy.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.asarray(v, dtype=np.float64) for v in (lat1, lon1, lat2, lon2)))
+    a, f = WGS84_SEMI_MAJOR_AXIS, WGS84_FLATTENING
+    b = (1 - f) * a
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        L = np.radians(lon2 - lon1)
+        U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+        U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+        sin_U1, cos_U1, sin_U2, cos_U2 = np.sin(U1), np.cos(U1), np.sin(U2), np.cos(U2)
+
+        lam = L
+        converged = np.zeros(L.shape, dtype=bool)
+        for _ in range(VINCENTY_MAX_ITERATIONS):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cos_U2 * sin_lam) ** 2 + (cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lam) ** 2)
+            cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_U1 * cos_U2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_U1 * sin_U2 / cos2_alpha)
+            C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * f * sin_alpha * (sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam - lam_prev) < VINCENTY_TOLERANCE
+            if converged.all():
+                break
+
+        u2 = cos2_alpha * (a ** 2 - b ** 2) / b ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+                                                               - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        distances = np.where(sin_sigma == 0, 0.0, b * A * (sigma - delta_sigma))
+
+    fallback = np.flatnonzero(~converged | ~np.isfinite(distances))
+    if len(fallback):
+        from geopy.distance import geodesic
+    for i in fallback:
+        distances.flat[i] = geodesic((lat1.flat[i], lon1.flat[i]), (lat2.flat[i], lon2.flat[i])).meters
+    return distances
@@ -1,16 +1,31 @@
 import os
 import json
+import hashlib
+import argparse
 from datetime import datetime, timezone
-import pandas as pd
-from geopy.distance import geodesic
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
+import distancias
+
 # --- CONFIGURAÇÕES DE AVALIAÇÃO ---
 BASE_DATA_PATH = 'data/' 
 YOUR_PREDICTIONS_FILE = 'resposta.json' # O arquivo gerado pelo seu main.py (na raiz do projeto)
 TRUE_RESULTS_BASE_PATH = os.path.join(BASE_DATA_PATH, 'final/') # Pasta raiz para os gabaritos
 EVALUATION_REPORT_FILE = 'relatorio_avaliacao_final.txt'
 
+# Índice binário persistente do gabarito: um .npz por arquivo resposta-*.json, atualizado pelo mtime/tamanho
+USE_TRUE_RESULTS_INDEX = True
+TRUE_RESULTS_INDEX_PATH = 'cache/gabarito/'
+TRUE_RESULTS_INDEX_VERSION = 1
+
+# Processos usados para ler os arquivos de gabarito novos ou alterados (None = número de CPUs)
+TRUE_RESULTS_LOAD_WORKERS = None
+
+# Tipos de resultado no gabarito colunar
+TRUE_TYPE_LOCATION = 0
+TRUE_TYPE_TIME = 1
+
 # --- FUNÇÕES DE CARREGAMENTO ---
 
 def load_your_predictions(file_path):
@@ -26,97 +41,254 @@ def load_your_predictions(file_path):
         print(f"ERRO: Erro ao carregar suas previsões de '{file_path}': {e}")
         return []
 
-def load_all_true_results(base_final_path):
+def list_true_results_files(base_final_path):
+    """Lista (ordenados) os arquivos 'final-*/resposta-*.json' de base_final_path."""
+    file_paths = []
+    for day_folder in os.listdir(base_final_path):
+        # Verifica se a pasta do dia começa com 'final-'
+        if day_folder.startswith('final-') and os.path.isdir(os.path.join(base_final_path, day_folder)):
+            day_path = os.path.join(base_final_path, day_folder)
+            for filename in os.listdir(day_path):
+                # Assume que os arquivos de gabarito são 'resposta-YYYY-MM-DD_HH.json'
+                if filename.startswith('resposta-') and filename.endswith('.json'):
+                    file_paths.append(os.path.join(day_path, filename))
+    return sorted(file_paths)
+
+
+def parse_true_results_file(file_path):
+    """
+    Lê um arquivo de gabarito e retorna suas colunas (ids, tipos, valor 1, valor 2):
+    [id, lat, lon] vira (TRUE_TYPE_LOCATION, lat, lon) e [id, timestamp] vira (TRUE_TYPE_TIME, timestamp, NaN).
+    """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    
+    ids, types, values_1, values_2 = [], [], [], []
+    for item in data.get('previsoes', []):
+        if len(item) == 3: # Previsão de localização: [id, lat, lon]
+            ids.append(item[0]); types.append(TRUE_TYPE_LOCATION); values_1.append(item[1]); values_2.append(item[2])
+        elif len(item) == 2: # Previsão de tempo: [id, timestamp]
+            ids.append(item[0]); types.append(TRUE_TYPE_TIME); values_1.append(item[1]); values_2.append(np.nan)
+        # else: # Comentado para output mais limpo
+            # print(f"AVISO_GABARITO: Formato de previsão inesperado no arquivo {os.path.basename(file_path)} para ID {item[0]}. Pulando.")
+    return ids, types, values_1, values_2
+
+
+def _true_results_index_file(file_path):
+    path_hash = hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(TRUE_RESULTS_INDEX_PATH, f"{os.path.splitext(os.path.basename(file_path))[0]}__{path_hash}.npz")
+
+
+def _load_true_results_manifest():
+    manifest_path = os.path.join(TRUE_RESULTS_INDEX_PATH, 'manifest.json')
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('versao') == TRUE_RESULTS_INDEX_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {'versao': TRUE_RESULTS_INDEX_VERSION, 'arquivos': {}}
+
+
+def _save_true_results_manifest(manifest):
+    os.makedirs(TRUE_RESULTS_INDEX_PATH, exist_ok=True)
+    manifest_path = os.path.join(TRUE_RESULTS_INDEX_PATH, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def _write_true_results_index_file(index_file, columns):
+    """Grava as colunas de um arquivo de gabarito; ids de tipos mistos (não representáveis) não são indexados."""
+    ids = np.asarray(columns[0])
+    if len(ids) == 0:
+        # Gabarito vazio: np.asarray([]) é float64, mas não há id a representar
+        ids = ids.astype(np.int64)
+    if ids.dtype.kind not in 'iuU':
+        return False
+    os.makedirs(TRUE_RESULTS_INDEX_PATH, exist_ok=True)
+    with open(index_file + '.tmp', 'wb') as f:
+        np.savez(f, ids=ids, types=np.asarray(columns[1], dtype=np.int8),
+                 values_1=np.asarray(columns[2], dtype=np.float64), values_2=np.asarray(columns[3], dtype=np.float64))
+    os.replace(index_file + '.tmp', index_file)
+    return True
+
+
+def _read_true_results_index_file(index_file):
+    with np.load(index_file, allow_pickle=False) as data:
+        return data['ids'].tolist(), data['types'], data['values_1'], data['values_2']
+
+
+def load_all_true_results(base_final_path, workers=None):
     """
     Carrega todos os arquivos de resposta (gabarito) de todas as subpastas de dias em 'data/final/'.
     Assume que os arquivos de dia estão no formato 'final-YYYY-MM-DD/' e os arquivos de resposta
     dentro são 'resposta-YYYY-MM-DD_HH.json'.
-    Retorna um dicionário mapeando 'id' da query para seus resultados verdadeiros.
+    Os arquivos já vistos são lidos do índice binário em TRUE_RESULTS_INDEX_PATH; apenas os novos ou
+    alterados (mtime/tamanho) são reprocessados, em paralelo em um pool de processos.
+    Retorna uma tabela colunar (DataFrame) com uma linha por 'id' de query e as colunas
+    'type' ('location' ou 'time'), 'lat', 'lon' e 'timestamp'. Se um id aparece mais de uma vez,
+    vale a última ocorrência (na ordem dos caminhos dos arquivos).
     """
-    true_results_map = {}
     print(f"Carregando resultados verdadeiros da pasta: {base_final_path}...")
     
     if not os.path.isdir(base_final_path):
         print(f"ERRO: A pasta de resultados esperados '{base_final_path}' não existe ou não é um diretório. Crie-a e adicione os arquivos de gabarito.")
-        return {}
+        return _empty_true_results()
 
-    # Itera sobre as pastas de dias (ex: 'final-2024-05-16')
-    for day_folder in os.listdir(base_final_path):
-        # Verifica se a pasta do dia começa com 'final-'
-        if day_folder.startswith('final-') and os.path.isdir(os.path.join(base_final_path, day_folder)):
-            day_path = os.path.join(base_final_path, day_folder)
-            for filename in os.listdir(day_path):
-                # Assume que os arquivos de gabarito são 'resposta-YYYY-MM-DD_HH.json'
-                if filename.startswith('resposta-') and filename.endswith('.json'):
-                    file_path = os.path.join(day_path, filename)
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            data = json.load(f)
-                        
-                        true_previsoes = data.get('previsoes', [])
-
-                        for item in true_previsoes:
-                            query_id = item[0]
-                            if len(item) == 3: # Previsão de localização: [id, lat, lon]
-                                true_results_map[query_id] = {'type': 'location', 'lat': item[1], 'lon': item[2]}
-                            elif len(item) == 2: # Previsão de tempo: [id, timestamp]
-                                true_results_map[query_id] = {'type': 'time', 'timestamp': item[1]}
-                            # else: # Comentado para output mais limpo
-                                # print(f"AVISO_GABARITO: Formato de previsão inesperado no arquivo {filename} para ID {query_id}. Pulando.")
-                    except Exception as e:
-                        print(f"ERRO_LOAD_TRUE_FILE: Erro ao carregar arquivo de resultado verdadeiro '{filename}': {e}")
-    
-    print(f"Total de {len(true_results_map)} resultados verdadeiros carregados para comparação.")
-    return true_results_map
+    file_paths = list_true_results_files(base_final_path)
+    manifest = _load_true_results_manifest() if USE_TRUE_RESULTS_INDEX else {'arquivos': {}}
+    previous_entries = manifest['arquivos']
+    current_entries = {}
+    columns_by_file = {}
+    files_to_parse = []
+
+    for file_path in file_paths:
+        key = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        entry = {'mtime_ns': stat.st_mtime_ns, 'tamanho': stat.st_size, 'indice': _true_results_index_file(file_path)}
+        previous = previous_entries.get(key)
+        if USE_TRUE_RESULTS_INDEX and previous == entry and os.path.isfile(entry['indice']):
+            try:
+                columns_by_file[file_path] = _read_true_results_index_file(entry['indice'])
+                current_entries[key] = entry
+                continue
+            except Exception:
+                pass
+        files_to_parse.append((file_path, key, entry))
+
+    if files_to_parse:
+        workers = workers or TRUE_RESULTS_LOAD_WORKERS or os.cpu_count() or 1
+        paths_to_parse = [file_path for file_path, _, _ in files_to_parse]
+        if workers > 1 and len(files_to_parse) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(files_to_parse))) as executor:
+                futures = [executor.submit(parse_true_results_file, path) for path in paths_to_parse]
+                results = [_future_result_or_error(future) for future in futures]
+        else:
+            results = [_call_or_error(parse_true_results_file, path) for path in paths_to_parse]
+
+        for (file_path, key, entry), (columns, error) in zip(files_to_parse, results):
+            if error is not None:
+                print(f"ERRO_LOAD_TRUE_FILE: Erro ao carregar arquivo de resultado verdadeiro '{os.path.basename(file_path)}': {error}")
+                continue
+            columns_by_file[file_path] = columns
+            if USE_TRUE_RESULTS_INDEX and _write_true_results_index_file(entry['indice'], columns):
+                current_entries[key] = entry
+
+    if USE_TRUE_RESULTS_INDEX:
+        for key, previous in previous_entries.items():
+            if key not in current_entries and os.path.isfile(previous.get('indice', '')):
+                os.remove(previous['indice'])
+        manifest['arquivos'] = current_entries
+        _save_true_results_manifest(manifest)
+
+    ids, types, values_1, values_2 = [], [], [], []
+    for file_path in file_paths:
+        if file_path in columns_by_file:
+            file_ids, file_types, file_values_1, file_values_2 = columns_by_file[file_path]
+            ids.extend(file_ids); types.extend(file_types); values_1.extend(file_values_1); values_2.extend(file_values_2)
+
+    true_results = _build_true_results_table(ids, types, values_1, values_2)
+    print(f"Total de {len(true_results)} resultados verdadeiros carregados para comparação "
+          f"({len(file_paths) - len(files_to_parse)} arquivos do índice, {len(files_to_parse)} processados).")
+    return true_results
+
+
+def _call_or_error(function, *args):
+    try:
+        return function(*args), None
+    except Exception as e:
+        return None, e
+
+
+def _future_result_or_error(future):
+    try:
+        return future.result(), None
+    except Exception as e:
+        return None, e
+
+
+def _empty_true_results():
+    return _build_true_results_table([], [], [], [])
+
+
+def _build_true_results_table(ids, types, values_1, values_2):
+    """Monta a tabela de gabarito a partir das colunas brutas (id, tipo, valor 1, valor 2)."""
+    import pandas as pd
+    types = np.asarray(types, dtype=np.int8)
+    values_1 = np.asarray(values_1, dtype=np.float64)
+    values_2 = np.asarray(values_2, dtype=np.float64)
+    is_location = types == TRUE_TYPE_LOCATION
+    table = pd.DataFrame({
+        'id': pd.Series(ids, dtype=object),
+        'type': np.where(is_location, 'location', 'time'),
+        'lat': np.where(is_location, values_1, np.nan),
+        'lon': np.where(is_location, values_2, np.nan),
+        'timestamp': np.where(is_location, np.nan, values_1),
+    })
+    return table.drop_duplicates(subset='id', keep='last').reset_index(drop=True)
 
 # --- FUNÇÕES DE AVALIAÇÃO ---
 
-def calculate_errors(your_predictions, true_results_map):
+def _predictions_table(your_predictions):
+    """Converte a lista de previsões ([id, lat, lon] ou [id, timestamp]) em colunas, mantendo a ordem."""
+    import pandas as pd
+    sizes = np.fromiter((len(pred) for pred in your_predictions), dtype=np.int64, count=len(your_predictions))
+    return pd.DataFrame({
+        'id': pd.Series([pred[0] for pred in your_predictions], dtype=object),
+        'size': sizes,
+        'value_1': np.array([pred[1] if len(pred) > 1 else np.nan for pred in your_predictions], dtype=np.float64),
+        'value_2': np.array([pred[2] if len(pred) > 2 else np.nan for pred in your_predictions], dtype=np.float64),
+    })
+
+
+def calculate_errors(your_predictions, true_results):
     """
     Compara as previsões com os resultados verdadeiros e calcula os erros.
+    O alinhamento por id é feito em bloco (join entre as previsões e a tabela de gabarito) e as
+    distâncias são calculadas de forma vetorizada. Retorna dois arrays, na ordem das previsões:
+    erros de localização (metros) e de tempo (segundos).
     """
-    location_errors = [] # Erros em metros
-    time_errors = []     # Erros em segundos
-
-    for pred in your_predictions:
-        pred_id = pred[0]
-        true_data = true_results_map.get(pred_id)
-
-        if not true_data:
-            # print(f"AVISO: Resultado verdadeiro não encontrado para ID de previsão: {pred_id}. Pulando.")
-            continue
-
-        if len(pred) == 3 and true_data['type'] == 'location': # Previsão de localização (id, lat, lon)
-            pred_lat, pred_lon = pred[1], pred[2]
-            true_lat, true_lon = true_data['lat'], true_data['lon']
-            
-            error_distance = geodesic((pred_lat, pred_lon), (true_lat, true_lon)).meters
-            location_errors.append(error_distance)
-
-        elif len(pred) == 2 and true_data['type'] == 'time': # Previsão de tempo (id, timestamp)
-            pred_timestamp = pred[1]
-            true_timestamp = true_data['timestamp']
-            
-            error_time_ms = abs(pred_timestamp - true_timestamp)
-            time_errors.append(error_time_ms / 1000) # Converte para segundos
+    if not your_predictions or true_results.empty:
+        return np.array([]), np.array([])
+
+    predictions = _predictions_table(your_predictions)
+    # Join interno: preserva a ordem das previsões
+    aligned = predictions.merge(true_results, on='id', how='inner', sort=False)
+
+    location = aligned[(aligned['size'] == 3) & (aligned['type'] == 'location')]
+    location_errors = distancias.geodesic_meters(location['value_1'].to_numpy(), location['value_2'].to_numpy(),
+                                                location['lat'].to_numpy(), location['lon'].to_numpy())
+
+    timed = aligned[(aligned['size'] == 2) & (aligned['type'] == 'time')]
+    time_errors = np.abs(timed['value_1'].to_numpy() - timed['timestamp'].to_numpy()) / 1000 # Converte para segundos
 
     return location_errors, time_errors
 
 # --- INÍCIO DO SCRIPT DE AVALIAÇÃO ---
-if __name__ == "__main__":
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Compara o resposta.json com os gabaritos de data/final/.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Processos para ler arquivos de gabarito novos/alterados (padrão: número de CPUs).")
+    return parser
+
+
+def run(args):
+    """Avaliação completa (argumentos de build_arg_parser): compara o resposta.json com o gabarito e grava o relatório."""
     print("Iniciando avaliação de desempenho FINAL...")
 
     # 1. Carregar suas previsões (o output do seu main.py)
     your_preds = load_your_predictions(YOUR_PREDICTIONS_FILE)
     if not your_preds:
         print("Avaliação não pode ser realizada sem previsões válidas. Certifique-se de que 'resposta.json' existe e está preenchido.")
-        exit()
+        return
     
     # 2. Carregar os resultados verdadeiros (gabaritos da pasta 'data/final/')
-    true_results = load_all_true_results(TRUE_RESULTS_BASE_PATH)
-    if not true_results:
+    true_results = load_all_true_results(TRUE_RESULTS_BASE_PATH, workers=args.workers)
+    if true_results.empty:
         print("Avaliação não pode ser realizada sem resultados verdadeiros válidos. Verifique a pasta 'data/final/' e o formato dos arquivos de gabarito.")
-        exit()
+        return
 
     # 3. Calcular os erros
     loc_errors, time_errors = calculate_errors(your_preds, true_results)
@@ -129,7 +301,7 @@ if __name__ == "__main__":
     report_lines.append(f"Total de resultados verdadeiros encontrados (gabarito): {len(true_results)}")
     
     report_lines.append("\n--- Métricas de Erro de Localização ---")
-    if loc_errors:
+    if len(loc_errors):
         report_lines.append(f"Número de previsões de localização avaliadas: {len(loc_errors)}")
         report_lines.append(f"Erro Médio Absoluto (MAE) de Posição: {np.mean(loc_errors):.2f} metros")
         report_lines.append(f"Erro Quadrático Médio (RMSE) de Posição: {np.sqrt(np.mean(np.array(loc_errors)**2)):.2f} metros")
@@ -138,7 +310,7 @@ if __name__ == "__main__":
         report_lines.append("Nenhuma previsão de localização para avaliar (verifique se há IDs correspondentes no gabarito).")
     
     report_lines.append("\n--- Métricas de Erro de Tempo ---")
-    if time_errors:
+    if len(time_errors):
         report_lines.append(f"Número de previsões de tempo avaliadas: {len(time_errors)}")
         report_lines.append(f"Erro Médio Absoluto (MAE) de Tempo: {np.mean(time_errors):.2f} segundos")
         report_lines.append(f"Erro Quadrático Médio (RMSE) de Tempo: {np.sqrt(np.mean(np.array(time_errors)**2)):.2f} segundos")
@@ -153,4 +325,8 @@ if __name__ == "__main__":
     
     print(f"\nRelatório de desempenho FINAL salvo em '{EVALUATION_REPORT_FILE}'.")
     print(final_report)
-    print("\nAvaliação de desempenho FINAL concluída!")
\ No newline at end of file
+    print("\nAvaliação de desempenho FINAL concluída!")
+
+
+if __name__ == "__main__":
+    run(build_arg_parser().parse_args())
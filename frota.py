@@ -0,0 +1,495 @@
+import os
+import json
+import numpy as np
+
+import rotas
+import distancias
+import perfis
+
+# --- ÍNDICE HISTÓRICO DA FROTA POR (LINHA, DIA DA SEMANA, HORA) ---
+# Resposta de reserva para queries cujo ônibus não tem histórico na janela: agrega todo o histórico das
+# linhas (todos os ônibus, todos os dias) em tabelas por (linha, dia da semana, hora do dia), construídas
+# uma vez (estágio offline) e gravadas como .npy, abertas com mmap. Cada consulta é uma leitura de tabela
+# (ou uma busca binária), sem depender do tamanho do histórico. O dia da semana ALL_WEEKDAYS guarda o
+# agregado de todos os dias e vale quando a célula do dia da semana da query não tem amostras.
+# - Posição: cada ônibus contribui com um ping por faixa de FLEET_MINUTE_BIN minutos, projetado na rota da
+#   linha (rotas.py, no sentido do movimento). Guarda-se a distância mediana ao longo da rota por
+#   (ônibus, linha, dia da semana, hora, faixa) e por (linha, dia da semana, hora, faixa); a consulta usa o
+#   mesmo ônibus em outros dias, senão a frota da linha, e devolve o ponto da rota a essa distância (a
+#   geometria das rotas usadas vai junto no índice). Linhas sem rota ficam só com o centroide da linha.
+#   Cada entrada só é guardada se, construída com os dias anteriores, errar menos que o nível seguinte (frota
+#   da linha -> centroide, mesmo ônibus -> frota da linha) no último dia em que tem amostras: numa linha sem
+#   horário regular a resposta continua sendo o centroide. O índice guarda ainda ('validacao') o erro médio
+#   da posição de reserva e do centroide no último dia, com as tabelas montadas só com os dias anteriores.
+# - Chegada: para cada célula de FLEET_GRID_CELL_M metros por onde a linha passa, o minuto mediano da hora
+#   em que os ônibus estiveram nela; sem a célula, o minuto mediano de todos os pings da linha na hora.
+
+FLEET_INDEX_VERSION = 2
+FLEET_MINUTE_BIN = 5
+FLEET_GRID_CELL_M = 250.0
+FLEET_MAX_SNAP_DISTANCE_M = 200.0
+
+ALL_WEEKDAYS = perfis.DAYS_PER_WEEK
+MINUTES_PER_HOUR = 60
+MINUTE_BINS = MINUTES_PER_HOUR // FLEET_MINUTE_BIN
+
+COORDINATE_SCALE = 10_000_000
+
+# Chave de célula: (cx, cy) deslocados para [0, 2^_CELL_BITS) em torno da origem do índice
+_CELL_BITS = 12
+_CELL_OFFSET = 1 << (_CELL_BITS - 1)
+_MINUTE_BITS = 6
+
+_ARRAY_FILES = ['distancias', 'amostras', 'onibus_chaves', 'onibus_distancias', 'centroides',
+                'rotas_offsets', 'rotas_latitude', 'rotas_longitude', 'rotas_distancia', 'rotas_fechada',
+                'celulas', 'celulas_minuto', 'minuto_hora', 'validacao']
+
+
+def new_fleet_accumulator():
+    return {'linhas': {}, 'onibus': {}, 'rotas': {}, 'origem': None, 'pings': 0,
+            'amostras_posicao': [], 'contagens_chegada': []}
+
+
+def _hour_keys(linha_codes, weekdays, hours):
+    """Chave plana de (linha, dia da semana, hora); o dia da semana vai de 0 a ALL_WEEKDAYS."""
+    return (linha_codes * (ALL_WEEKDAYS + 1) + weekdays) * perfis.HOURS_PER_DAY + hours
+
+
+def _all_weekdays_keys(keys):
+    """Mesmas chaves com o dia da semana trocado por ALL_WEEKDAYS."""
+    linha_codes = keys // ((ALL_WEEKDAYS + 1) * perfis.HOURS_PER_DAY)
+    return _hour_keys(linha_codes, ALL_WEEKDAYS, keys % perfis.HOURS_PER_DAY)
+
+
+def _slot_keys(linha_codes, weekdays, hours, minute_bins):
+    """Chave plana de (linha, dia da semana, hora, faixa de minutos): índice na tabela 'distancias' achatada."""
+    return _hour_keys(linha_codes, weekdays, hours) * MINUTE_BINS + minute_bins
+
+
+def _cell_keys(lats, lons, origin, cell_m=FLEET_GRID_CELL_M):
+    x, y = rotas.to_local_xy(lats, lons, origin)
+    limit = (1 << _CELL_BITS) - 1
+    cell_x = np.clip(np.floor(x / cell_m).astype(np.int64) + _CELL_OFFSET, 0, limit)
+    cell_y = np.clip(np.floor(y / cell_m).astype(np.int64) + _CELL_OFFSET, 0, limit)
+    return (cell_x << _CELL_BITS) | cell_y
+
+
+def _codes_for(mapping, labels):
+    """Códigos globais (estáveis entre horas) das categorias de uma hora."""
+    return np.array([mapping.setdefault(str(label), len(mapping)) for label in labels], dtype=np.int64)
+
+
+def accumulate_hour(accumulator, df, get_route=None, max_snap_distance_m=FLEET_MAX_SNAP_DISTANCE_M):
+    """
+    Soma ao índice uma hora no layout compacto (ordem, linha, latitude_e7, longitude_e7, velocidade, timestamp_ms).
+    get_route(linha) devolve a rota da linha (rotas.py) ou None; pings a mais de max_snap_distance_m da rota
+    não entram na distância ao longo da rota.
+    """
+    if df.empty:
+        return
+    linha_labels = df['linha'].cat.categories
+    local_linha = df['linha'].cat.codes.to_numpy().astype(np.int64)
+    local_ordem = df['ordem'].cat.codes.to_numpy().astype(np.int64)
+    linha_codes = _codes_for(accumulator['linhas'], linha_labels)[local_linha]
+    ordem_codes = _codes_for(accumulator['onibus'], df['ordem'].cat.categories)[local_ordem]
+    lats = df['latitude_e7'].to_numpy() / COORDINATE_SCALE
+    lons = df['longitude_e7'].to_numpy() / COORDINATE_SCALE
+    timestamps = df['timestamp_ms'].to_numpy().astype(np.int64)
+    if accumulator['origem'] is None:
+        accumulator['origem'] = (round(float(lats[0]), 4), round(float(lons[0]), 4))
+
+    weekdays, hours = perfis.weekday_and_hour(timestamps)
+    keys = _hour_keys(linha_codes, weekdays, hours)
+    minutes = (timestamps // 60_000) % MINUTES_PER_HOUR
+    accumulator['pings'] += len(df)
+
+    # Pings de cada ônibus em ordem de tempo; o ping anterior do mesmo ônibus dá o sentido na projeção
+    bus = local_ordem * len(linha_labels) + local_linha
+    order = np.lexsort((timestamps, bus))
+    same_bus = np.r_[False, bus[order][1:] == bus[order][:-1]]
+    previous = np.empty(len(df), dtype=np.int64)
+    previous[order] = np.where(same_bus, np.r_[order[0], order[:-1]], order)
+
+    # Posição: o primeiro ping de cada ônibus em cada faixa de minutos, para ônibus que pingam mais não pesarem mais
+    time_bins = timestamps // (FLEET_MINUTE_BIN * 60_000)
+    time_bins -= time_bins.min()
+    _, first_sorted = np.unique((bus * (int(time_bins.max()) + 1) + time_bins)[order], return_index=True)
+    first = order[first_sorted]
+    along = np.full(len(first), np.nan)
+    if get_route is not None:
+        for local_code in np.unique(local_linha[first]):
+            route = get_route(str(linha_labels[local_code]))
+            if route is None:
+                continue
+            selected = np.flatnonzero(local_linha[first] == local_code)
+            points = first[selected]
+            route_along, snap_distance = rotas.project_onto_route(route, lats[points], lons[points],
+                                                                  lats[previous[points]], lons[previous[points]])
+            along[selected] = np.where(snap_distance <= max_snap_distance_m, route_along, np.nan)
+            accumulator['rotas'].setdefault(int(linha_codes[points[0]]), route)
+    sample_keys = keys[first] * MINUTE_BINS + minutes[first] // FLEET_MINUTE_BIN
+    accumulator['amostras_posicao'].append((sample_keys, ordem_codes[first], timestamps[first] // (24 * 3600 * 1000),
+                                            along, lats[first], lons[first]))
+
+    # Chegada: contagem de pings por (chave, célula, minuto)
+    cells = _cell_keys(lats, lons, accumulator['origem'])
+    codes, counts = np.unique((((keys << (2 * _CELL_BITS)) | cells) << _MINUTE_BITS) | minutes, return_counts=True)
+    accumulator['contagens_chegada'].append((codes, counts))
+
+
+def _grouped_median(groups, values):
+    """Mediana de values por grupo. Retorna (grupos distintos, medianas, tamanhos)."""
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    unique_groups, starts, sizes = np.unique(groups, return_index=True, return_counts=True)
+    medians = (values[starts + (sizes - 1) // 2] + values[starts + sizes // 2]) / 2
+    return unique_groups, medians, sizes
+
+
+def _grouped_route_median(groups, along, lengths, closed):
+    """
+    Mediana por grupo de distâncias ao longo da rota. Em rotas fechadas (closed, por amostra, com o
+    comprimento lengths) as distâncias dão a volta: antes da mediana, cada grupo é recentrado na sua média
+    circular, para que um grupo em torno do ponto inicial da rota não se divida entre o começo e o fim.
+    Retorna (grupos distintos, medianas, tamanhos).
+    """
+    unique_groups, first, inverse = np.unique(groups, return_index=True, return_inverse=True)
+    closed = closed & (lengths > 0)
+    safe_lengths = np.where(closed, lengths, 1.0)
+    angle = 2 * np.pi * along / safe_lengths
+    mean_angle = np.arctan2(np.bincount(inverse, np.where(closed, np.sin(angle), 0.0), len(unique_groups)),
+                            np.bincount(inverse, np.where(closed, np.cos(angle), 0.0), len(unique_groups)))
+    centers = np.mod(mean_angle, 2 * np.pi) / (2 * np.pi) * safe_lengths[first]
+    shift = np.where(closed, centers[inverse] - safe_lengths / 2, 0.0)
+    shifted = np.where(closed, np.mod(along - shift, safe_lengths), along)
+
+    _, medians, sizes = _grouped_median(groups, shifted)
+    medians = np.where(closed[first], np.mod(medians + shift[first], safe_lengths[first]), medians)
+    return unique_groups, medians, sizes
+
+
+def _median_minutes(codes, counts):
+    """
+    Minuto mediano por grupo a partir de contagens por código (grupo << _MINUTE_BITS | minuto), somando as
+    contagens de códigos repetidos. Retorna (grupos, minuto mediano, total de pings).
+    """
+    codes, inverse = np.unique(codes, return_inverse=True)
+    counts = np.bincount(inverse, weights=counts).astype(np.int64)
+    groups = codes >> _MINUTE_BITS
+    minutes = codes & ((1 << _MINUTE_BITS) - 1)
+    unique_groups, starts = np.unique(groups, return_index=True)
+    cumulative = np.cumsum(counts)
+    before_group = np.r_[0, cumulative][starts]
+    totals = np.r_[cumulative[starts[1:] - 1], cumulative[-1]] - before_group
+    group_of_code = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(codes)]))
+    reached = 2 * (cumulative - before_group[group_of_code]) >= totals[group_of_code]
+    median_idx = np.minimum.reduceat(np.where(reached, np.arange(len(codes)), len(codes)), starts)
+    return unique_groups, minutes[median_idx], totals
+
+
+def _route_tables(accumulator, n_linhas):
+    """Geometria das rotas usadas, concatenada por linha (offsets no formato CSR; linhas sem rota ficam vazias)."""
+    routes = [accumulator['rotas'].get(code) for code in range(n_linhas)]
+    sizes = [len(route['distancia_acumulada']) if route is not None else 0 for route in routes]
+    used = [route for route in routes if route is not None]
+    return {
+        'rotas_offsets': np.r_[0, np.cumsum(sizes)].astype(np.int64),
+        'rotas_latitude': np.concatenate([route['latitude'] for route in used]) if used else np.zeros(0),
+        'rotas_longitude': np.concatenate([route['longitude'] for route in used]) if used else np.zeros(0),
+        'rotas_distancia': np.concatenate([route['distancia_acumulada'] for route in used]) if used else np.zeros(0),
+        'rotas_fechada': np.array([route is not None and bool(route['fechada']) for route in routes], dtype=bool),
+    }
+
+
+def _validated_groups(index, groups, days, along, lengths, closed, lines, lats, lons, fallback_lats, fallback_lons):
+    """
+    Validação fora da amostra dos grupos de um nível do índice (por amostra: grupo, dia, distância ao longo da
+    rota, rota da linha e posição; fallback_* é a resposta do nível seguinte). Para cada grupo, a mediana das
+    amostras dos dias anteriores ao último dia do grupo é comparada com o nível seguinte nas amostras desse
+    último dia. Retorna, ordenados, os grupos que erram menos; grupos com um só dia não são aprovados.
+    """
+    unique_groups, inverse = np.unique(groups, return_inverse=True)
+    last_day = np.full(len(unique_groups), np.iinfo(np.int64).min)
+    np.maximum.at(last_day, inverse, days)
+    holdout = days == last_day[inverse]
+    train = ~holdout
+    if not train.any():
+        return unique_groups[:0]
+
+    train_groups, train_medians, _ = _grouped_route_median(groups[train], along[train], lengths[train], closed[train])
+    _, first_train = np.unique(groups[train], return_index=True)
+    entry_lats, entry_lons = route_points(index, lines[train][first_train], train_medians)
+
+    test = np.flatnonzero(holdout)
+    position = np.minimum(np.searchsorted(train_groups, groups[test]), len(train_groups) - 1)
+    has_train = train_groups[position] == groups[test]
+    test, position = test[has_train], position[has_train]
+    entry_error = np.bincount(position, distancias.haversine_meters(lats[test], lons[test], entry_lats[position], entry_lons[position]),
+                              len(train_groups))
+    fallback_error = np.bincount(position, distancias.haversine_meters(lats[test], lons[test], fallback_lats[test], fallback_lons[test]),
+                                 len(train_groups))
+    tested = np.bincount(position, minlength=len(train_groups)) > 0
+    return train_groups[tested & (entry_error < fallback_error)]
+
+
+def _accumulate_route_medians(index, sample_keys, ordem_codes, days, along, lats, lons):
+    """
+    Preenche as distâncias medianas ao longo da rota por faixa da linha e por (ônibus, faixa) a partir das
+    amostras projetadas. Só ficam as entradas aprovadas por _validated_groups: as faixas contra o centroide da
+    linha e as entradas por ônibus contra a faixa da linha (ou o centroide, onde a faixa não ficou).
+    """
+    n_linhas = len(index['centroides'])
+    slots_per_line = (ALL_WEEKDAYS + 1) * perfis.HOURS_PER_DAY * MINUTE_BINS
+    sample_keys = np.r_[sample_keys, _all_weekdays_keys(sample_keys // MINUTE_BINS) * MINUTE_BINS + sample_keys % MINUTE_BINS]
+    ordem_codes, days, along = np.r_[ordem_codes, ordem_codes], np.r_[days, days], np.r_[along, along]
+    lats, lons = np.r_[lats, lats], np.r_[lons, lons]
+
+    offsets = index['rotas_offsets']
+    route_lengths = np.array([index['rotas_distancia'][offsets[code + 1] - 1] if offsets[code + 1] > offsets[code] else 0.0
+                              for code in range(n_linhas)])
+    lines = sample_keys // slots_per_line
+    lengths, closed = route_lengths[lines], index['rotas_fechada'][lines]
+    centroid_lats, centroid_lons = index['centroides'][lines, 0], index['centroides'][lines, 1]
+
+    slots, medians, sizes = _grouped_route_median(sample_keys, along, lengths, closed)
+    kept = np.isin(slots, _validated_groups(index, sample_keys, days, along, lengths, closed, lines, lats, lons,
+                                            centroid_lats, centroid_lons))
+    index['distancias'].reshape(-1)[slots[kept]] = medians[kept]
+    index['amostras'].reshape(-1)[slots] = sizes
+
+    # Nível seguinte de cada amostra para as entradas por ônibus: a faixa da linha (se ficou) ou o centroide
+    slot_lats, slot_lons = route_points(index, slots // slots_per_line, medians)
+    of_sample = np.searchsorted(slots, sample_keys)
+    line_lats = np.where(kept[of_sample], slot_lats[of_sample], centroid_lats)
+    line_lons = np.where(kept[of_sample], slot_lons[of_sample], centroid_lons)
+
+    bus_keys = ordem_codes * (n_linhas * slots_per_line) + sample_keys
+    bus_slots, bus_medians, _ = _grouped_route_median(bus_keys, along, lengths, closed)
+    bus_kept = np.isin(bus_slots, _validated_groups(index, bus_keys, days, along, lengths, closed, lines, lats, lons,
+                                                    line_lats, line_lons))
+    index['onibus_chaves'] = bus_slots[bus_kept]
+    index['onibus_distancias'] = bus_medians[bus_kept]
+
+
+def _position_tables(n_linhas):
+    """Tabelas vazias da parte de posição do índice."""
+    shape = (n_linhas, ALL_WEEKDAYS + 1, perfis.HOURS_PER_DAY, MINUTE_BINS)
+    return {
+        'distancias': np.full(shape, np.nan),
+        'amostras': np.zeros(shape, dtype=np.int32),
+        'onibus_chaves': np.zeros(0, dtype=np.int64),
+        'onibus_distancias': np.zeros(0),
+        'centroides': np.full((n_linhas, 2), np.nan),
+    }
+
+
+def _fill_position_tables(index, sample_keys, ordem_codes, days, along, lats, lons):
+    """Centroides das linhas e medianas ao longo da rota a partir das amostras de posição."""
+    slots_per_line = (ALL_WEEKDAYS + 1) * perfis.HOURS_PER_DAY * MINUTE_BINS
+    lines, centroid_lats, _ = _grouped_median(sample_keys // slots_per_line, lats)
+    _, centroid_lons, _ = _grouped_median(sample_keys // slots_per_line, lons)
+    index['centroides'][lines] = np.column_stack((centroid_lats, centroid_lons))
+
+    routed = np.isfinite(along)
+    if routed.any():
+        _accumulate_route_medians(index, sample_keys[routed], ordem_codes[routed], days[routed], along[routed],
+                                  lats[routed], lons[routed])
+
+
+def _holdout_errors(index, sample_keys, ordem_codes, days, along, lats, lons):
+    """
+    Erro médio (m) da posição de reserva e do centroide da linha nas amostras do último dia, com as tabelas de
+    posição montadas só com os dias anteriores: [erro do índice, erro do centroide, amostras]. NaN com um só dia.
+    """
+    last_day = days == days.max()
+    if last_day.all():
+        return np.array([np.nan, np.nan, 0.0])
+    held_out = dict(index, **_position_tables(len(index['centroides'])))
+    train = ~last_day
+    _fill_position_tables(held_out, sample_keys[train], ordem_codes[train], days[train], along[train], lats[train], lons[train])
+
+    codes, weekdays, hours, minute_bins = np.unravel_index(sample_keys[last_day], held_out['distancias'].shape)
+    pred_lats, pred_lons = _coded_positions(held_out, codes, ordem_codes[last_day], weekdays, hours, minute_bins)
+    centroid_lats, centroid_lons = held_out['centroides'][codes, 0], held_out['centroides'][codes, 1]
+    scored = np.isfinite(centroid_lats)
+    if not scored.any():
+        return np.array([np.nan, np.nan, 0.0])
+    test_lats, test_lons = lats[last_day][scored], lons[last_day][scored]
+    return np.array([distancias.haversine_meters(test_lats, test_lons, pred_lats[scored], pred_lons[scored]).mean(),
+                     distancias.haversine_meters(test_lats, test_lons, centroid_lats[scored], centroid_lons[scored]).mean(),
+                     float(scored.sum())])
+
+
+def finalize_fleet_index(accumulator):
+    """
+    Tabelas finais do índice a partir do acumulador (inclui o agregado de todos os dias da semana). 'validacao'
+    guarda o erro da posição de reserva contra o centroide da linha no último dia (ver _holdout_errors).
+    """
+    n_linhas = len(accumulator['linhas'])
+    shape = (n_linhas, ALL_WEEKDAYS + 1, perfis.HOURS_PER_DAY)
+    index = {
+        **_position_tables(n_linhas),
+        'celulas': np.zeros(0, dtype=np.int64),
+        'celulas_minuto': np.zeros(0, dtype=np.int8),
+        'minuto_hora': np.full(shape, -1, dtype=np.int8),
+        'validacao': np.array([np.nan, np.nan, 0.0]),
+    }
+    index.update(_route_tables(accumulator, n_linhas))
+    if not accumulator['amostras_posicao']:
+        return index
+
+    samples = [np.concatenate(column) for column in zip(*accumulator['amostras_posicao'])]
+    _fill_position_tables(index, *samples)
+    index['validacao'] = _holdout_errors(index, *samples)
+
+    codes, counts = (np.concatenate(column) for column in zip(*accumulator['contagens_chegada']))
+    keys = codes >> (2 * _CELL_BITS + _MINUTE_BITS)
+    all_days_codes = (_all_weekdays_keys(keys) << (2 * _CELL_BITS + _MINUTE_BITS)) | (codes & ((1 << (2 * _CELL_BITS + _MINUTE_BITS)) - 1))
+    codes, counts = np.r_[codes, all_days_codes], np.r_[counts, counts]
+
+    cell_groups, cell_minutes, _ = _median_minutes(codes, counts)
+    index['celulas'] = cell_groups
+    index['celulas_minuto'] = cell_minutes.astype(np.int8)
+
+    hour_codes = ((codes >> (2 * _CELL_BITS + _MINUTE_BITS)) << _MINUTE_BITS) | (codes & ((1 << _MINUTE_BITS) - 1))
+    hour_keys, hour_minutes, _ = _median_minutes(hour_codes, counts)
+    index['minuto_hora'].reshape(-1)[hour_keys] = hour_minutes
+    return index
+
+
+def save_fleet_index(index, metadata, folder):
+    """Grava as tabelas (.npy, abertas com mmap em load_fleet_index) e, por último, o indice.json que as valida."""
+    os.makedirs(folder, exist_ok=True)
+    metadata_path = os.path.join(folder, 'indice.json')
+    if os.path.isfile(metadata_path):
+        os.remove(metadata_path)
+    for name in _ARRAY_FILES:
+        with open(os.path.join(folder, name + '.npy.tmp'), 'wb') as f:
+            np.save(f, index[name])
+        os.replace(os.path.join(folder, name + '.npy.tmp'), os.path.join(folder, name + '.npy'))
+    metadata = dict(metadata, versao=FLEET_INDEX_VERSION, faixa_minutos=FLEET_MINUTE_BIN, celula_m=FLEET_GRID_CELL_M)
+    with open(metadata_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, ensure_ascii=False)
+    os.replace(metadata_path + '.tmp', metadata_path)
+
+
+def load_fleet_index(folder):
+    """Abre o índice gravado em folder (tabelas em mmap, só leitura); None se não existe ou é de outra versão."""
+    try:
+        with open(os.path.join(folder, 'indice.json'), 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (metadata.get('versao'), metadata.get('faixa_minutos'), metadata.get('celula_m')) != \
+            (FLEET_INDEX_VERSION, FLEET_MINUTE_BIN, FLEET_GRID_CELL_M):
+        return None
+    index = {name: np.load(os.path.join(folder, name + '.npy'), mmap_mode='r') for name in _ARRAY_FILES}
+    index['linhas'] = {linha: code for code, linha in enumerate(metadata['linhas'])}
+    index['onibus'] = {ordem: code for code, ordem in enumerate(metadata['onibus'])}
+    index['origem'] = tuple(metadata['origem']) if metadata['origem'] else None
+    return index
+
+
+def _linha_codes(index, linhas):
+    return np.array([index['linhas'].get(str(linha), -1) for linha in linhas], dtype=np.int64)
+
+
+def route_points(index, linha_codes, along):
+    """Pontos (lat, lon) das rotas guardadas no índice a uma distância 'along' do início (com volta nas fechadas)."""
+    lats = np.full(len(along), np.nan)
+    lons = np.full(len(along), np.nan)
+    offsets = index['rotas_offsets']
+    for code in np.unique(linha_codes):
+        start, end = offsets[code], offsets[code + 1]
+        if end - start < 2:
+            continue
+        selected = np.flatnonzero(linha_codes == code)
+        cumulative = index['rotas_distancia'][start:end]
+        positions = along[selected]
+        if index['rotas_fechada'][code] and cumulative[-1] > 0:
+            positions = np.mod(positions, cumulative[-1])
+        lats[selected] = np.interp(positions, cumulative, index['rotas_latitude'][start:end])
+        lons[selected] = np.interp(positions, cumulative, index['rotas_longitude'][start:end])
+    return lats, lons
+
+
+def _coded_positions(index, codes, ordem_codes, weekdays, hours, minute_bins):
+    """Consulta de fleet_positions já com códigos de linha e ônibus (-1 para ônibus fora do índice)."""
+    day_levels = (weekdays, np.full(len(codes), ALL_WEEKDAYS))
+    along = np.full(len(codes), np.nan)
+
+    bus_keys_table, n_slots = index['onibus_chaves'], index['distancias'].size
+    if len(bus_keys_table):
+        for days in day_levels:
+            keys = ordem_codes * n_slots + _slot_keys(codes, days, hours, minute_bins)
+            found = np.minimum(np.searchsorted(bus_keys_table, keys), len(bus_keys_table) - 1)
+            hit = np.isnan(along) & (ordem_codes >= 0) & (bus_keys_table[found] == keys)
+            along[hit] = index['onibus_distancias'][found[hit]]
+    for days in day_levels:
+        missing = np.isnan(along)
+        along[missing] = index['distancias'][codes[missing], days[missing], hours[missing], minute_bins[missing]]
+
+    lats, lons = route_points(index, codes, along)
+    no_route = np.isnan(lats)
+    lats[no_route] = index['centroides'][codes[no_route], 0]
+    lons[no_route] = index['centroides'][codes[no_route], 1]
+    return lats, lons
+
+
+def fleet_positions(index, bus_keys, target_timestamps_ms):
+    """
+    Posição de reserva de cada ônibus (bus_keys: pares (ordem, linha)) no instante alvo, na ordem: distância
+    mediana ao longo da rota do mesmo ônibus em outros dias, da frota da linha e, sem rota ou sem amostras,
+    o centroide da linha. Em cada nível, o dia da semana da query antes do agregado de todos os dias.
+    Retorna arrays (lat, lon), NaN para linhas fora do índice.
+    """
+    target_timestamps_ms = np.asarray(target_timestamps_ms, dtype=np.int64)
+    pred_lats = np.full(len(target_timestamps_ms), np.nan)
+    pred_lons = np.full(len(target_timestamps_ms), np.nan)
+    linha_codes = _linha_codes(index, [linha for _, linha in bus_keys])
+    known = np.flatnonzero(linha_codes >= 0)
+    if len(known) == 0:
+        return pred_lats, pred_lons
+
+    ordem_codes = np.array([index['onibus'].get(str(bus_keys[k][0]), -1) for k in known], dtype=np.int64)
+    weekdays, hours = perfis.weekday_and_hour(target_timestamps_ms[known])
+    minute_bins = (target_timestamps_ms[known] // 60_000) % MINUTES_PER_HOUR // FLEET_MINUTE_BIN
+    pred_lats[known], pred_lons[known] = _coded_positions(index, linha_codes[known], ordem_codes, weekdays, hours, minute_bins)
+    return pred_lats, pred_lons
+
+
+def fleet_arrival_times(index, linhas, target_lats, target_lons, reference_timestamps_ms):
+    """
+    Instante de chegada típico da linha a cada local, na hora do instante de referência: início da hora mais
+    o minuto mediano da célula do local (ou da hora inteira), no meio do minuto e nunca antes da referência.
+    Array de timestamps em ms (float), NaN sem amostras.
+    """
+    reference_timestamps_ms = np.asarray(reference_timestamps_ms, dtype=np.int64)
+    predictions = np.full(len(reference_timestamps_ms), np.nan)
+    linha_codes = _linha_codes(index, linhas)
+    known = np.flatnonzero(linha_codes >= 0)
+    if len(known) == 0 or index['origem'] is None:
+        return predictions
+
+    references = reference_timestamps_ms[known]
+    weekdays, hours = perfis.weekday_and_hour(references)
+    cells = _cell_keys(np.asarray(target_lats, dtype=np.float64)[known], np.asarray(target_lons, dtype=np.float64)[known],
+                       index['origem'])
+    minutes = np.full(len(known), -1, dtype=np.int64)
+    all_weekdays = np.full(len(known), ALL_WEEKDAYS)
+    # Ordem de preferência: célula no dia da semana, célula em todos os dias, hora no dia, hora em todos os dias
+    if len(index['celulas']):
+        for days in (weekdays, all_weekdays):
+            keys = (_hour_keys(linha_codes[known], days, hours) << (2 * _CELL_BITS)) | cells
+            found = np.minimum(np.searchsorted(index['celulas'], keys), len(index['celulas']) - 1)
+            hit = (minutes < 0) & (index['celulas'][found] == keys)
+            minutes[hit] = index['celulas_minuto'][found[hit]]
+    for days in (weekdays, all_weekdays):
+        missing = minutes < 0
+        minutes[missing] = index['minuto_hora'][linha_codes[known][missing], days[missing], hours[missing]]
+
+    answered = minutes >= 0
+    hour_starts = references - references % 3_600_000
+    arrivals = np.maximum(hour_starts + minutes * 60_000 + 30_000, references)
+    predictions[known[answered]] = arrivals[answered]
+    return predictions
@@ -0,0 +1,230 @@
+import sys
+import json
+import time
+import html
+import threading
+import functools
+import contextlib
+
+# --- INSTRUMENTAÇÃO DO PIPELINE ---
+# Temporizadores e contadores por etapa, desligados por padrão (main.py --profile liga). Desligada, cada
+# ponto instrumentado custa só a checagem de ENABLED. Os tempos são inclusivos: uma etapa que chama outra
+# também conta o tempo da interna.
+
+ENABLED = False
+
+# nome da etapa -> {'chamadas', 'segundos', 'itens'}
+STAGE_STATS = {}
+
+# nome do contador -> valor
+COUNTERS = {}
+
+_STATS_LOCK = threading.Lock()
+_DISABLED_STAGE = contextlib.nullcontext({})
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def reset():
+    with _STATS_LOCK:
+        STAGE_STATS.clear()
+        COUNTERS.clear()
+
+
+def _record_stage(name, elapsed_s, items):
+    with _STATS_LOCK:
+        stats = STAGE_STATS.get(name)
+        if stats is None:
+            stats = STAGE_STATS[name] = {'chamadas': 0, 'segundos': 0.0, 'itens': 0}
+        stats['chamadas'] += 1
+        stats['segundos'] += elapsed_s
+        stats['itens'] += items
+
+
+class _Stage:
+    __slots__ = ('name', 'start', 'result')
+
+    def __init__(self, name, items):
+        self.name = name
+        self.result = {'itens': items}
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.result
+
+    def __exit__(self, *exc_info):
+        _record_stage(self.name, time.perf_counter() - self.start, self.result['itens'] or 0)
+        return False
+
+
+def stage(name, items=0):
+    """
+    Mede um bloco: `with stage('nome') as s: ...; s['itens'] = n`. Desligada, devolve um contexto nulo
+    (o dicionário retornado continua aceitando 'itens', que é ignorado).
+    """
+    if not ENABLED:
+        return _DISABLED_STAGE
+    return _Stage(name, items)
+
+
+def timed(name):
+    """Decorador: mede cada chamada da função como a etapa 'name'."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record_stage(name, time.perf_counter() - start, 0)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    if ENABLED:
+        with _STATS_LOCK:
+            COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+
+def snapshot():
+    with _STATS_LOCK:
+        return {
+            'etapas': {name: dict(stats) for name, stats in STAGE_STATS.items()},
+            'contadores': dict(COUNTERS),
+        }
+
+
+def merge(other_snapshot):
+    """Soma ao estado atual um snapshot de outro processo (workers de run_test_days)."""
+    with _STATS_LOCK:
+        for name, stats in other_snapshot['etapas'].items():
+            current = STAGE_STATS.setdefault(name, {'chamadas': 0, 'segundos': 0.0, 'itens': 0})
+            for field in current:
+                current[field] += stats[field]
+        for name, value in other_snapshot['contadores'].items():
+            COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+
+def format_report(report=None, total_seconds=None):
+    """Tabela legível das etapas (ordenadas por tempo) e dos contadores."""
+    report = report or snapshot()
+    lines = ["--- Perfil de Execução (tempos inclusivos; com --workers, somados entre os processos) ---",
+             f"{'Etapa':<36}{'Chamadas':>10}{'Segundos':>12}{'% total':>9}{'ms/chamada':>12}{'Itens':>12}"]
+    for name, stats in sorted(report['etapas'].items(), key=lambda item: -item[1]['segundos']):
+        share = f"{stats['segundos'] / total_seconds * 100:.1f}" if total_seconds else '-'
+        per_call_ms = stats['segundos'] / stats['chamadas'] * 1000 if stats['chamadas'] else 0.0
+        lines.append(f"{name:<36}{stats['chamadas']:>10}{stats['segundos']:>12.4f}{share:>9}{per_call_ms:>12.3f}{stats['itens'] or '':>12}")
+    if report['contadores']:
+        lines.append("")
+        lines.append(f"{'Contador':<48}{'Valor':>14}")
+        for name, value in sorted(report['contadores'].items()):
+            lines.append(f"{name:<48}{value:>14}")
+    if total_seconds:
+        lines.append(f"\nTempo total da execução: {total_seconds:.3f} s")
+    return "\n".join(lines)
+
+
+def write_report(file_path, total_seconds=None):
+    report = snapshot()
+    report['segundos_totais'] = total_seconds
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+# --- PROFILER POR AMOSTRAGEM ---
+
+SAMPLING_INTERVAL_S = 0.005
+
+
+class SamplingProfiler:
+    """
+    Amostra periodicamente (sys._current_frames) a pilha da thread que o criou e conta as pilhas iguais.
+    O resultado sai no formato "collapsed" (uma linha 'f1;f2;f3 contagem', lido por flamegraph.pl e
+    speedscope) e como um flamegraph SVG autocontido.
+    """
+
+    def __init__(self, interval_s=SAMPLING_INTERVAL_S):
+        self.interval_s = interval_s
+        self.thread_id = threading.get_ident()
+        self.stack_counts = {}
+        self.samples = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _sample_loop(self):
+        while not self._stop_event.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                module = code.co_filename.rsplit('/', 1)[-1].rsplit('\\', 1)[-1]
+                stack.append(f"{code.co_name} ({module})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stack_counts[key] = self.stack_counts.get(key, 0) + 1
+                self.samples += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write_collapsed(self, file_path):
+        with open(file_path, 'w', encoding='utf-8') as f:
+            for stack, samples in sorted(self.stack_counts.items()):
+                f.write(f"{stack} {samples}\n")
+
+    def write_flamegraph_svg(self, file_path, width=1200, row_height=16):
+        """Flamegraph SVG simples: largura de cada quadro proporcional às amostras em que ele está na pilha."""
+        tree = {'nome': 'total', 'amostras': 0, 'filhos': {}}
+        for stack, samples in self.stack_counts.items():
+            node = tree
+            node['amostras'] += samples
+            for frame_name in stack.split(';'):
+                node = node['filhos'].setdefault(frame_name, {'nome': frame_name, 'amostras': 0, 'filhos': {}})
+                node['amostras'] += samples
+
+        rects = []
+        max_depth = [0]
+
+        def layout(node, x, depth):
+            max_depth[0] = max(max_depth[0], depth)
+            rects.append((x, depth, node))
+            child_x = x
+            for child in sorted(node['filhos'].values(), key=lambda child: child['nome']):
+                layout(child, child_x, depth + 1)
+                child_x += child['amostras']
+
+        layout(tree, 0, 0)
+        total = max(tree['amostras'], 1)
+        height = (max_depth[0] + 1) * row_height + 20
+        parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">']
+        for x, depth, node in rects:
+            rect_width = node['amostras'] / total * width
+            if rect_width < 0.5:
+                continue
+            rect_x = x / total * width
+            rect_y = height - (depth + 1) * row_height
+            hue = 20 + sum(map(ord, node["nome"])) % 40
+            label = html.escape(node['nome'])
+            title = f"{label}: {node['amostras']} amostras ({node['amostras'] / total * 100:.1f}%)"
+            text = label[:int(rect_width / 7)] if rect_width > 21 else ''
+            parts.append(f'<g><title>{title}</title><rect x="{rect_x:.1f}" y="{rect_y}" width="{rect_width:.1f}" '
+                         f'height="{row_height - 1}" fill="hsl({hue},90%,60%)"/>'
+                         f'<text x="{rect_x + 2:.1f}" y="{rect_y + row_height - 4}">{text}</text></g>')
+        parts.append('</svg>')
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(parts))
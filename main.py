@@ -1,8 +1,27 @@
 import os
+import re
 import json
+import math
+import shutil
+import tempfile
+import argparse
+import hashlib
+import time
+import threading
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta, timezone 
-from geopy.distance import geodesic 
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import rotas
+import perfis
+import distancias
+import compressao
+import frota
+import instrumentacao
+from instrumentacao import timed
 
 # --- CONFIGURAÇÕES GLOBAIS ---
 ALUNO_NOME = "Brian Medeiros"
@@ -13,6 +32,32 @@ BASE_DATA_PATH = 'data/'
 OUTPUT_FILE = 'resposta.json'
 EVAL_REPORT_FILE = 'relatorio_avaliacao_mvp.txt' 
 
+# Raiz dos caches em disco (horas pré-processadas, manifesto, rotas, perfis, índice da frota e checkpoints);
+# set_cache_path muda todos juntos (o cli.py usa <pasta de dados>/cache quando a pasta de dados é outra)
+CACHE_PATH = 'cache/'
+
+# Saídas de --profile (tempos por etapa e contadores) e de --profile-flamegraph (amostras de pilha)
+PROFILE_REPORT_FILE = 'relatorio_perfil.json'
+PROFILE_FLAMEGRAPH_FILE = 'perfil_amostras.svg'
+PROFILE_COLLAPSED_STACKS_FILE = 'perfil_amostras.txt'
+
+# Mensagens por arquivo horário (INFO_LOADED_FILE, INFO_MEMORY); --quiet desliga
+LOG_EACH_FILE = True
+
+# Checkpoints (--checkpoint): as previsões de cada arquivo treino concluído vão para um shard JSONL em
+# CHECKPOINT_PATH/<dia>/; numa nova execução os arquivos com shard válido não são reprocessados
+CHECKPOINT_ENABLED = False
+CHECKPOINT_PATH = os.path.join(CACHE_PATH, 'checkpoints/')
+CHECKPOINT_VERSION = 1
+
+# Janela de histórico (horas antes do instante da query) usada nas previsões e na avaliação interna;
+# a janela carregada para cada dia de teste começa QUERY_HOURS_BEFORE horas antes da meia-noite
+QUERY_HOURS_BEFORE = 5
+EVAL_HOURS_BEFORE = 5
+
+# Escopo do agrupamento de queries por ônibus (plan_queries_by_bus): 'arquivo' (cada treino-*.json) ou 'dia'
+QUERY_PLAN_SCOPE = 'arquivo'
+
 # Linhas de ônibus a serem consideradas
 LINHAS_INTERESSE = [
     "483", "864", "639", "3", "309", "774", "629", "371", "397", "100", "838",
@@ -25,61 +70,476 @@ LINHAS_INTERESSE = [
 # Cache para mapear (ano, mês, dia, hora) para lista de caminhos de arquivo histórico bruto
 HISTORICAL_RAW_FILE_PATH_CACHE = {}
 
+# Manifesto persistente da árvore historical/ (pasta do dia -> arquivos com chave, tamanho, mtime, registros
+# válidos e timestamps mínimo/máximo). Na inicialização só as pastas de dia com mtime alterado são reescaneadas.
+# Alterações no conteúdo de um arquivo existente não mudam o mtime da pasta; o cache de horas em disco
+# valida cada arquivo individualmente.
+USE_HISTORICAL_MANIFEST = True
+HISTORICAL_MANIFEST_PATH = os.path.join(CACHE_PATH, 'manifest_historico.json')
+HISTORICAL_MANIFEST_VERSION = 1
+HISTORICAL_SCAN_WORKERS = 8
+HISTORICAL_FILE_MANIFEST = {}
+
+# Rotas de referência por linha, construídas no estágio offline (python main.py --build-routes)
+# e carregadas sob demanda. Sem rotas construídas, a previsão de chegada usa o ping histórico mais próximo.
+ROUTES_PATH = os.path.join(CACHE_PATH, 'rotas/')
+ROUTE_BUILD_DAYS = 3
+ROUTE_MAX_SNAP_DISTANCE_M = 200.0
+ROUTE_DEFAULT_SPEED_MS = 5.0
+ROUTE_SPEED_WINDOW_MS = 15 * 60 * 1000
+ROUTE_CACHE = {}
+
+# Perfis de tempo de viagem por linha, trecho da rota e dia da semana/hora (perfis.py), construídos no estágio
+# offline (python main.py --build-profiles, depois das rotas) e carregados sob demanda. Com perfil, a posição
+# de um ônibus além do último ping é extrapolada ao longo da rota (até PROFILE_MAX_EXTRAPOLATION_MS) e a
+# chegada usa o tempo de viagem típico; sem perfil, as previsões não mudam.
+PROFILES_PATH = os.path.join(CACHE_PATH, 'perfis/')
+PROFILE_BUILD_DAYS = 14
+PROFILE_MAX_EXTRAPOLATION_MS = 20 * 60 * 1000
+PROFILE_CACHE = {}
+
+# Dead reckoning (extrapolate_dead_reckoning): depois do último ping, quando não há perfil, o ônibus avança no
+# rumo dos pings dos últimos DEAD_RECKONING_WINDOW_MS, com a velocidade reportada média nessa janela (ou, sem
+# ela, a medida pelo deslocamento), por no máximo DEAD_RECKONING_MAX_MS. Com rota da linha (e
+# DEAD_RECKONING_SNAP_TO_ROUTE), o avanço é feito ao longo da rota; senão, em linha reta.
+DEAD_RECKONING_ENABLED = True
+DEAD_RECKONING_WINDOW_MS = 3 * 60 * 1000
+DEAD_RECKONING_MIN_DISPLACEMENT_M = 20.0
+DEAD_RECKONING_MAX_SPEED_MS = 25.0
+DEAD_RECKONING_MAX_MS = 10 * 60 * 1000
+DEAD_RECKONING_SNAP_TO_ROUTE = True
+
+# Índice histórico da frota por (linha, dia da semana, hora) (frota.py), construído no estágio offline
+# (python main.py --build-fleet-index) sobre todo o histórico, ou os FLEET_INDEX_BUILD_DAYS dias mais recentes,
+# e aberto com mmap. Responde as queries cujo ônibus não tem histórico na janela, que antes ficavam sem
+# previsão; sem o índice construído, nada muda.
+FLEET_INDEX_PATH = os.path.join(CACHE_PATH, 'frota/')
+FLEET_INDEX_BUILD_DAYS = None
+FLEET_FALLBACK_ENABLED = True
+FLEET_INDEX_CACHE = {}
+
 # Cache de DataFrames carregados para a janela de um dia de teste específico
 CURRENT_TEST_DAY_DATA_CACHE = {} 
 
+# Índice de trajetórias do dia de teste: (ordem, linha) -> arrays NumPy contíguos ordenados por tempo
+CURRENT_TEST_DAY_TRAJECTORY_INDEX = {}
+# (data de referência, hours_before) da janela atualmente carregada no cache do dia
+CURRENT_TEST_DAY_WINDOW = None
+
+# Buffers com folga por ônibus para a ingestão incremental (ingest_new_historical_files): registros de um
+# arquivo horário novo são escritos no fim do buffer e a entrada do índice passa a ser uma view maior dele.
+# Quando a folga acaba, o buffer é realocado com TRAJECTORY_GROWTH_FACTOR vezes o tamanho necessário.
+TRAJECTORY_APPEND_BUFFERS = {}
+TRAJECTORY_GROWTH_FACTOR = 2
+TRAJECTORY_COLUMNS = ['timestamp_ms', 'latitude', 'longitude', 'velocidade']
+
+# Cache LRU em memória das horas pré-processadas (por caminho de arquivo), compartilhado entre dias de teste
+# consecutivos: as horas que se sobrepõem entre um dia e o seguinte não são recarregadas. Limitado por número
+# de entradas e, opcionalmente, por bytes (HOUR_CACHE_MAX_BYTES=None desativa o limite de bytes).
+HOUR_CACHE_MAX_ENTRIES = 48
+HOUR_CACHE_MAX_BYTES = None
+HOUR_DATA_LRU_CACHE = OrderedDict()
+HOUR_CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+# Pré-carregamento (run_test_days sequencial): enquanto as queries de um dia são previstas, PREFETCH_WORKERS
+# threads pré-processam as horas da janela do dia seguinte. No máximo PREFETCH_MAX_HOURS horas ficam
+# carregadas à espera de consumo (contrapressão), fora do cache LRU. PREFETCH_WORKERS = 0 desliga.
+PREFETCH_WORKERS = 4
+PREFETCH_MAX_HOURS = 24
+HOUR_PREFETCHER = None
+
+# Cache persistente em disco das horas brutas já pré-processadas (uma coluna por arquivo .npy).
+# Cada arquivo histórico é gravado uma vez e, nas execuções seguintes, lido via memory-map.
+# É invalidado quando o mtime/tamanho do arquivo de origem ou as LINHAS_INTERESSE mudam.
+USE_PREPROCESSED_CACHE = True
+PREPROCESSED_CACHE_PATH = os.path.join(CACHE_PATH, 'horas/')
+PREPROCESSED_CACHE_VERSION = 2
+
+# Layout compacto de cada hora carregada: ordem/linha como categorias (códigos inteiros + dicionário),
+# coordenadas em ponto fixo int32 (graus * COORDINATE_SCALE), um único timestamp int64 e velocidade uint8.
+PREPROCESSED_COLUMNS = ['ordem', 'linha', 'latitude_e7', 'longitude_e7', 'velocidade', 'timestamp_ms']
+CATEGORICAL_COLUMNS = ['ordem', 'linha']
+COORDINATE_SCALE = 10_000_000
+
 # --- FUNÇÕES UTILITÁRIAS ---
 
-def load_and_preprocess_single_raw_file(file_path):
+def set_cache_path(cache_path):
+    """Aponta todos os caches em disco para cache_path (mesmas subpastas do padrão 'cache/') e esvazia os caches em memória deles."""
+    global CACHE_PATH, CHECKPOINT_PATH, HISTORICAL_MANIFEST_PATH, ROUTES_PATH, PROFILES_PATH, FLEET_INDEX_PATH, PREPROCESSED_CACHE_PATH
+    CACHE_PATH = cache_path
+    CHECKPOINT_PATH = os.path.join(cache_path, 'checkpoints/')
+    HISTORICAL_MANIFEST_PATH = os.path.join(cache_path, 'manifest_historico.json')
+    ROUTES_PATH = os.path.join(cache_path, 'rotas/')
+    PROFILES_PATH = os.path.join(cache_path, 'perfis/')
+    FLEET_INDEX_PATH = os.path.join(cache_path, 'frota/')
+    PREPROCESSED_CACHE_PATH = os.path.join(cache_path, 'horas/')
+    ROUTE_CACHE.clear()
+    PROFILE_CACHE.clear()
+    FLEET_INDEX_CACHE.clear()
+
+
+# Tamanho dos blocos lidos de cada arquivo bruto na ingestão em streaming
+RAW_FILE_READ_CHUNK_SIZE = 1 << 20
+
+# Janela de horas (UTC) mantida na ingestão: [8h, 23h)
+RAW_FILE_HOUR_START = 8
+RAW_FILE_HOUR_END = 23
+
+# Compressão das trajetórias na ingestão (compressao.py): duplicatas exatas, pings parados e Douglas-Peucker
+# temporal com tolerância em metros. Desligada por padrão (--compress liga); as horas comprimidas vão para
+# o cache em disco com a configuração na assinatura.
+TRAJECTORY_COMPRESSION = False
+COMPRESSION_TOLERANCE_M = compressao.COMPRESSION_TOLERANCE_M
+COMPRESSION_STATIONARY_RADIUS_M = compressao.COMPRESSION_STATIONARY_RADIUS_M
+COMPRESSION_STATS = compressao.new_compression_stats()
+COMPRESSION_STATS_LOCK = threading.Lock()
+
+_JSON_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+_JSON_RECORD_SEPARATOR_RE = re.compile(r'[ \t\n\r]*,[ \t\n\r]*')
+
+
+def iter_json_array_records(file_path, chunk_size=RAW_FILE_READ_CHUNK_SIZE):
     """
-    Carrega um único arquivo JSON de dados brutos, limpa e padroniza os dados.
-    Aplica filtro inicial por linhas de interesse e horário para reduzir volume.
+    Itera os objetos de um arquivo JSON cujo conteúdo é uma lista de objetos, lendo o arquivo em blocos.
+    Cada objeto é decodificado com o scanner em C do módulo json (raw_decode), sem carregar o arquivo inteiro.
+    Lista malformada ou truncada levanta json.JSONDecodeError; conteúdo que não é lista, ValueError.
     """
+    decoder = json.JSONDecoder()
+    with open(file_path, 'r', encoding='utf-8') as f:
+        buffer, pos, at_eof = '', 0, False
+
+        def read_more():
+            nonlocal buffer, pos, at_eof
+            chunk = f.read(chunk_size)
+            at_eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+
+        def next_char():
+            """Pula espaços, lendo mais blocos se preciso; devolve o próximo caractere ('' no fim do arquivo)."""
+            nonlocal pos
+            while True:
+                pos = _JSON_WHITESPACE_RE.match(buffer, pos).end()
+                if pos < len(buffer) or at_eof:
+                    return buffer[pos:pos + 1]
+                read_more()
+
+        if next_char() != '[':
+            raise ValueError("o arquivo não contém uma lista JSON")
+        pos += 1
+        if next_char() == ']':
+            return
+
+        while True:
+            try:
+                record, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Objeto cortado no fim do bloco: lê o próximo e tenta de novo
+                if at_eof:
+                    raise
+                read_more()
+                continue
+            yield record
+
+            # Caso comum: vírgula e o início do próximo objeto no mesmo bloco
+            separator = _JSON_RECORD_SEPARATOR_RE.match(buffer, pos)
+            if separator and separator.end() < len(buffer):
+                pos = separator.end()
+                continue
+            char = next_char()
+            if char == ']':
+                return
+            if char != ',':
+                raise json.JSONDecodeError("esperado ',' ou ']'" if char else "lista JSON incompleta", buffer, pos)
+            pos += 1
+            next_char()
+
+
+def _parse_timestamp_ms(value):
+    """Converte datahora/datahoraservidor (texto ou número) em milissegundos; None se inválido."""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        df = pd.DataFrame(data)
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        return int(value) if math.isfinite(value) else None
 
-        initial_len = len(df) 
-        
-        df = df[df['linha'].isin(LINHAS_INTERESSE)].copy() 
-        if len(df) < initial_len:
-            # print(f"  INFO_LOAD_FILTER: Descartados {initial_len - len(df)} registros de linhas não-interesse em {os.path.basename(file_path)}.")
-            pass 
 
-        if df.empty:
-            return pd.DataFrame()
+def _parse_coordinate(value):
+    """Converte latitude/longitude no formato '-22,91234' em float; None se inválido."""
+    try:
+        value = float(str(value).replace(',', '.'))
+    except ValueError:
+        return None
+    return None if math.isnan(value) else value
 
-        required_cols = ['ordem', 'latitude', 'longitude', 'datahoraservidor', 'linha', 'datahora', 'velocidade']
-        for col in required_cols:
-            if col not in df.columns:
-                df[col] = pd.NA
 
-        df['latitude'] = df['latitude'].astype(str).str.replace(',', '.', regex=False).astype(float)
-        df['longitude'] = df['longitude'].astype(str).str.replace(',', '.', regex=False).astype(float)
-        df['velocidade'] = pd.to_numeric(df['velocidade'], errors='coerce').fillna(0)
-        
-        df['timestamp_ms'] = pd.to_numeric(df['datahoraservidor'], errors='coerce')
-        df['timestamp_ms'] = df['timestamp_ms'].fillna(pd.to_numeric(df['datahora'], errors='coerce'))
-        
-        df = df.dropna(subset=['timestamp_ms', 'latitude', 'longitude'])
-        
-        df['datahoraservidor_dt'] = pd.to_datetime(df['timestamp_ms'], unit='ms', utc=True)
+def _parse_speed(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return 0.0 if math.isnan(value) else value
+
+
+def encode_coordinates(degrees):
+    """Graus (float) -> ponto fixo int32. Para coordenadas com até 7 casas decimais a conversão é exata."""
+    return np.rint(np.asarray(degrees, dtype=np.float64) * COORDINATE_SCALE).astype(np.int32)
 
-        len_after_line_filter = len(df)
-        df = df[(df['datahoraservidor_dt'].dt.hour >= 8) & (df['datahoraservidor_dt'].dt.hour < 23)]
-        if len(df) < len_after_line_filter:
-            pass 
-        
-        if not df.empty:
-            print(f"  INFO_LOADED_FILE: Arquivo {os.path.basename(file_path)} carregado e pré-filtrado: {len(df)} registros válidos.")
 
+def decode_coordinates(fixed_point):
+    """Ponto fixo int32 -> graus (float64), igual ao float do texto original."""
+    return np.asarray(fixed_point, dtype=np.float64) / COORDINATE_SCALE
+
+
+def encode_speeds(speeds):
+    """Velocidade em km/h arredondada para uint8 (0 a 255)."""
+    return np.clip(np.rint(np.asarray(speeds, dtype=np.float64)), 0, 255).astype(np.uint8)
+
+
+def load_and_preprocess_single_raw_file(file_path):
+    """
+    Carrega um único arquivo JSON de dados brutos, limpa e padroniza os dados.
+    O arquivo é lido em streaming: registros de linhas fora de LINHAS_INTERESSE, sem timestamp/coordenadas
+    válidos ou fora da janela de horário são descartados durante a leitura, e apenas as colunas finais
+    tipadas são construídas.
+    """
+    try:
+        with instrumentacao.stage('carga_json_bruto') as stage:
+            df = _load_and_filter_raw_records(file_path)
+            stage['itens'] = len(df)
+        if LOG_EACH_FILE:
+            print(f"  INFO_LOADED_FILE: Arquivo {os.path.basename(file_path)} carregado e pré-filtrado: {len(df)} registros válidos.")
         return df
 
     except Exception as e:
         print(f"ERRO_LOAD_RAW_FILE: Erro ao processar o arquivo {file_path}: {e}") 
         return pd.DataFrame()
 
+
+def _load_and_filter_raw_records(file_path):
+    linhas_interesse = set(LINHAS_INTERESSE)
+    ordens, linhas = [], []
+    latitudes, longitudes, velocidades = array('d'), array('d'), array('d')
+    timestamps = array('q')
+
+    scanned = 0
+    for record in iter_json_array_records(file_path):
+        scanned += 1
+        linha = record.get('linha')
+        if linha not in linhas_interesse:
+            continue
+
+        timestamp_ms = _parse_timestamp_ms(record.get('datahoraservidor'))
+        if timestamp_ms is None:
+            timestamp_ms = _parse_timestamp_ms(record.get('datahora'))
+        if timestamp_ms is None:
+            continue
+        hour = (timestamp_ms // 3_600_000) % 24
+        if hour < RAW_FILE_HOUR_START or hour >= RAW_FILE_HOUR_END:
+            continue
+
+        latitude = _parse_coordinate(record.get('latitude'))
+        longitude = _parse_coordinate(record.get('longitude'))
+        if latitude is None or longitude is None:
+            continue
+
+        ordens.append(str(record.get('ordem')))
+        linhas.append(linha)
+        latitudes.append(latitude)
+        longitudes.append(longitude)
+        velocidades.append(_parse_speed(record.get('velocidade')))
+        timestamps.append(timestamp_ms)
+
+    instrumentacao.count('registros_brutos_lidos', scanned)
+    instrumentacao.count('registros_brutos_validos', len(timestamps))
+    if not timestamps:
+        return pd.DataFrame()
+
+    df = pd.DataFrame({
+        'ordem': pd.Categorical(ordens),
+        'linha': pd.Categorical(linhas),
+        'latitude_e7': encode_coordinates(np.frombuffer(latitudes, dtype=np.float64)),
+        'longitude_e7': encode_coordinates(np.frombuffer(longitudes, dtype=np.float64)),
+        'velocidade': encode_speeds(np.frombuffer(velocidades, dtype=np.float64)),
+        'timestamp_ms': np.frombuffer(timestamps, dtype=np.int64),
+    })
+    return df
+
+
+def _linhas_interesse_fingerprint():
+    """Identificador estável do conjunto LINHAS_INTERESSE (usado para invalidar o cache em disco)."""
+    return hashlib.sha1(",".join(sorted(LINHAS_INTERESSE)).encode('utf-8')).hexdigest()
+
+
+def _preprocessed_cache_dir_for(file_path):
+    """Pasta do cache colunar de um arquivo bruto: <YYYY-MM-DD_HH>__<hash do caminho>."""
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    path_hash = hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(PREPROCESSED_CACHE_PATH, f"{base_name}__{path_hash}")
+
+
+def _source_file_signature(file_path):
+    stat = os.stat(file_path)
+    return {
+        'versao': PREPROCESSED_CACHE_VERSION,
+        'arquivo_origem': os.path.abspath(file_path),
+        'mtime_ns': stat.st_mtime_ns,
+        'tamanho': stat.st_size,
+        'linhas_interesse': _linhas_interesse_fingerprint(),
+        'compressao': [COMPRESSION_TOLERANCE_M, COMPRESSION_STATIONARY_RADIUS_M] if TRAJECTORY_COMPRESSION else None,
+    }
+
+
+def _to_compact_layout(df):
+    """Garante o layout compacto (PREPROCESSED_COLUMNS com os tipos fixos) em um DataFrame pré-processado."""
+    if df.empty:
+        return pd.DataFrame()
+    df = df[PREPROCESSED_COLUMNS]
+    return pd.DataFrame({
+        'ordem': df['ordem'].astype('category'),
+        'linha': df['linha'].astype('category'),
+        'latitude_e7': df['latitude_e7'].to_numpy(dtype=np.int32),
+        'longitude_e7': df['longitude_e7'].to_numpy(dtype=np.int32),
+        'velocidade': df['velocidade'].to_numpy(dtype=np.uint8),
+        'timestamp_ms': df['timestamp_ms'].to_numpy(dtype=np.int64),
+    })
+
+
+def hour_memory_usage(df):
+    """Bytes ocupados por uma hora carregada (incluindo os dicionários das colunas categóricas)."""
+    return int(df.memory_usage(deep=True).sum()) if not df.empty else 0
+
+
+def _read_preprocessed_cache(cache_dir, signature):
+    """
+    Lê uma hora do cache em disco se a assinatura bater; retorna (DataFrame, meta) ou (None, None) se
+    ausente ou inválida.
+    """
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return None, None
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if any(meta.get(k) != v for k, v in signature.items()):
+        return None, None
+    if meta.get('registros', 0) == 0:
+        return pd.DataFrame(), meta
+
+    def load_column(name):
+        return np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode='r')
+
+    columns = {}
+    for col in PREPROCESSED_COLUMNS:
+        if col in CATEGORICAL_COLUMNS:
+            columns[col] = pd.Categorical.from_codes(load_column(f"{col}_codigos"), categories=load_column(f"{col}_categorias"))
+        else:
+            columns[col] = load_column(col)
+    return pd.DataFrame(columns, copy=False), meta
+
+
+def _write_preprocessed_cache(cache_dir, signature, df, compression_stats=None):
+    """
+    Grava uma hora pré-processada de forma atômica (pasta temporária + rename). A pasta temporária é única por
+    chamada, pois processos de --workers podem gravar a mesma hora ao mesmo tempo; se outro processo já tiver
+    colocado a pasta final no lugar entre a remoção e o rename, a versão dele fica.
+    """
+    parent_dir = os.path.dirname(cache_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(cache_dir) + '.', suffix='.tmp', dir=parent_dir)
+    try:
+        for col in PREPROCESSED_COLUMNS if not df.empty else []:
+            if col in CATEGORICAL_COLUMNS:
+                # Categorias em largura fixa ('<U..') para permitir memory-map
+                np.save(os.path.join(tmp_dir, f"{col}_codigos.npy"), df[col].cat.codes.to_numpy(), allow_pickle=False)
+                np.save(os.path.join(tmp_dir, f"{col}_categorias.npy"), df[col].cat.categories.to_numpy().astype(str), allow_pickle=False)
+            else:
+                np.save(os.path.join(tmp_dir, f"{col}.npy"), df[col].to_numpy(), allow_pickle=False)
+
+        meta = dict(signature, registros=int(len(df)))
+        if compression_stats is not None:
+            meta['compressao_estatisticas'] = compression_stats
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        try:
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def record_compression_stats(stats):
+    """Soma as estatísticas de compressão de uma hora ao total da execução (e aos contadores de --profile)."""
+    # As threads do HourPrefetcher também chamam esta função
+    with COMPRESSION_STATS_LOCK:
+        for name, value in stats.items():
+            COMPRESSION_STATS[name] += value
+    for name, value in stats.items():
+        instrumentacao.count(f'compressao_{name}', value)
+
+
+def _preprocess_hour(file_path):
+    """
+    load_and_preprocess_single_raw_file no layout compacto e, com TRAJECTORY_COMPRESSION, comprimido.
+    Retorna (DataFrame, estatísticas da compressão ou None).
+    """
+    df = _to_compact_layout(load_and_preprocess_single_raw_file(file_path))
+    if not TRAJECTORY_COMPRESSION or df.empty:
+        return df, None
+
+    with instrumentacao.stage('compressao_trajetorias', len(df)):
+        df, stats = compressao.compress_hour_dataframe(df, COMPRESSION_TOLERANCE_M, COMPRESSION_STATIONARY_RADIUS_M)
+    record_compression_stats(stats)
+    if LOG_EACH_FILE:
+        print(f"  INFO_COMPRESSION: Arquivo {os.path.basename(file_path)}: {compressao.format_compression_stats(stats)}.")
+    return df, stats
+
+
+def load_preprocessed_raw_file(file_path):
+    """
+    Versão com cache de load_and_preprocess_single_raw_file.
+    Na primeira vez o JSON bruto é processado e gravado em PREPROCESSED_CACHE_PATH como colunas tipadas;
+    nas execuções seguintes as colunas são lidas via memory-map, sem reprocessar o JSON.
+    """
+    if not USE_PREPROCESSED_CACHE:
+        df, _ = _preprocess_hour(file_path)
+        return df
+
+    cache_dir = _preprocessed_cache_dir_for(file_path)
+    try:
+        signature = _source_file_signature(file_path)
+        with instrumentacao.stage('leitura_cache_horas_disco') as stage:
+            cached_df, meta = _read_preprocessed_cache(cache_dir, signature)
+            stage['itens'] = len(cached_df) if cached_df is not None else 0
+        if cached_df is not None:
+            instrumentacao.count('cache_horas_disco_acertos')
+            if meta.get('compressao_estatisticas'):
+                record_compression_stats(meta['compressao_estatisticas'])
+            return cached_df
+        instrumentacao.count('cache_horas_disco_faltas')
+    except Exception as e:
+        print(f"AVISO_CACHE_HORAS: Cache inválido para {os.path.basename(file_path)}, reprocessando. Erro: {e}")
+        signature = None
+
+    with instrumentacao.stage('preprocessamento_hora') as stage:
+        df, compression_stats = _preprocess_hour(file_path)
+        stage['itens'] = len(df)
+
+    if signature is not None:
+        try:
+            _write_preprocessed_cache(cache_dir, signature, df, compression_stats)
+        except Exception as e:
+            print(f"AVISO_CACHE_HORAS: Não foi possível gravar o cache de {os.path.basename(file_path)}: {e}")
+    return df
+
+
 def load_test_queries_file(file_path):
     """Carrega as queries do arquivo de teste (treino-YYYY-MM-DD_HH.json)."""
     try:
@@ -97,63 +557,377 @@ def load_test_queries_file(file_path):
         print(f"ERRO_LOAD_QUERY: Erro ao carregar queries de teste de {file_path}: {e}")
         return []
 
-def build_historical_file_path_cache(base_historical_path):
+def _parse_day_folder_date(day_folder):
+    """Data (UTC) de uma pasta de dia 'YYYY-MM-DD'; None se o nome não estiver nesse formato."""
+    try:
+        return datetime.strptime(day_folder, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def _parse_hour_file_key(filename):
+    """Chave (ano, mês, dia, hora) de um arquivo 'YYYY-MM-DD_HH.json'; None se o nome não estiver nesse formato."""
+    if not filename.endswith('.json'):
+        return None
+    name_parts = os.path.splitext(filename)[0].split('_')
+    if len(name_parts) != 2:
+        return None
+    try:
+        file_dt = datetime.strptime(f"{name_parts[0]}_{name_parts[1]}", "%Y-%m-%d_%H")
+    except ValueError:
+        return None
+    return (file_dt.year, file_dt.month, file_dt.day, file_dt.hour)
+
+
+def _scan_day_folder(day_path, previous_files):
+    """
+    Escaneia uma pasta de dia com os.scandir e retorna {nome do arquivo: entrada do manifesto}.
+    Estatísticas já conhecidas (registros, timestamps) são mantidas se o arquivo não mudou.
+    """
+    files = {}
+    with os.scandir(day_path) as entries:
+        for entry in entries:
+            key = _parse_hour_file_key(entry.name)
+            if key is None or not entry.is_file():
+                continue
+            stat = entry.stat()
+            file_entry = {'chave': list(key), 'tamanho': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            previous = previous_files.get(entry.name)
+            if previous and previous.get('tamanho') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns:
+                for stat_name in ('registros', 'ts_min', 'ts_max'):
+                    if stat_name in previous:
+                        file_entry[stat_name] = previous[stat_name]
+            files[entry.name] = file_entry
+    return files
+
+
+def load_historical_manifest(base_historical_path):
+    """Lê o manifesto persistido; retorna um manifesto vazio se não existir, for de outra versão ou de outra pasta."""
+    empty_manifest = {'versao': HISTORICAL_MANIFEST_VERSION, 'base': os.path.abspath(base_historical_path), 'pastas': {}}
+    if not USE_HISTORICAL_MANIFEST:
+        return empty_manifest
+    try:
+        with open(HISTORICAL_MANIFEST_PATH, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return empty_manifest
+    if manifest.get('versao') != HISTORICAL_MANIFEST_VERSION or manifest.get('base') != empty_manifest['base']:
+        return empty_manifest
+    return manifest
+
+
+def save_historical_manifest():
+    """Grava o manifesto (de forma atômica) com as estatísticas acumuladas até agora."""
+    if not USE_HISTORICAL_MANIFEST or not HISTORICAL_FILE_MANIFEST:
+        return
+    try:
+        os.makedirs(os.path.dirname(HISTORICAL_MANIFEST_PATH) or '.', exist_ok=True)
+        with open(HISTORICAL_MANIFEST_PATH + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(HISTORICAL_FILE_MANIFEST, f, ensure_ascii=False)
+        os.replace(HISTORICAL_MANIFEST_PATH + '.tmp', HISTORICAL_MANIFEST_PATH)
+    except OSError as e:
+        print(f"AVISO_MANIFESTO: Não foi possível gravar o manifesto histórico: {e}")
+
+
+def update_historical_manifest_stats(file_path, df):
+    """Registra no manifesto (em memória) os registros válidos e o intervalo de timestamps de um arquivo carregado."""
+    day_folder = os.path.basename(os.path.dirname(file_path))
+    file_entry = HISTORICAL_FILE_MANIFEST.get('pastas', {}).get(day_folder, {}).get('arquivos', {}).get(os.path.basename(file_path))
+    if file_entry is None:
+        return
+    file_entry['registros'] = int(len(df))
+    if not df.empty:
+        file_entry['ts_min'] = int(df['timestamp_ms'].min())
+        file_entry['ts_max'] = int(df['timestamp_ms'].max())
+
+
+@timed('cache_de_caminhos')
+def build_historical_file_path_cache(base_historical_path, quiet=False):
     """
     Escaneia a pasta de dados históricos (com subpastas de dias) UMA ÚNICA VEZ
     e cria um cache (ano, mês, dia, hora) -> lista de caminhos de arquivo.
+    Usa o manifesto persistido: só as pastas de dia novas ou com mtime alterado são reescaneadas
+    (com os.scandir, em paralelo); as demais vêm do manifesto.
+    quiet: omite as mensagens informativas (os erros continuam sendo impressos).
     """
-    print(f"Construindo cache de caminhos de arquivos históricos em: {base_historical_path}...")
-    file_count = 0
-    latest_historical_date = None 
+    global HISTORICAL_FILE_MANIFEST
+    if not quiet:
+        print(f"Construindo cache de caminhos de arquivos históricos em: {base_historical_path}...")
     if not os.path.isdir(base_historical_path):
         print(f"ERRO: A pasta histórica '{base_historical_path}' não existe ou não é um diretório. Verifique o caminho.")
         return
 
-    for day_folder in os.listdir(base_historical_path):
-        day_path = os.path.join(base_historical_path, day_folder)
-        if os.path.isdir(day_path):
-            try: 
-                current_day_dt = datetime.strptime(day_folder, "%Y-%m-%d").replace(tzinfo=timezone.utc)
-                if latest_historical_date is None or current_day_dt > latest_historical_date:
-                    latest_historical_date = current_day_dt
-            except ValueError:
+    manifest = load_historical_manifest(base_historical_path)
+    previous_folders = manifest['pastas']
+    current_folders = {}
+    folders_to_scan = []
+
+    with os.scandir(base_historical_path) as entries:
+        for entry in entries:
+            if not entry.is_dir() or _parse_day_folder_date(entry.name) is None:
                 continue
+            folder_mtime_ns = entry.stat().st_mtime_ns
+            previous = previous_folders.get(entry.name)
+            if previous is not None and previous.get('mtime_ns') == folder_mtime_ns:
+                current_folders[entry.name] = previous
+            else:
+                folders_to_scan.append((entry.name, entry.path, folder_mtime_ns, (previous or {}).get('arquivos', {})))
+
+    if folders_to_scan:
+        with ThreadPoolExecutor(max_workers=max(1, min(HISTORICAL_SCAN_WORKERS, len(folders_to_scan)))) as executor:
+            scanned = executor.map(lambda folder: _scan_day_folder(folder[1], folder[3]), folders_to_scan)
+            for (day_folder, _, folder_mtime_ns, _), files in zip(folders_to_scan, scanned):
+                current_folders[day_folder] = {'mtime_ns': folder_mtime_ns, 'arquivos': files}
+
+    manifest['pastas'] = current_folders
+    HISTORICAL_FILE_MANIFEST = manifest
+    if folders_to_scan or set(previous_folders) != set(current_folders):
+        save_historical_manifest()
+
+    file_count = 0
+    latest_historical_date = None
+    for day_folder in sorted(current_folders):
+        current_day_dt = _parse_day_folder_date(day_folder)
+        if latest_historical_date is None or current_day_dt > latest_historical_date:
+            latest_historical_date = current_day_dt
+
+        for filename in sorted(current_folders[day_folder]['arquivos']):
+            file_entry = current_folders[day_folder]['arquivos'][filename]
+            key = tuple(file_entry['chave'])
+            if key not in HISTORICAL_RAW_FILE_PATH_CACHE:
+                HISTORICAL_RAW_FILE_PATH_CACHE[key] = []
+            HISTORICAL_RAW_FILE_PATH_CACHE[key].append(os.path.join(base_historical_path, day_folder, filename))
+            file_count += 1
+    if not quiet:
+        print(f"Cache de caminhos de arquivos históricos construído. {len(HISTORICAL_RAW_FILE_PATH_CACHE)} horas de dados mapeadas de {file_count} arquivos "
+              f"({len(folders_to_scan)} de {len(current_folders)} pastas de dia reescaneadas).")
+    return latest_historical_date
+
+
+def get_hour_dataframe(file_path):
+    """
+    Retorna o DataFrame pré-processado de um arquivo horário, passando pelo cache LRU em memória.
+    Em caso de falta, carrega com load_preprocessed_raw_file e descarta as horas menos usadas recentemente
+    até respeitar HOUR_CACHE_MAX_ENTRIES / HOUR_CACHE_MAX_BYTES.
+    """
+    if file_path in HOUR_DATA_LRU_CACHE:
+        HOUR_DATA_LRU_CACHE.move_to_end(file_path)
+        HOUR_CACHE_STATS['hits'] += 1
+        instrumentacao.count('cache_horas_memoria_acertos')
+        return HOUR_DATA_LRU_CACHE[file_path][0]
+
+    HOUR_CACHE_STATS['misses'] += 1
+    instrumentacao.count('cache_horas_memoria_faltas')
+    prefetcher = HOUR_PREFETCHER
+    try:
+        df = prefetcher.take(file_path) if prefetcher is not None else None
+        if df is None:
+            df = load_preprocessed_raw_file(file_path)
+        update_historical_manifest_stats(file_path, df)
+        nbytes = hour_memory_usage(df)
+        if not df.empty and LOG_EACH_FILE:
+            print(f"  INFO_MEMORY: {os.path.basename(file_path)}: {len(df)} registros em {nbytes / 1024:.1f} KB ({nbytes / len(df):.1f} bytes/registro).")
+        HOUR_DATA_LRU_CACHE[file_path] = (df, nbytes)
+        HOUR_CACHE_STATS['bytes'] += nbytes
+    finally:
+        # Hora guardada no cache LRU (ou carga com erro): fim da reserva na produtora
+        if prefetcher is not None:
+            prefetcher.release(file_path)
+
+    while len(HOUR_DATA_LRU_CACHE) > 1 and (
+        len(HOUR_DATA_LRU_CACHE) > HOUR_CACHE_MAX_ENTRIES
+        or (HOUR_CACHE_MAX_BYTES is not None and HOUR_CACHE_STATS['bytes'] > HOUR_CACHE_MAX_BYTES)
+    ):
+        _, (_, evicted_bytes) = HOUR_DATA_LRU_CACHE.popitem(last=False)
+        HOUR_CACHE_STATS['bytes'] -= evicted_bytes
+        HOUR_CACHE_STATS['evictions'] += 1
+    return df
+
+
+class HourPrefetcher:
+    """
+    Pré-processa arquivos horários em threads (load_preprocessed_raw_file) antes de serem pedidos.
+    Uma thread produtora submete os arquivos um a um e só avança quando há vaga: no máximo max_pending
+    horas carregadas e ainda não consumidas (contrapressão). O consumo é feito por get_hour_dataframe, na
+    thread principal, que é a única a mexer no cache LRU; enquanto ela carrega um arquivo (por conta própria ou
+    esperando o prefetch), ele fica reservado e a produtora o pula, assim como os que já estão no cache LRU.
+    Cada chamada de prefetch é um lote; discard libera as vagas do que o lote carregou e ninguém consumiu
+    (ex.: um dia pulado por checkpoint).
+    """
 
-            for filename in os.listdir(day_path):
-                if filename.endswith('.json'):
-                    file_path = os.path.join(day_path, filename)
-                    try:
-                        name_parts = os.path.splitext(filename)[0].split('_')
-                        if len(name_parts) == 2:
-                            date_part = name_parts[0]
-                            hour_part = name_parts[1]
-                            
-                            file_dt = datetime.strptime(f"{date_part}_{hour_part}", "%Y-%m-%d_%H").replace(tzinfo=timezone.utc)
-                            key = (file_dt.year, file_dt.month, file_dt.day, file_dt.hour)
-                            
-                            if key not in HISTORICAL_RAW_FILE_PATH_CACHE:
-                                HISTORICAL_RAW_FILE_PATH_CACHE[key] = []
-                            HISTORICAL_RAW_FILE_PATH_CACHE[key].append(file_path)
-                            file_count += 1
-                    except ValueError:
-                        pass 
-                    except Exception as e:
-                        pass 
-    print(f"Cache de caminhos de arquivos históricos construído. {len(HISTORICAL_RAW_FILE_PATH_CACHE)} horas de dados mapeadas de {file_count} arquivos.")
-    return latest_historical_date 
+    def __init__(self, workers=PREFETCH_WORKERS, max_pending=PREFETCH_MAX_HOURS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self.slots = threading.Semaphore(max_pending)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.claimed = set()
+        self.closed = False
+        self.producers = []
+        self.batches = []
+
+    def prefetch(self, file_paths):
+        """
+        Agenda (sem bloquear a chamadora) o pré-processamento dos arquivos ainda fora do cache LRU.
+        Retorna o lote agendado, para discard.
+        """
+        batch = {'arquivos': [path for path in file_paths if path not in HOUR_DATA_LRU_CACHE], 'descartado': False}
+        with self.lock:
+            self.batches.append(batch)
+        producer = threading.Thread(target=self._submit_all, args=(batch,), daemon=True)
+        self.producers.append(producer)
+        producer.start()
+        return batch
+
+    def _submit_all(self, batch):
+        for file_path in batch['arquivos']:
+            self.slots.acquire()
+            with self.lock:
+                if (self.closed or batch['descartado'] or file_path in self.pending or file_path in self.claimed
+                        or file_path in HOUR_DATA_LRU_CACHE):
+                    self.slots.release()
+                    if self.closed or batch['descartado']:
+                        return
+                    continue
+                self.pending[file_path] = self.executor.submit(load_preprocessed_raw_file, file_path)
+
+    def discard(self, batch):
+        """
+        Encerra um lote: a produtora para de agendá-lo e as horas dele carregadas e não consumidas liberam as
+        vagas, exceto as que outro lote ainda ativo também pediu.
+        """
+        with self.lock:
+            batch['descartado'] = True
+            self.batches = [other for other in self.batches if other is not batch]
+            wanted = {path for other in self.batches for path in other['arquivos']}
+            futures = [self.pending.pop(path) for path in batch['arquivos'] if path in self.pending and path not in wanted]
+        for future in futures:
+            future.cancel()
+            self.slots.release()
+        instrumentacao.count('prefetch_descartados', len(futures))
+
+    def take(self, file_path):
+        """
+        DataFrame pré-carregado do arquivo (esperando terminar, se preciso); None se não foi agendado.
+        O arquivo fica reservado até release, chamado por get_hour_dataframe depois de guardá-lo no cache LRU.
+        """
+        with self.lock:
+            self.claimed.add(file_path)
+            future = self.pending.pop(file_path, None)
+            if future is None:
+                return None
+        try:
+            with instrumentacao.stage('espera_prefetch'):
+                df = future.result()
+            instrumentacao.count('prefetch_aproveitados')
+            return df
+        finally:
+            self.slots.release()
+
+    def release(self, file_path):
+        """Encerra a reserva feita por take."""
+        with self.lock:
+            self.claimed.discard(file_path)
+
+    def close(self):
+        """Descarta o que não foi consumido e encerra as threads."""
+        with self.lock:
+            self.closed = True
+            futures = list(self.pending.values())
+            self.pending.clear()
+        for future in futures:
+            future.cancel()
+            self.slots.release()
+        instrumentacao.count('prefetch_descartados', len(futures))
+        for producer in self.producers:
+            producer.join()
+        self.executor.shutdown(wait=True)
+
+
+@timed('indice_trajetorias')
+def build_trajectory_index(hour_dfs):
+    """
+    Agrupa os registros de várias horas por (ordem, linha) em arrays NumPy contíguos e ordenados por tempo.
+    Todos os ônibus compartilham os mesmos arrays globais; cada entrada do índice guarda apenas fatias (views).
+    """
+    frames = [df for df in hour_dfs if not df.empty]
+    if not frames:
+        return {}
+
+    full_df = pd.concat(frames, ignore_index=True)
+    full_df = full_df[full_df['linha'].isin(LINHAS_INTERESSE)]
+    if full_df.empty:
+        return {}
+
+    ordem_codes, ordem_values = pd.factorize(full_df['ordem'])
+    linha_codes, linha_values = pd.factorize(full_df['linha'])
+    timestamps = full_df['timestamp_ms'].to_numpy(dtype=np.int64)
+
+    # Ordena por ônibus e, dentro de cada ônibus, por tempo (lexsort é estável)
+    order = np.lexsort((timestamps, linha_codes, ordem_codes))
+    columns = {
+        'timestamp_ms': np.ascontiguousarray(timestamps[order]),
+        'latitude': decode_coordinates(full_df['latitude_e7'].to_numpy()[order]),
+        'longitude': decode_coordinates(full_df['longitude_e7'].to_numpy()[order]),
+        'velocidade': np.ascontiguousarray(full_df['velocidade'].to_numpy(dtype=np.float64)[order]),
+    }
 
+    sorted_ordem = ordem_codes[order]
+    sorted_linha = linha_codes[order]
+    group_starts = np.flatnonzero(np.r_[True, (sorted_ordem[1:] != sorted_ordem[:-1]) | (sorted_linha[1:] != sorted_linha[:-1])])
+    group_ends = np.r_[group_starts[1:], len(order)]
 
-# Cache de DataFrames carregados para a janela de um dia de teste específico
-CURRENT_TEST_DAY_DATA_CACHE = {} 
+    index = {}
+    for start, end in zip(group_starts, group_ends):
+        key = (ordem_values[sorted_ordem[start]], linha_values[sorted_linha[start]])
+        index[key] = {col: values[start:end] for col, values in columns.items()}
+    return index
 
-def load_historical_data_for_test_day_window(test_day_datetime_ref, hours_before=12): # Aumentado para 12 horas para garantir
+
+def _datetime_to_ms(dt, round_up=False):
+    """Converte um datetime com fuso para milissegundos desde a época (arredondando para baixo ou para cima)."""
+    delta = dt - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    if round_up:
+        return -((-delta) // timedelta(milliseconds=1))
+    return delta // timedelta(milliseconds=1)
+
+
+def slice_trajectory(trajectory, start_ms, end_ms):
+    """Fatia uma trajetória no intervalo fechado [start_ms, end_ms] com duas buscas binárias (sem cópias)."""
+    timestamps = trajectory['timestamp_ms']
+    lo = np.searchsorted(timestamps, start_ms, side='left')
+    hi = np.searchsorted(timestamps, end_ms, side='right')
+    return {col: values[lo:hi] for col, values in trajectory.items()}
+
+
+def historical_files_for_day_window(test_day_datetime_ref, hours_before):
+    """Caminhos (ordenados, sem repetição) dos arquivos horários da janela [dia - hours_before, fim do dia]."""
+    files_for_window = []
+    current_dt_iterator = test_day_datetime_ref.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(hours=hours_before)
+    end_hour = test_day_datetime_ref.replace(hour=23, minute=0, second=0, microsecond=0)
+    while current_dt_iterator <= end_hour:
+        key = (current_dt_iterator.year, current_dt_iterator.month, current_dt_iterator.day, current_dt_iterator.hour)
+        if key in HISTORICAL_RAW_FILE_PATH_CACHE:
+            files_for_window.extend(HISTORICAL_RAW_FILE_PATH_CACHE[key])
+        current_dt_iterator += timedelta(hours=1)
+    return sorted(set(files_for_window))
+
+
+@timed('carga_janela_dia')
+def load_historical_data_for_test_day_window(test_day_datetime_ref, hours_before=None):
     """
     Carrega TODOS os DataFrames de dados brutos (normais) relevantes para a janela de um DIA de teste.
     Popula o CURRENT_TEST_DAY_DATA_CACHE para evitar recarregar arquivos grandes repetidamente.
-    A janela de carregamento é maior para garantir que haja dados para todas as queries do dia de teste.
+    As horas vêm do cache LRU (HOUR_DATA_LRU_CACHE), então as que já foram carregadas no dia anterior são reaproveitadas.
+    A janela começa hours_before horas (padrão: QUERY_HOURS_BEFORE) antes da meia-noite do dia, para que as
+    primeiras queries do dia também tenham histórico.
     """
-    global CURRENT_TEST_DAY_DATA_CACHE
+    global CURRENT_TEST_DAY_DATA_CACHE, CURRENT_TEST_DAY_TRAJECTORY_INDEX, CURRENT_TEST_DAY_WINDOW
+    if hours_before is None:
+        hours_before = QUERY_HOURS_BEFORE
     CURRENT_TEST_DAY_DATA_CACHE = {} 
+    CURRENT_TEST_DAY_TRAJECTORY_INDEX = {}
+    CURRENT_TEST_DAY_WINDOW = None
+    TRAJECTORY_APPEND_BUFFERS.clear()
 
     # A janela de tempo para carregamento abrange o dia inteiro do teste e algumas horas antes
     start_window_for_load = test_day_datetime_ref.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(hours=hours_before)
@@ -163,118 +937,406 @@ def load_historical_data_for_test_day_window(test_day_datetime_ref, hours_before
 
     print(f"  INFO_DAY_LOAD: Pré-carregando dados brutos para a janela do dia de teste: {start_window_for_load.strftime('%Y-%m-%d %H:%M:%S UTC')} a {end_window_for_load.strftime('%Y-%m-%d %H:%M:%S UTC')}")
 
-    files_to_load_paths_for_window = []
-    current_dt_iterator = start_window_for_load.replace(minute=0, second=0, microsecond=0)
-    
-    while current_dt_iterator <= end_window_for_load.replace(minute=0, second=0, microsecond=0): 
-        key = (current_dt_iterator.year, current_dt_iterator.month, current_dt_iterator.day, current_dt_iterator.hour)
-        if key in HISTORICAL_RAW_FILE_PATH_CACHE:
-            files_to_load_paths_for_window.extend(HISTORICAL_RAW_FILE_PATH_CACHE[key])
-        current_dt_iterator += timedelta(hours=1) 
-    
-    unique_files_to_load = sorted(list(set(files_to_load_paths_for_window)))
+    unique_files_to_load = historical_files_for_day_window(test_day_datetime_ref, hours_before)
     print(f"  INFO_DAY_LOAD: Total de {len(unique_files_to_load)} arquivos brutos identificados para pré-carregamento.")
 
     for file_path in unique_files_to_load:
-        df = load_and_preprocess_single_raw_file(file_path)
+        df = get_hour_dataframe(file_path)
         if not df.empty:
             file_dt_key_from_path = datetime.strptime(os.path.basename(file_path).replace('.json',''), "%Y-%m-%d_%H").replace(tzinfo=timezone.utc)
             key = (file_dt_key_from_path.year, file_dt_key_from_path.month, file_dt_key_from_path.day, file_dt_key_from_path.hour)
             CURRENT_TEST_DAY_DATA_CACHE[key] = df
     print(f"  INFO_DAY_LOAD: Pré-carregamento de dados brutos do dia concluído. {len(CURRENT_TEST_DAY_DATA_CACHE)} horas de DataFrames carregados para o cache do dia de teste.")
+    print(f"  INFO_HOUR_CACHE: {HOUR_CACHE_STATS['hits']} acertos, {HOUR_CACHE_STATS['misses']} faltas, {HOUR_CACHE_STATS['evictions']} descartes, {len(HOUR_DATA_LRU_CACHE)} horas ({HOUR_CACHE_STATS['bytes'] / 1024**2:.1f} MB) em memória.")
+
+    CURRENT_TEST_DAY_TRAJECTORY_INDEX = build_trajectory_index(CURRENT_TEST_DAY_DATA_CACHE.values())
+    print(f"  INFO_DAY_LOAD: Índice de trajetórias construído para {len(CURRENT_TEST_DAY_TRAJECTORY_INDEX)} ônibus.")
+    CURRENT_TEST_DAY_WINDOW = (test_day_datetime_ref.replace(hour=0, minute=0, second=0, microsecond=0), hours_before)
 
 
-def get_recent_historical_data_for_query_from_cache(ordem, linha, query_datetime, hours_before=5): 
+def get_recent_historical_data_for_query_from_cache(ordem, linha, query_datetime, hours_before=None): 
     """
-    Recupera dados históricos relevantes do CURRENT_TEST_DAY_DATA_CACHE (já pré-carregados para o dia do teste).
-    Aplica filtros de ônibus/linha e janela de tempo específica da query.
+    Recupera a trajetória recente de um ônibus a partir do CURRENT_TEST_DAY_TRAJECTORY_INDEX (construído para o dia do teste).
+    Retorna um dicionário de arrays (views, sem cópia) ordenados por tempo, na janela
+    [query_datetime - hours_before, query_datetime] (padrão: QUERY_HOURS_BEFORE), ou uma lista vazia se não houver dados.
     """
-    recent_data_dfs = []
-    
-    end_window_query = query_datetime
-    start_window_query = query_datetime - timedelta(hours=hours_before)
+    if hours_before is None:
+        hours_before = QUERY_HOURS_BEFORE
+    with instrumentacao.stage('busca_historico_query', 1):
+        trajectory = CURRENT_TEST_DAY_TRAJECTORY_INDEX.get((ordem, linha))
+        if trajectory is None:
+            instrumentacao.count('historico_onibus_ausente')
+            return []
+
+        end_window_ms = _datetime_to_ms(query_datetime)
+        start_window_ms = _datetime_to_ms(query_datetime - timedelta(hours=hours_before), round_up=True)
+
+        bus_history = slice_trajectory(trajectory, start_window_ms, end_window_ms)
+        instrumentacao.count('historico_pontos_retornados', len(bus_history['timestamp_ms']))
+        if len(bus_history['timestamp_ms']) == 0:
+            instrumentacao.count('historico_janela_vazia')
+            return []
+        return bus_history
+
+# --- INGESTÃO INCREMENTAL DE NOVOS ARQUIVOS HORÁRIOS ---
+
+def _window_contains_hour(window, hour_key):
+    """Se a hora (ano, mês, dia, hora) está na janela carregada (dia, hours_before): [dia - hours_before, fim do dia]."""
+    if window is None:
+        return False
+    day, hours_before = window
+    hour_dt = datetime(*hour_key, tzinfo=timezone.utc)
+    return day - timedelta(hours=hours_before) <= hour_dt < day + timedelta(days=1)
+
+
+def _append_to_trajectory(key, trajectory, new_part):
+    """
+    Anexa new_part (arrays ordenados por tempo) à trajetória de um ônibus. Se os novos registros vêm depois
+    do último conhecido, são escritos no fim do buffer do ônibus (realocado só quando a folga acaba); senão,
+    a trajetória é reordenada em um buffer novo. Retorna a nova entrada do índice (views do buffer).
+    """
+    n_old = len(trajectory['timestamp_ms'])
+    n_new = len(new_part['timestamp_ms'])
+    n_total = n_old + n_new
+    buffers = TRAJECTORY_APPEND_BUFFERS.get(key)
+    owns_buffer = buffers is not None and trajectory['timestamp_ms'].base is buffers['timestamp_ms']
+    in_order = n_old == 0 or new_part['timestamp_ms'][0] >= trajectory['timestamp_ms'][-1]
+
+    if in_order and owns_buffer and len(buffers['timestamp_ms']) >= n_total:
+        for col, buffer in buffers.items():
+            buffer[n_old:n_total] = new_part[col]
+        return {col: buffer[:n_total] for col, buffer in buffers.items()}
+
+    capacity = max(n_total * TRAJECTORY_GROWTH_FACTOR, 16)
+    order = None if in_order else np.argsort(np.concatenate([trajectory['timestamp_ms'], new_part['timestamp_ms']]), kind='stable')
+    buffers = {}
+    for col in trajectory:
+        values = np.concatenate([trajectory[col], new_part[col]])
+        buffers[col] = np.empty(capacity, dtype=values.dtype)
+        buffers[col][:n_total] = values if order is None else values[order]
+    TRAJECTORY_APPEND_BUFFERS[key] = buffers
+    return {col: buffer[:n_total] for col, buffer in buffers.items()}
+
+
+def append_hour_to_trajectory_index(hour_df, trajectory_index=None):
+    """
+    Anexa os registros de um DataFrame horário (já pré-processado) às trajetórias do índice, sem reconstruir
+    as horas já carregadas. Retorna o número de registros anexados.
+    """
+    if trajectory_index is None:
+        trajectory_index = CURRENT_TEST_DAY_TRAJECTORY_INDEX
 
-    current_dt_iterator = start_window_query.replace(minute=0, second=0, microsecond=0) 
-    
-    while current_dt_iterator <= end_window_query.replace(minute=0, second=0, microsecond=0): 
-        key = (current_dt_iterator.year, current_dt_iterator.month, current_dt_iterator.day, current_dt_iterator.hour)
-        if key in CURRENT_TEST_DAY_DATA_CACHE:
-            recent_data_dfs.append(CURRENT_TEST_DAY_DATA_CACHE[key])
-        current_dt_iterator += timedelta(hours=1) 
-    
-    if not recent_data_dfs:
-        # print(f"    AVISO_QUERY: Nenhum DataFrame para horas {start_window_query.hour}-{end_window_query.hour} no cache do dia para {ordem}/{linha}.")
-        return []
+    appended = 0
+    for key, new_part in build_trajectory_index([hour_df]).items():
+        trajectory = trajectory_index.get(key)
+        trajectory_index[key] = new_part if trajectory is None else _append_to_trajectory(key, trajectory, new_part)
+        appended += len(new_part['timestamp_ms'])
+    return appended
 
-    full_recent_df = pd.concat(recent_data_dfs, ignore_index=True)
-    
-    if not all(col in full_recent_df.columns for col in ['ordem', 'linha', 'datahoraservidor_dt']):
-        # print(f"    AVISO_QUERY: Colunas essenciais ausentes no full_recent_df para {ordem}/{linha}.")
-        return []
 
-    filtered_df = full_recent_df[
-        (full_recent_df['datahoraservidor_dt'] >= start_window_query) & 
-        (full_recent_df['datahoraservidor_dt'] <= end_window_query) & 
-        (full_recent_df['ordem'] == ordem) & 
-        (full_recent_df['linha'] == linha) &
-        (full_recent_df['linha'].isin(LINHAS_INTERESSE)) 
-    ].sort_values(by='datahoraservidor_dt').reset_index(drop=True)
+@timed('ingestao_incremental')
+def ingest_new_historical_files(base_historical_path, quiet=False):
+    """
+    Ingestão incremental: reescaneia a pasta histórica pelo manifesto (só pastas de dia alteradas), pré-processa
+    apenas os arquivos horários que ainda não estavam no cache de caminhos e, se a hora cair na janela do dia
+    carregado, anexa os registros ao CURRENT_TEST_DAY_TRAJECTORY_INDEX no lugar. As horas já carregadas não são
+    tocadas. Retorna {'novos': caminhos novos, 'registros_anexados': n, 'fora_da_janela': n}.
+    quiet: omite as mensagens informativas, como em build_historical_file_path_cache.
+    """
+    known_paths = {path for paths in HISTORICAL_RAW_FILE_PATH_CACHE.values() for path in paths}
+    previous_cache = {key: list(paths) for key, paths in HISTORICAL_RAW_FILE_PATH_CACHE.items()}
+    HISTORICAL_RAW_FILE_PATH_CACHE.clear()
+    if build_historical_file_path_cache(base_historical_path, quiet) is None and not HISTORICAL_RAW_FILE_PATH_CACHE:
+        HISTORICAL_RAW_FILE_PATH_CACHE.update(previous_cache)
+        return {'novos': [], 'registros_anexados': 0, 'fora_da_janela': 0}
+
+    new_paths = sorted(path for paths in HISTORICAL_RAW_FILE_PATH_CACHE.values() for path in paths if path not in known_paths)
+    appended = 0
+    outside_window = 0
+    for file_path in new_paths:
+        hour_key = _parse_hour_file_key(os.path.basename(file_path))
+        df = get_hour_dataframe(file_path)
+        if not _window_contains_hour(CURRENT_TEST_DAY_WINDOW, hour_key):
+            outside_window += 1
+            continue
+        if df.empty:
+            continue
+        CURRENT_TEST_DAY_DATA_CACHE[hour_key] = df if hour_key not in CURRENT_TEST_DAY_DATA_CACHE \
+            else pd.concat([CURRENT_TEST_DAY_DATA_CACHE[hour_key], df], ignore_index=True)
+        appended += append_hour_to_trajectory_index(df)
+
+    if new_paths:
+        if not quiet:
+            print(f"INFO_INGESTAO: {len(new_paths)} arquivos novos; {appended} registros anexados ao índice do dia, "
+                  f"{outside_window} arquivos fora da janela carregada.")
+        save_historical_manifest()
+    return {'novos': new_paths, 'registros_anexados': appended, 'fora_da_janela': outside_window}
 
-    if filtered_df.empty:
-        # print(f"    AVISO_QUERY: DataFrame vazio após filtros finais para {ordem}/{linha} na janela {start_window_query.strftime('%H:%M')}-{end_window_query.strftime('%H:%M')}. Dados ausentes ou filtrados.")
-        return []
 
-    # print(f"    INFO_QUERY_SUCCESS: Histórico encontrado para {ordem}/{linha}: {len(filtered_df)} registros.")
-    return filtered_df[['latitude', 'longitude', 'timestamp_ms', 'datahoraservidor_dt', 'velocidade']].to_dict('records')
+def evict_hour_file(file_path):
+    """
+    Descarta do cache LRU de horas um arquivo horário reescrito no lugar; a próxima leitura refaz o
+    pré-processamento (a assinatura do cache em disco muda com o mtime/tamanho). Se a hora estiver na janela
+    carregada, a janela é invalidada e recarregada na próxima consulta. Retorna se a janela foi invalidada.
+    """
+    global CURRENT_TEST_DAY_WINDOW
+    entry = HOUR_DATA_LRU_CACHE.pop(file_path, None)
+    if entry is not None:
+        HOUR_CACHE_STATS['bytes'] -= entry[1]
+    hour_key = _parse_hour_file_key(os.path.basename(file_path))
+    if hour_key is None or not _window_contains_hour(CURRENT_TEST_DAY_WINDOW, hour_key):
+        return False
+    CURRENT_TEST_DAY_WINDOW = None
+    return True
+
 
 # --- FUNÇÕES DE PREVISÃO (MVP SIMPLIFICADO) ---
 
-def predict_location(bus_history, target_timestamp_ms):
+@timed('predict_location')
+def predict_location(bus_history, target_timestamp_ms, linha=None):
     """
     Prevê a localização (lat, lon) de um ônibus dado um timestamp futuro.
     Usa interpolação linear simples ou a última posição conhecida.
+    bus_history é uma trajetória (dicionário de arrays ordenados por tempo) como a retornada pelo cache.
+    Se a linha for informada e tiver perfil de tempo de viagem, a posição depois do último ping é
+    extrapolada ao longo da rota (extrapolate_positions_on_route); senão, por dead reckoning
+    (extrapolate_dead_reckoning), se ligado.
     """
-    if not bus_history:
+    if not bus_history or len(bus_history['timestamp_ms']) == 0:
         return None, None 
 
-    target_datetime = datetime.fromtimestamp(target_timestamp_ms / 1000, tz=timezone.utc)
-
-    prev_point = None
-    next_point = None
-    
-    for i in range(len(bus_history)):
-        current_point = bus_history[i]
-        current_datetime = current_point['datahoraservidor_dt']
+    timestamps = bus_history['timestamp_ms']
+    latitudes = bus_history['latitude']
+    longitudes = bus_history['longitude']
 
-        if current_datetime <= target_datetime:
-            prev_point = current_point
-        else:
-            next_point = current_point
-            break 
+    # Primeiro ponto estritamente posterior ao alvo; o anterior (se existir) é o último ponto <= alvo
+    next_idx = int(np.searchsorted(timestamps, target_timestamp_ms, side='right'))
+    prev_idx = next_idx - 1
+    has_prev = prev_idx >= 0
+    has_next = next_idx < len(timestamps)
 
-    if prev_point is None and next_point is not None:
-        return next_point['latitude'], next_point['longitude']
+    if not has_prev and has_next:
+        return float(latitudes[next_idx]), float(longitudes[next_idx])
     
-    if prev_point is not None and next_point is not None:
-        time_diff = (next_point['timestamp_ms'] - prev_point['timestamp_ms'])
+    if has_prev and has_next:
+        time_diff = (timestamps[next_idx] - timestamps[prev_idx])
         if time_diff == 0: 
-            return prev_point['latitude'], prev_point['longitude']
+            return float(latitudes[prev_idx]), float(longitudes[prev_idx])
+
+        time_ratio = (target_timestamp_ms - timestamps[prev_idx]) / time_diff
+
+        lat = latitudes[prev_idx] + time_ratio * (latitudes[next_idx] - latitudes[prev_idx])
+        lon = longitudes[prev_idx] + time_ratio * (longitudes[next_idx] - longitudes[prev_idx])
+        return float(lat), float(lon)
+
+    if has_prev and not has_next:
+        if linha is not None:
+            before_idx = max(prev_idx - 1, 0)
+            ext_lats, ext_lons, extrapolated = extrapolate_positions_on_route(
+                linha, latitudes[prev_idx:prev_idx + 1], longitudes[prev_idx:prev_idx + 1],
+                timestamps[prev_idx:prev_idx + 1], np.array([target_timestamp_ms]),
+                latitudes[before_idx:before_idx + 1], longitudes[before_idx:before_idx + 1]
+            )
+            if extrapolated[0]:
+                return float(ext_lats[0]), float(ext_lons[0])
+        if DEAD_RECKONING_ENABLED:
+            ref_idx = int(np.searchsorted(timestamps, timestamps[prev_idx] - DEAD_RECKONING_WINDOW_MS, side='left'))
+            reported = bus_history['velocidade'][ref_idx:prev_idx + 1]
+            reported = reported[reported > 0]
+            ext_lats, ext_lons, extrapolated = extrapolate_dead_reckoning(
+                np.array([linha]), latitudes[prev_idx:prev_idx + 1], longitudes[prev_idx:prev_idx + 1],
+                timestamps[prev_idx:prev_idx + 1], latitudes[ref_idx:ref_idx + 1], longitudes[ref_idx:ref_idx + 1],
+                timestamps[ref_idx:ref_idx + 1], np.array([reported.mean() / 3.6 if len(reported) else np.nan]),
+                np.array([target_timestamp_ms])
+            )
+            if extrapolated[0]:
+                return float(ext_lats[0]), float(ext_lons[0])
+        return float(latitudes[prev_idx]), float(longitudes[prev_idx])
 
-        time_ratio = (target_timestamp_ms - prev_point['timestamp_ms']) / time_diff
+    return None, None 
 
-        lat = prev_point['latitude'] + time_ratio * (next_point['latitude'] - prev_point['latitude'])
-        lon = prev_point['longitude'] + time_ratio * (next_point['longitude'] - prev_point['longitude'])
-        return lat, lon
 
-    if prev_point is not None and next_point is None:
-        return prev_point['latitude'], prev_point['longitude']
+def predict_locations_batch(bus_keys, target_timestamps_ms, hours_before=None, trajectory_index=None):
+    """
+    Versão vetorizada de predict_location para todas as queries de tempo de um arquivo de teste.
+    bus_keys é uma sequência de (ordem, linha) e target_timestamps_ms os instantes alvo (também fim da janela
+    de histórico de cada query, como no fluxo por query). Aplica exatamente as mesmas regras de
+    predict_location (interpolação entre os pontos que cercam o alvo ou o ponto conhecido mais próximo),
+    com np.searchsorted sobre as trajetórias indexadas, e a mesma extrapolação por perfil depois do último ping.
+    Retorna dois arrays (lat, lon), com NaN onde não há histórico. hours_before: padrão QUERY_HOURS_BEFORE.
+    """
+    if hours_before is None:
+        hours_before = QUERY_HOURS_BEFORE
+    with instrumentacao.stage('predict_locations_batch', len(target_timestamps_ms)):
+        return _predict_locations_batch(bus_keys, target_timestamps_ms, hours_before, trajectory_index)
 
-    if len(bus_history) == 1 and prev_point is not None:
-        return prev_point['latitude'], prev_point['longitude']
 
-    return None, None 
+def _predict_locations_batch(bus_keys, target_timestamps_ms, hours_before, trajectory_index):
+    if trajectory_index is None:
+        trajectory_index = CURRENT_TEST_DAY_TRAJECTORY_INDEX
+
+    targets = np.asarray(target_timestamps_ms)
+    pred_lats = np.full(len(targets), np.nan)
+    pred_lons = np.full(len(targets), np.nan)
+    if len(targets) == 0:
+        return pred_lats, pred_lons
+
+    window_ms = hours_before * 3600 * 1000
+    bus_codes, unique_keys = pd.factorize(pd.Series(list(bus_keys), dtype=object))
+
+    # Queries depois do último ping sem extrapolação por perfil: vão juntas para o dead reckoning no fim
+    reckoning_parts = []
+
+    for bus_code, bus_key in enumerate(unique_keys):
+        trajectory = trajectory_index.get(bus_key)
+        if trajectory is None:
+            continue
+
+        positions = np.flatnonzero(bus_codes == bus_code)
+        bus_targets = targets[positions]
+        timestamps = trajectory['timestamp_ms']
+        latitudes = trajectory['latitude']
+        longitudes = trajectory['longitude']
+
+        # Janela [alvo - hours_before, alvo] de cada query e, dentro dela, os pontos que cercam o alvo
+        lo = np.searchsorted(timestamps, bus_targets - window_ms, side='left')
+        hi = np.searchsorted(timestamps, bus_targets, side='right')
+        next_idx = np.clip(np.searchsorted(timestamps, bus_targets, side='right'), lo, hi)
+        prev_idx = next_idx - 1
+        has_prev = prev_idx >= lo
+        has_next = next_idx < hi
+
+        safe_prev = np.clip(prev_idx, 0, max(len(timestamps) - 1, 0))
+        safe_next = np.clip(next_idx, 0, max(len(timestamps) - 1, 0))
+        lat_prev, lon_prev, ts_prev = latitudes[safe_prev], longitudes[safe_prev], timestamps[safe_prev]
+        lat_next, lon_next, ts_next = latitudes[safe_next], longitudes[safe_next], timestamps[safe_next]
+
+        bus_lats = np.full(len(positions), np.nan)
+        bus_lons = np.full(len(positions), np.nan)
+
+        only_next = ~has_prev & has_next
+        bus_lats[only_next] = lat_next[only_next]
+        bus_lons[only_next] = lon_next[only_next]
+
+        only_prev = has_prev & ~has_next
+        bus_lats[only_prev] = lat_prev[only_prev]
+        bus_lons[only_prev] = lon_prev[only_prev]
+        if only_prev.any():
+            # Ping anterior ao último da janela (o próprio último se ele for o único), para o rumo na rota
+            before_prev = np.maximum(safe_prev[only_prev] - 1, lo[only_prev])
+            ext_lats, ext_lons, extrapolated = extrapolate_positions_on_route(
+                bus_key[1], lat_prev[only_prev], lon_prev[only_prev], ts_prev[only_prev], bus_targets[only_prev],
+                latitudes[before_prev], longitudes[before_prev]
+            )
+            extrapolated_positions = np.flatnonzero(only_prev)[extrapolated]
+            bus_lats[extrapolated_positions] = ext_lats[extrapolated]
+            bus_lons[extrapolated_positions] = ext_lons[extrapolated]
+
+            pending = np.flatnonzero(only_prev)[~extrapolated]
+            if DEAD_RECKONING_ENABLED and len(pending):
+                last = safe_prev[pending]
+                ref = np.maximum(np.searchsorted(timestamps, ts_prev[pending] - DEAD_RECKONING_WINDOW_MS, side='left'), lo[pending])
+                reported = trajectory['velocidade']
+                reported_sum = np.r_[0.0, np.cumsum(np.where(reported > 0, reported, 0.0))]
+                reported_count = np.r_[0, np.cumsum(reported > 0)]
+                count = reported_count[last + 1] - reported_count[ref]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    reported_ms = np.where(count > 0, (reported_sum[last + 1] - reported_sum[ref]) / count / 3.6, np.nan)
+                reckoning_parts.append((positions[pending], np.full(len(pending), bus_key[1], dtype=object),
+                                        latitudes[last], longitudes[last], timestamps[last],
+                                        latitudes[ref], longitudes[ref], timestamps[ref], reported_ms, bus_targets[pending]))
+
+        both = has_prev & has_next
+        time_diff = ts_next - ts_prev
+        same_time = both & (time_diff == 0)
+        bus_lats[same_time] = lat_prev[same_time]
+        bus_lons[same_time] = lon_prev[same_time]
+
+        interpolate = both & (time_diff != 0)
+        time_ratio = (bus_targets[interpolate] - ts_prev[interpolate]) / time_diff[interpolate]
+        bus_lats[interpolate] = lat_prev[interpolate] + time_ratio * (lat_next[interpolate] - lat_prev[interpolate])
+        bus_lons[interpolate] = lon_prev[interpolate] + time_ratio * (lon_next[interpolate] - lon_prev[interpolate])
+
+        pred_lats[positions] = bus_lats
+        pred_lons[positions] = bus_lons
+
+    if reckoning_parts:
+        query_positions, *columns = (np.concatenate(column) for column in zip(*reckoning_parts))
+        ext_lats, ext_lons, extrapolated = extrapolate_dead_reckoning(*columns)
+        pred_lats[query_positions[extrapolated]] = ext_lats[extrapolated]
+        pred_lons[query_positions[extrapolated]] = ext_lons[extrapolated]
+
+    return pred_lats, pred_lons
+
+
+# Erro relativo máximo da haversine (esfera) em relação à geodésica no elipsoide WGS-84 (~0,56%, com margem).
+# Todo ponto cuja distância haversine esteja dentro dessa tolerância do mínimo é reavaliado com a geodésica
+# exata, então o ponto escolhido é o mesmo da busca exaustiva com geodesic.
+HAVERSINE_MAX_RELATIVE_ERROR = 0.006
+
+# Limite de pares (alvo x ponto) avaliados de uma vez na matriz de distâncias haversine
+NEAREST_POINT_CHUNK_SIZE = 2_000_000
+
+
+def _geodesic_meters(point_1, point_2):
+    """geopy.distance.geodesic em metros; o geopy só é importado quando a distância exata é necessária."""
+    from geopy.distance import geodesic
+    return geodesic(point_1, point_2).meters
+
+
+def find_nearest_points(latitudes, longitudes, target_lats, target_lons):
+    """
+    Para cada alvo, encontra o índice do ponto (latitudes[i], longitudes[i]) mais próximo pela geodésica.
+    A haversine vetorizada descarta os pontos claramente mais distantes; a geodésica exata só é calculada
+    para os candidatos dentro de HAVERSINE_MAX_RELATIVE_ERROR do mínimo. Empates ficam com o primeiro ponto,
+    como na busca sequencial. Retorna (índices, distâncias em metros), com -1/inf quando não há pontos.
+    """
+    target_lats = np.atleast_1d(np.asarray(target_lats, dtype=np.float64))
+    target_lons = np.atleast_1d(np.asarray(target_lons, dtype=np.float64))
+    nearest_idx = np.full(len(target_lats), -1, dtype=np.int64)
+    nearest_dist = np.full(len(target_lats), np.inf)
+    if len(latitudes) == 0:
+        return nearest_idx, nearest_dist
+
+    tolerance_factor = (1 + HAVERSINE_MAX_RELATIVE_ERROR) / (1 - HAVERSINE_MAX_RELATIVE_ERROR)
+    chunk = max(1, NEAREST_POINT_CHUNK_SIZE // len(latitudes))
+
+    for chunk_start in range(0, len(target_lats), chunk):
+        chunk_lats = target_lats[chunk_start:chunk_start + chunk]
+        chunk_lons = target_lons[chunk_start:chunk_start + chunk]
+        approx = distancias.haversine_meters(chunk_lats[:, None], chunk_lons[:, None], latitudes[None, :], longitudes[None, :])
+        approx_min = np.nanmin(np.where(np.isnan(approx), np.inf, approx), axis=1)
+
+        for offset, (target_lat, target_lon) in enumerate(zip(chunk_lats, chunk_lons)):
+            if not np.isfinite(approx_min[offset]):
+                continue
+            candidates = np.flatnonzero(approx[offset] <= approx_min[offset] * tolerance_factor + 1e-6)
+
+            min_distance = float('inf')
+            for candidate in candidates:
+                dist = _geodesic_meters((latitudes[candidate], longitudes[candidate]), (target_lat, target_lon))
+                if dist < min_distance:
+                    min_distance = dist
+                    nearest_idx[chunk_start + offset] = candidate
+            nearest_dist[chunk_start + offset] = min_distance
+
+    return nearest_idx, nearest_dist
+
+
+def predict_arrival_times_batch(bus_history, target_lats, target_lons):
+    """
+    Versão em lote de predict_arrival_time: para cada localização alvo do mesmo ônibus, retorna o
+    timestamp do ponto histórico mais próximo (ou None se não houver histórico).
+    """
+    if not bus_history or len(bus_history['timestamp_ms']) == 0:
+        return [None] * len(np.atleast_1d(target_lats))
 
+    nearest_idx, _ = find_nearest_points(bus_history['latitude'], bus_history['longitude'], target_lats, target_lons)
+    timestamps = bus_history['timestamp_ms']
+    return [int(timestamps[i]) if i >= 0 else None for i in nearest_idx]
 
+
+@timed('predict_arrival_time')
 def predict_arrival_time(bus_history, target_location):
     """
     Prevê o timestamp de chegada em uma localização (lat, lon) alvo.
@@ -283,130 +1345,478 @@ def predict_arrival_time(bus_history, target_location):
     if not bus_history or not target_location:
         return None
 
-    target_lat, target_lon = target_location['latitude'], target_location['longitude']
-    
-    min_distance = float('inf')
-    closest_point_timestamp = None
-    
-    for point in bus_history:
-        point_lat, point_lon = point['latitude'], point['longitude']
-        dist = geodesic((point_lat, point_lon), (target_lat, target_lon)).meters
-        
-        if dist < min_distance:
-            min_distance = dist
-            closest_point_timestamp = point['timestamp_ms']
-            
-    return closest_point_timestamp
+    return predict_arrival_times_batch(bus_history, [target_location['latitude']], [target_location['longitude']])[0]
+
+
+# --- ROTAS DE REFERÊNCIA POR LINHA (ESTÁGIO OFFLINE) ---
+
+def route_file_path(linha):
+    return os.path.join(ROUTES_PATH, f"rota_{linha}.npz")
+
+
+def get_route(linha):
+    """Rota de referência da linha (carregada do disco na primeira vez); None se não foi construída."""
+    if linha not in ROUTE_CACHE:
+        file_path = route_file_path(linha)
+        ROUTE_CACHE[linha] = rotas.load_route(file_path) if os.path.isfile(file_path) else None
+    return ROUTE_CACHE[linha]
+
+
+@timed('construcao_rotas')
+def build_route_geometries(days=None, candidates_per_line=5):
+    """
+    Estágio offline: constrói a rota de referência de cada linha de LINHAS_INTERESSE a partir dos pings
+    históricos e grava em ROUTES_PATH. Para cada linha, as trajetórias diárias mais longas são candidatas;
+    a rota é o primeiro ciclo completo encontrado (ou a trajetória mais longa, como rota aberta).
+    days: datas (UTC) a usar; por padrão os ROUTE_BUILD_DAYS dias mais recentes do cache de caminhos.
+    """
+    if days is None:
+        all_days = sorted({datetime(key[0], key[1], key[2], tzinfo=timezone.utc) for key in HISTORICAL_RAW_FILE_PATH_CACHE})
+        days = all_days[-ROUTE_BUILD_DAYS:]
+
+    candidates = {}
+    for day in days:
+        day_files = sorted(path for key, paths in HISTORICAL_RAW_FILE_PATH_CACHE.items()
+                           if (key[0], key[1], key[2]) == (day.year, day.month, day.day) for path in paths)
+        day_index = build_trajectory_index(get_hour_dataframe(path) for path in day_files)
+        for (_, linha), trajectory in day_index.items():
+            line_candidates = candidates.setdefault(linha, [])
+            line_candidates.append((trajectory['latitude'].copy(), trajectory['longitude'].copy()))
+            line_candidates.sort(key=lambda candidate: -len(candidate[0]))
+            del line_candidates[candidates_per_line:]
+
+    built = 0
+    for linha, line_candidates in sorted(candidates.items()):
+        extracted = [rotas.extract_route_cycle(lats, lons) for lats, lons in line_candidates]
+        closed = [candidate for candidate in extracted if candidate[2]]
+        route_lats, route_lons, is_closed = closed[0] if closed else max(extracted, key=lambda candidate: len(candidate[0]))
+        if len(route_lats) < 2:
+            continue
+        route = rotas.build_route(route_lats, route_lons, closed=is_closed)
+        rotas.save_route(route, route_file_path(linha))
+        ROUTE_CACHE[linha] = route
+        built += 1
+        print(f"  INFO_ROTAS: Linha {linha}: {len(route_lats)} vértices, {rotas.route_length(route) / 1000:.1f} km, {'fechada' if is_closed else 'aberta'}.")
+    print(f"INFO_ROTAS: {built} rotas construídas a partir de {len(days)} dias de histórico em '{ROUTES_PATH}'.")
+    return built
+
+
+def estimate_route_speed(route, bus_history):
+    """
+    Velocidade média (m/s) de avanço do ônibus ao longo da rota nos últimos ROUTE_SPEED_WINDOW_MS do histórico.
+    Usa a velocidade reportada (velocidade) ou ROUTE_DEFAULT_SPEED_MS quando o avanço não pode ser medido.
+    """
+    timestamps = bus_history['timestamp_ms']
+    recent = timestamps >= timestamps[-1] - ROUTE_SPEED_WINDOW_MS
+    recent_lats, recent_lons = bus_history['latitude'][recent], bus_history['longitude'][recent]
+    along, snap_distance = rotas.project_onto_route(route, recent_lats, recent_lons,
+                                                    np.r_[recent_lats[:1], recent_lats[:-1]], np.r_[recent_lons[:1], recent_lons[:-1]])
+    on_route = snap_distance <= ROUTE_MAX_SNAP_DISTANCE_M
+
+    if on_route.sum() >= 2:
+        along, recent_ts = along[on_route], timestamps[recent][on_route]
+        steps = rotas.forward_distance(route, along[:-1], along[1:])
+        # Em rotas fechadas, um pequeno recuo (ruído do GPS) vira quase uma volta inteira: descarta
+        steps = np.where(np.isnan(steps) | (steps > rotas.route_length(route) / 2), 0.0, steps)
+        elapsed_s = (recent_ts[-1] - recent_ts[0]) / 1000
+        if elapsed_s > 0 and steps.sum() > 0:
+            return float(steps.sum() / elapsed_s)
+
+    reported = bus_history['velocidade'][recent]
+    reported = reported[reported > 0]
+    return float(reported.mean() / 3.6) if len(reported) else ROUTE_DEFAULT_SPEED_MS
+
+
+def project_bus_on_route(route, bus_history):
+    """Projeção do último ping do ônibus na rota (sentido dado pelo penúltimo): arrays (posição ao longo, distância)."""
+    if len(bus_history['timestamp_ms']) >= 2:
+        return rotas.project_onto_route(route, bus_history['latitude'][-1:], bus_history['longitude'][-1:],
+                                        bus_history['latitude'][-2:-1], bus_history['longitude'][-2:-1])
+    return rotas.project_onto_route(route, bus_history['latitude'][-1:], bus_history['longitude'][-1:])
+
+
+def predict_arrival_time_on_route(bus_history, target_lat, target_lon, route, linha=None, bus_projection=None):
+    """
+    Prevê a chegada projetando o alvo e a última posição do ônibus na rota da linha: o tempo restante é a
+    distância ao longo da rota (diferença na distância acumulada) dividida pela velocidade estimada, ou,
+    se a linha tiver perfil, o tempo de viagem típico entre os dois pontos no dia da semana/hora do último ping.
+    O sentido do ônibus vem dos dois últimos pings; se a rota passa pelo alvo mais de uma vez (ida e volta
+    pela mesma rua), vale a próxima passagem.
+    Retorna None se o alvo estiver longe da rota ou já tiver ficado para trás em uma rota aberta.
+    bus_projection (de project_bus_on_route) evita refazer a projeção do ônibus para vários alvos.
+    """
+    target_alongs = rotas.route_positions_near(route, target_lat, target_lon, ROUTE_MAX_SNAP_DISTANCE_M)
+    bus_along, bus_distance = bus_projection if bus_projection is not None else project_bus_on_route(route, bus_history)
+    if len(target_alongs) == 0 or bus_distance[0] > ROUTE_MAX_SNAP_DISTANCE_M:
+        return None
+
+    remaining_candidates = rotas.forward_distance(route, bus_along[0], target_alongs)
+    if np.isnan(remaining_candidates).all():
+        return None
+    next_passage = int(np.nanargmin(remaining_candidates))
+    remaining_m, target_along = remaining_candidates[next_passage], target_alongs[next_passage:next_passage + 1]
+
+    last_timestamp_ms = bus_history['timestamp_ms'][-1]
+    profile = get_travel_time_profile(linha) if linha is not None else None
+    if profile is not None:
+        remaining_s = perfis.travel_time_s(profile, bus_along, target_along, [last_timestamp_ms])[0]
+        if not np.isnan(remaining_s):
+            return int(last_timestamp_ms + remaining_s * 1000)
+    speed_ms = estimate_route_speed(route, bus_history)
+    return int(last_timestamp_ms + remaining_m / speed_ms * 1000)
+
+
+@timed('predict_arrival_time_with_route')
+def predict_arrival_time_with_route(bus_history, target_location, linha):
+    """
+    Previsão de chegada usada no pipeline: se a rota da linha foi construída, a chegada é estimada ao longo
+    da rota (predict_arrival_time_on_route); sem rota, ou com alvo/ônibus fora dela, vale o ping histórico
+    mais próximo, como em predict_arrival_time.
+    """
+    if not bus_history or not target_location:
+        return None
+
+    route = get_route(linha)
+    if route is not None:
+        route_timestamp = predict_arrival_time_on_route(bus_history, target_location['latitude'], target_location['longitude'], route, linha)
+        if route_timestamp is not None:
+            return route_timestamp
+    return predict_arrival_time(bus_history, target_location)
+
+
+@timed('predict_arrival_times_with_route_batch')
+def predict_arrival_times_with_route_batch(bus_history, target_lats, target_lons, linha):
+    """
+    Versão em lote de predict_arrival_time_with_route para vários alvos do mesmo ônibus e mesma janela de
+    histórico: a projeção do ônibus na rota é feita uma vez, os alvos resolvidos pela rota são previstos um a um
+    e os demais caem juntos em uma única busca
+    do ping mais próximo (predict_arrival_times_batch).
+    """
+    target_lats = np.atleast_1d(np.asarray(target_lats, dtype=np.float64))
+    target_lons = np.atleast_1d(np.asarray(target_lons, dtype=np.float64))
+    if not bus_history or len(bus_history['timestamp_ms']) == 0:
+        return [None] * len(target_lats)
+
+    predictions = [None] * len(target_lats)
+    route = get_route(linha)
+    if route is not None:
+        bus_projection = project_bus_on_route(route, bus_history)
+        for i in range(len(target_lats)):
+            predictions[i] = predict_arrival_time_on_route(bus_history, target_lats[i], target_lons[i], route, linha, bus_projection)
+    fallback = [i for i, prediction in enumerate(predictions) if prediction is None]
+    if fallback:
+        for i, timestamp in zip(fallback, predict_arrival_times_batch(bus_history, target_lats[fallback], target_lons[fallback])):
+            predictions[i] = timestamp
+    return predictions
+
+
+# --- PERFIS DE TEMPO DE VIAGEM (ESTÁGIO OFFLINE) ---
+
+def profile_file_path(linha):
+    return os.path.join(PROFILES_PATH, f"perfil_{linha}.npz")
+
+
+def get_travel_time_profile(linha):
+    """Perfil de tempo de viagem da linha (carregado do disco na primeira vez); None se não foi construído."""
+    if linha not in PROFILE_CACHE:
+        file_path = profile_file_path(linha)
+        PROFILE_CACHE[linha] = perfis.load_profile(file_path) if os.path.isfile(file_path) else None
+    return PROFILE_CACHE[linha]
+
+
+@timed('construcao_perfis')
+def build_travel_time_profiles(days=None):
+    """
+    Estágio offline: agrega o histórico de cada linha com rota construída em um perfil de tempo de viagem
+    (avanço ao longo da rota e velocidade reportada por dia da semana, hora e trecho) e grava em PROFILES_PATH.
+    days: datas (UTC) a usar; por padrão os PROFILE_BUILD_DAYS dias mais recentes do cache de caminhos.
+    """
+    if days is None:
+        all_days = sorted({datetime(key[0], key[1], key[2], tzinfo=timezone.utc) for key in HISTORICAL_RAW_FILE_PATH_CACHE})
+        days = all_days[-PROFILE_BUILD_DAYS:]
+
+    accumulators = {}
+    for day in days:
+        day_files = sorted(path for key, paths in HISTORICAL_RAW_FILE_PATH_CACHE.items()
+                           if (key[0], key[1], key[2]) == (day.year, day.month, day.day) for path in paths)
+        day_index = build_trajectory_index(get_hour_dataframe(path) for path in day_files)
+        for (_, linha), trajectory in day_index.items():
+            route = get_route(linha)
+            if route is None:
+                continue
+            if linha not in accumulators:
+                accumulators[linha] = perfis.new_profile_accumulator(route)
+            perfis.accumulate_trajectory(accumulators[linha], route, trajectory['timestamp_ms'], trajectory['latitude'],
+                                         trajectory['longitude'], trajectory['velocidade'], ROUTE_MAX_SNAP_DISTANCE_M)
+
+    for linha, accumulator in sorted(accumulators.items()):
+        profile = perfis.finalize_profile(accumulator, get_route(linha))
+        perfis.save_profile(profile, profile_file_path(linha))
+        PROFILE_CACHE[linha] = profile
+        filled = (accumulator['amostras'] >= perfis.PROFILE_MIN_SAMPLES).mean() * 100
+        print(f"  INFO_PERFIS: Linha {linha}: {int(accumulator['amostras'].sum())} passos medidos, "
+              f"{filled:.0f}% das células (dia, hora, trecho) com amostras próprias.")
+    if not accumulators:
+        print("AVISO_PERFIS: Nenhuma linha com rota construída. Rode antes 'python main.py --build-routes'.")
+    print(f"INFO_PERFIS: {len(accumulators)} perfis construídos a partir de {len(days)} dias de histórico em '{PROFILES_PATH}'.")
+    return len(accumulators)
+
+
+def extrapolate_positions_on_route(linha, last_lats, last_lons, last_timestamps_ms, target_timestamps_ms,
+                                   previous_lats=None, previous_lons=None):
+    """
+    Extrapola, para uma linha, posições além do último ping: projeta cada último ping na rota (no sentido
+    dado pelo ping anterior, previous_lats/previous_lons, quando informado), avança ao longo dela o tempo até o alvo segundo o perfil (consulta à tabela de tempo acumulado) e volta para
+    (lat, lon). Retorna (lats, lons, extrapolado); extrapolado é False onde não há rota/perfil, o ping está
+    fora da rota ou o alvo está a mais de PROFILE_MAX_EXTRAPOLATION_MS do último ping.
+    """
+    last_lats = np.asarray(last_lats, dtype=np.float64)
+    last_lons = np.asarray(last_lons, dtype=np.float64)
+    elapsed_ms = np.asarray(target_timestamps_ms, dtype=np.int64) - np.asarray(last_timestamps_ms, dtype=np.int64)
+    extrapolated = (elapsed_ms > 0) & (elapsed_ms <= PROFILE_MAX_EXTRAPOLATION_MS)
+
+    route = get_route(linha)
+    profile = get_travel_time_profile(linha) if route is not None else None
+    if profile is None or not extrapolated.any():
+        return last_lats, last_lons, np.zeros(len(last_lats), dtype=bool)
+
+    if previous_lats is not None:
+        previous_lats, previous_lons = np.asarray(previous_lats)[extrapolated], np.asarray(previous_lons)[extrapolated]
+    along, snap_distance = rotas.project_onto_route(route, last_lats[extrapolated], last_lons[extrapolated], previous_lats, previous_lons)
+    on_route = snap_distance <= ROUTE_MAX_SNAP_DISTANCE_M
+    new_along = perfis.distance_after_s(profile, along, elapsed_ms[extrapolated] / 1000,
+                                        np.asarray(last_timestamps_ms)[extrapolated])
+    new_lats, new_lons = rotas.position_at_distance(route, new_along)
+
+    result_lats, result_lons = last_lats.copy(), last_lons.copy()
+    positions = np.flatnonzero(extrapolated)[on_route]
+    result_lats[positions] = new_lats[on_route]
+    result_lons[positions] = new_lons[on_route]
+    extrapolated[np.flatnonzero(extrapolated)[~on_route]] = False
+    return result_lats, result_lons, extrapolated
+
+
+def extrapolate_dead_reckoning(linhas, last_lats, last_lons, last_timestamps_ms, ref_lats, ref_lons, ref_timestamps_ms,
+                               reported_speeds_ms, target_timestamps_ms):
+    """
+    Dead reckoning em lote (ônibus e linhas quaisquer, um elemento por query). O rumo vai do ping de referência
+    (o mais antigo da janela recente) ao último ping; a velocidade é a reportada média na janela
+    (reported_speeds_ms, NaN se não houver) ou, sem ela, a medida entre os dois pings. O ônibus avança
+    velocidade * tempo até o alvo (limitado a DEAD_RECKONING_MAX_MS): ao longo da rota da linha, se houver e o
+    último ping estiver nela, ou em linha reta. Retorna (lats, lons, extrapolado); extrapolado é False onde o
+    deslocamento recente é curto demais para dar um rumo.
+    """
+    last_lats = np.asarray(last_lats, dtype=np.float64)
+    last_lons = np.asarray(last_lons, dtype=np.float64)
+    ref_lats = np.asarray(ref_lats, dtype=np.float64)
+    ref_lons = np.asarray(ref_lons, dtype=np.float64)
+    last_timestamps_ms = np.asarray(last_timestamps_ms, dtype=np.int64)
+
+    # Deslocamento recente no plano local de cada último ping
+    cos_lat = np.cos(np.radians(last_lats))
+    dx = np.radians(last_lons - ref_lons) * cos_lat * rotas.EARTH_RADIUS_M
+    dy = np.radians(last_lats - ref_lats) * rotas.EARTH_RADIUS_M
+    displacement = np.hypot(dx, dy)
+    recent_s = (last_timestamps_ms - np.asarray(ref_timestamps_ms, dtype=np.int64)) / 1000
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        measured = np.where(recent_s > 0, displacement / recent_s, np.nan)
+        speed = np.clip(np.where(np.isnan(reported_speeds_ms), measured, reported_speeds_ms), 0.0, DEAD_RECKONING_MAX_SPEED_MS)
+        elapsed_s = np.clip(np.asarray(target_timestamps_ms, dtype=np.int64) - last_timestamps_ms, 0, DEAD_RECKONING_MAX_MS) / 1000
+        travel_m = speed * elapsed_s
+        extrapolated = (displacement >= DEAD_RECKONING_MIN_DISPLACEMENT_M) & (recent_s > 0) & (travel_m > 0)
+        travel_m = np.where(extrapolated, travel_m, 0.0)
+
+        new_lats = last_lats + np.degrees(np.where(extrapolated, dy / displacement, 0.0) * travel_m / rotas.EARTH_RADIUS_M)
+        new_lons = last_lons + np.degrees(np.where(extrapolated, dx / displacement, 0.0) * travel_m / (rotas.EARTH_RADIUS_M * cos_lat))
+
+    if DEAD_RECKONING_SNAP_TO_ROUTE and extrapolated.any():
+        linhas = np.asarray(linhas, dtype=object)
+        for linha in pd.unique(linhas[extrapolated]):
+            route = get_route(linha)
+            if route is None:
+                continue
+            selected = np.flatnonzero(extrapolated & (linhas == linha))
+            along, snap_distance = rotas.project_onto_route(route, last_lats[selected], last_lons[selected],
+                                                            ref_lats[selected], ref_lons[selected])
+            on_route = snap_distance <= ROUTE_MAX_SNAP_DISTANCE_M
+            route_lats, route_lons = rotas.position_at_distance(route, along[on_route] + travel_m[selected][on_route])
+            new_lats[selected[on_route]] = route_lats
+            new_lons[selected[on_route]] = route_lons
+
+    return new_lats, new_lons, extrapolated
+
+
+# --- ÍNDICE HISTÓRICO DA FROTA (ESTÁGIO OFFLINE) ---
+
+def get_fleet_index():
+    """Índice da frota (aberto do disco, em mmap, na primeira vez); None se não foi construído ou está desligado."""
+    if not FLEET_FALLBACK_ENABLED:
+        return None
+    if 'indice' not in FLEET_INDEX_CACHE:
+        FLEET_INDEX_CACHE['indice'] = frota.load_fleet_index(FLEET_INDEX_PATH)
+    return FLEET_INDEX_CACHE['indice']
+
+
+@timed('construcao_indice_frota')
+def build_fleet_index(days=None):
+    """
+    Estágio offline: agrega as horas históricas das linhas de interesse no índice da frota por (linha, dia da
+    semana, hora) e grava em FLEET_INDEX_PATH. As horas são lidas uma a uma, sem montar trajetórias; as posições
+    são projetadas nas rotas já construídas (python main.py --build-routes), e linhas sem rota ficam só com o centroide.
+    days: datas (UTC) a usar; por padrão todas as do cache de caminhos (ou as FLEET_INDEX_BUILD_DAYS mais recentes).
+    """
+    if days is None:
+        days = sorted({datetime(key[0], key[1], key[2], tzinfo=timezone.utc) for key in HISTORICAL_RAW_FILE_PATH_CACHE})
+        if FLEET_INDEX_BUILD_DAYS:
+            days = days[-FLEET_INDEX_BUILD_DAYS:]
+    day_keys = {(day.year, day.month, day.day) for day in days}
+
+    accumulator = frota.new_fleet_accumulator()
+    for key in sorted(HISTORICAL_RAW_FILE_PATH_CACHE):
+        if (key[0], key[1], key[2]) in day_keys:
+            for path in sorted(HISTORICAL_RAW_FILE_PATH_CACHE[key]):
+                frota.accumulate_hour(accumulator, get_hour_dataframe(path), get_route, ROUTE_MAX_SNAP_DISTANCE_M)
+
+    index = frota.finalize_fleet_index(accumulator)
+    frota.save_fleet_index(index, {'linhas': list(accumulator['linhas']), 'onibus': list(accumulator['onibus']),
+                                   'origem': accumulator['origem'],
+                                   'dias': [day.strftime('%Y-%m-%d') for day in days], 'pings': accumulator['pings']},
+                           FLEET_INDEX_PATH)
+    FLEET_INDEX_CACHE.clear()
+    filled = (index['amostras'][:, :frota.ALL_WEEKDAYS] > 0).mean() * 100 if index['amostras'].size else 0.0
+    print(f"INFO_FROTA: Índice da frota com {len(accumulator['linhas'])} linhas ({len(accumulator['rotas'])} com rota) construído "
+          f"a partir de {accumulator['pings']} pings de {len(days)} dias em '{FLEET_INDEX_PATH}' ({filled:.0f}% das células "
+          f"(dia, hora, faixa) com amostras, {len(index['onibus_chaves'])} entradas por ônibus, {len(index['celulas'])} células de chegada).")
+    index_error_m, centroid_error_m, holdout_samples = index['validacao']
+    if holdout_samples:
+        print(f"INFO_FROTA: No último dia ({int(holdout_samples)} amostras, índice montado com os dias anteriores), "
+              f"erro médio da posição de reserva {index_error_m:.0f} m contra {centroid_error_m:.0f} m do centroide da linha.")
+    if not accumulator['rotas']:
+        print("AVISO_FROTA: Nenhuma linha com rota construída; as posições de reserva serão só os centroides das linhas. "
+              "Rode antes 'python main.py --build-routes'.")
+    return len(accumulator['linhas'])
+
+
+def fleet_fallback_positions(bus_keys, target_timestamps_ms):
+    """Posições de reserva do índice da frota para pares (ordem, linha) (arrays lat, lon com NaN sem resposta); None sem índice."""
+    index = get_fleet_index()
+    if index is None:
+        return None
+    return frota.fleet_positions(index, bus_keys, target_timestamps_ms)
+
+
+def fleet_fallback_arrival_times(linhas, target_lats, target_lons, reference_timestamps_ms):
+    """Chegadas de reserva do índice da frota (timestamps em ms, NaN sem resposta); None sem índice."""
+    index = get_fleet_index()
+    if index is None:
+        return None
+    return frota.fleet_arrival_times(index, linhas, target_lats, target_lons, reference_timestamps_ms)
 
 
 # --- FUNÇÕES DE AVALIAÇÃO (MVP SIMPLIFICADO) ---
-def evaluate_predictions_mvp(previsoes, all_test_queries_list_for_eval):
+def _query_reference_datetime(query, test_filename=None):
     """
-    Avalia as previsões comparando-as com o histórico conhecido.
-    Retorna uma string de relatório.
+    Instante de referência de uma query: datahora_dt ou, sem ela, a hora do nome do arquivo treino
+    (test_filename ou, sem ele, id_arquivo_teste); sem nenhum dos dois, agora.
     """
-    total_pos_error = 0.0 
-    total_time_error_sec = 0.0 
-    pos_predictions_count = 0
-    time_predictions_count = 0
-    
-    evaluation_report = ["--- Relatório de Avaliação MVP (Estimado) ---"]
-    evaluation_report.append("Nota: Esta é uma avaliação interna simplificada, pois não temos um arquivo 'resposta' real para comparação direta aqui.")
-    evaluation_report.append("Os erros são calculados comparando a previsão com o ponto histórico mais próximo ou estimado na janela de dados.")
-    
-    queries_by_id = {q['id']: q for q in all_test_queries_list_for_eval}
+    query_datetime = query.get('datahora_dt')
+    if query_datetime is not None:
+        return query_datetime
+    try:
+        parts = os.path.splitext(os.path.basename(test_filename or query['id_arquivo_teste']))[0].split('_')
+        date_part = parts[0].replace('treino-', '')
+        hour_part = parts[1]
+        return datetime.strptime(f"{date_part}_{hour_part}", "%Y-%m-%d_%H").replace(tzinfo=timezone.utc)
+    except Exception:
+        return datetime.now(timezone.utc)
 
-    for pred in previsoes:
-        query_id = pred[0]
-        original_query = queries_by_id.get(query_id)
 
-        if not original_query:
-            continue
+def _nearest_in_time_indices(timestamps, lo, hi, target_timestamps):
+    """
+    Índice do ponto de timestamps[lo:hi] mais próximo de cada alvo no tempo (empates ficam com o primeiro
+    ponto na ordem temporal, como na busca sequencial). Retorna -1 para janelas vazias.
+    """
+    candidate = np.clip(np.searchsorted(timestamps, target_timestamps, side='left'), lo, hi)
+    has_prev = candidate - 1 >= lo
+    has_next = candidate < hi
+    last = max(len(timestamps) - 1, 0)
+    prev_ts = timestamps[np.clip(candidate - 1, 0, last)]
+    next_ts = timestamps[np.clip(candidate, 0, last)]
 
-        ordem_bus = original_query['ordem']
-        linha_bus = original_query['linha']
-        query_datetime = original_query.get('datahora_dt')
-
-        if query_datetime is None and 'id_arquivo_teste' in original_query:
-             try:
-                base_test_filename = os.path.basename(original_query['id_arquivo_teste'])
-                parts = os.path.splitext(base_test_filename)[0].split('_') 
-                date_part = parts[0].replace('treino-', '') 
-                hour_part = parts[1]
-                query_datetime = datetime.strptime(f"{date_part}_{hour_part}", "%Y-%m-%d_%H").replace(tzinfo=timezone.utc)
-             except Exception:
-                 query_datetime = datetime.now(timezone.utc) 
-        elif query_datetime is None: 
-             query_datetime = datetime.now(timezone.utc)
+    use_prev = has_prev & (~has_next | (np.abs(target_timestamps - prev_ts) <= np.abs(next_ts - target_timestamps)))
+    # Entre pontos com o mesmo timestamp, o primeiro da janela
+    first_of_prev = np.maximum(np.searchsorted(timestamps, prev_ts, side='left'), lo)
+    nearest = np.where(use_prev, first_of_prev, candidate)
+    return np.where(has_prev | has_next, nearest, -1)
 
-        
-        eval_hours_before = 5 
-        eval_end_window = query_datetime
-        eval_start_window = query_datetime - timedelta(hours=eval_hours_before)
-        eval_start_window = eval_start_window.replace(minute=0, second=0, microsecond=0)
-
-        eval_dfs_for_query = []
-        eval_current_dt_iterator = eval_start_window
-        while eval_current_dt_iterator <= eval_end_window.replace(minute=0, second=0, microsecond=0):
-            key = (eval_current_dt_iterator.year, eval_current_dt_iterator.month, eval_current_dt_iterator.day, eval_current_dt_iterator.hour)
-            if key in HISTORICAL_RAW_FILE_PATH_CACHE:
-                for path in HISTORICAL_RAW_FILE_PATH_CACHE[key]:
-                    df = load_and_preprocess_single_raw_file(path) 
-                    if not df.empty:
-                        eval_dfs_for_query.append(df)
-            eval_current_dt_iterator += timedelta(hours=1)
-
-        temp_full_eval_df = pd.concat(eval_dfs_for_query, ignore_index=True) if eval_dfs_for_query else pd.DataFrame()
-
-        bus_history_for_eval = temp_full_eval_df[
-            (temp_full_eval_df['datahoraservidor_dt'] >= eval_start_window) & 
-            (temp_full_eval_df['datahoraservidor_dt'] <= eval_end_window) & 
-            (temp_full_eval_df['ordem'] == ordem) & 
-            (temp_full_eval_df['linha'] == linha) &
-            (temp_full_eval_df['linha'].isin(LINHAS_INTERESSE)) 
-        ].sort_values(by='datahoraservidor_dt').to_dict('records')
-
-        if not bus_history_for_eval:
+
+def accumulate_mvp_evaluation(indexed_previsoes, queries_by_id, position_errors, time_errors_sec, trajectory_index=None, eval_hours_before=None):
+    """
+    Calcula o "gabarito estimado" das previsões usando o índice de trajetórias já carregado:
+    ponto mais próximo no tempo (previsões de posição) ou no espaço (previsões de tempo), dentro da janela
+    [hora cheia de (query - eval_hours_before), query] do mesmo ônibus (eval_hours_before padrão: EVAL_HOURS_BEFORE).
+    As previsões são agrupadas por ônibus e janela, e cada grupo é resolvido de forma vetorizada.
+    indexed_previsoes é uma lista de (posição da previsão, previsão); position_errors / time_errors_sec são
+    dicionários posição da previsão -> erro, preenchidos in-place.
+    """
+    if trajectory_index is None:
+        trajectory_index = CURRENT_TEST_DAY_TRAJECTORY_INDEX
+    if eval_hours_before is None:
+        eval_hours_before = EVAL_HOURS_BEFORE
+
+    groups = {}
+    for pred_position, pred in indexed_previsoes:
+        original_query = queries_by_id[pred[0]]
+        query_datetime = _query_reference_datetime(original_query)
+        eval_start_window = (query_datetime - timedelta(hours=eval_hours_before)).replace(minute=0, second=0, microsecond=0)
+        group_key = (original_query['ordem'], original_query['linha'],
+                     _datetime_to_ms(eval_start_window, round_up=True), _datetime_to_ms(query_datetime))
+        groups.setdefault(group_key, []).append((pred_position, pred, original_query))
+
+    for (ordem_bus, linha_bus, start_ms, end_ms), group in groups.items():
+        trajectory = trajectory_index.get((ordem_bus, linha_bus))
+        if trajectory is None:
+            continue
+        bus_history_for_eval = slice_trajectory(trajectory, start_ms, end_ms)
+        if len(bus_history_for_eval['timestamp_ms']) == 0:
             continue
 
-        if len(pred) == 3: # Previsão de localização (id, lat, lon)
-            pred_lat, pred_lon = pred[1], pred[2]
-            
-            target_timestamp = original_query.get('datahora') 
-            if target_timestamp:
-                closest_historical_point = None
-                min_time_diff = float('inf')
-                for point in bus_history_for_eval:
-                    time_diff = abs(point['timestamp_ms'] - target_timestamp)
-                    if time_diff < min_time_diff: 
-                        min_time_diff = time_diff
-                        closest_historical_point = point
-                
-                if closest_historical_point:
-                    true_lat, true_lon = closest_historical_point['latitude'], closest_historical_point['longitude']
-                    error_dist = geodesic((pred_lat, pred_lon), (true_lat, true_lon)).meters
-                    total_pos_error += error_dist
-                    pos_predictions_count += 1
-
-        elif len(pred) == 2: # Previsão de tempo (id, timestamp)
-            pred_timestamp = pred[1]
-            target_location = {'latitude': original_query['latitude'], 'longitude': original_query['longitude']}
-
-            closest_historical_point = None
-            min_distance = float('inf')
-            
-            for point in bus_history_for_eval:
-                point_lat, point_lon = point['latitude'], point['longitude']
-                dist = geodesic((point_lat, point_lon), (target_location['latitude'], target_location['longitude'])).meters
-                if dist < min_distance:
-                    min_distance = dist
-                    closest_historical_point = point
-            
-            if closest_historical_point: 
-                true_timestamp = closest_historical_point['timestamp_ms']
-                error_time_ms = abs(pred_timestamp - true_timestamp)
-                total_time_error_sec += (error_time_ms / 1000) 
-                time_predictions_count += 1
+        location_items = [(pos, pred, q) for pos, pred, q in group if len(pred) == 3 and q.get('datahora')]
+        if location_items:
+            target_timestamps = np.array([q['datahora'] for _, _, q in location_items])
+            nearest = _nearest_in_time_indices(bus_history_for_eval['timestamp_ms'], 0, len(bus_history_for_eval['timestamp_ms']), target_timestamps)
+            errors = distancias.geodesic_meters([pred[1] for _, pred, _ in location_items], [pred[2] for _, pred, _ in location_items],
+                                                bus_history_for_eval['latitude'][nearest], bus_history_for_eval['longitude'][nearest])
+            for (pred_position, _, _), error in zip(location_items, errors):
+                position_errors[pred_position] = float(error)
+
+        time_items = [(pos, pred, q) for pos, pred, q in group if len(pred) == 2]
+        if time_items:
+            nearest, _ = find_nearest_points(
+                bus_history_for_eval['latitude'], bus_history_for_eval['longitude'],
+                [q['latitude'] for _, _, q in time_items], [q['longitude'] for _, _, q in time_items]
+            )
+            for (pred_position, pred, _), point_idx in zip(time_items, nearest):
+                if point_idx >= 0:
+                    true_timestamp = bus_history_for_eval['timestamp_ms'][point_idx]
+                    time_errors_sec[pred_position] = abs(pred[1] - int(true_timestamp)) / 1000
+
+
+def format_mvp_evaluation_report(position_errors, time_errors_sec):
+    """Monta o texto do relatório MVP a partir dos erros por previsão (somados na ordem das previsões)."""
+    evaluation_report = ["--- Relatório de Avaliação MVP (Estimado) ---"]
+    evaluation_report.append("Nota: Esta é uma avaliação interna simplificada, pois não temos um arquivo 'resposta' real para comparação direta aqui.")
+    evaluation_report.append("Os erros são calculados comparando a previsão com o ponto histórico mais próximo ou estimado na janela de dados.")
+
+    total_pos_error = 0.0 
+    for pred_position in sorted(position_errors):
+        total_pos_error += position_errors[pred_position]
+    total_time_error_sec = 0.0 
+    for pred_position in sorted(time_errors_sec):
+        total_time_error_sec += time_errors_sec[pred_position]
+    pos_predictions_count = len(position_errors)
+    time_predictions_count = len(time_errors_sec)
 
     if pos_predictions_count > 0:
         avg_pos_error = total_pos_error / pos_predictions_count
@@ -423,16 +1833,558 @@ def evaluate_predictions_mvp(previsoes, all_test_queries_list_for_eval):
     return "\n".join(evaluation_report)
 
 
+@timed('avaliacao_mvp')
+def evaluate_predictions_mvp(previsoes, all_test_queries_list_for_eval):
+    """
+    Avalia as previsões comparando-as com o histórico conhecido.
+    As previsões são agrupadas pelo dia da query; cada dia usa o índice de trajetórias daquele dia
+    (reaproveitando o que já estiver carregado) em vez de reprocessar os arquivos brutos por previsão.
+    Retorna uma string de relatório.
+    """
+    queries_by_id = {q['id']: q for q in all_test_queries_list_for_eval}
+    eval_hours_before = EVAL_HOURS_BEFORE
+
+    previsoes_by_day = {}
+    for pred_position, pred in enumerate(previsoes):
+        original_query = queries_by_id.get(pred[0])
+        if not original_query:
+            continue
+        query_day = _query_reference_datetime(original_query).replace(hour=0, minute=0, second=0, microsecond=0)
+        previsoes_by_day.setdefault(query_day, []).append((pred_position, pred))
+
+    # O dia que já está no cache é avaliado primeiro, sem recarregar
+    loaded_day = CURRENT_TEST_DAY_WINDOW[0] if CURRENT_TEST_DAY_WINDOW and CURRENT_TEST_DAY_WINDOW[1] >= eval_hours_before else None
+    ordered_days = sorted(previsoes_by_day, key=lambda day: (day != loaded_day, day))
+
+    position_errors = {}
+    time_errors_sec = {}
+    for query_day in ordered_days:
+        if query_day != loaded_day:
+            load_historical_data_for_test_day_window(query_day, hours_before=eval_hours_before)
+        accumulate_mvp_evaluation(previsoes_by_day[query_day], queries_by_id, position_errors, time_errors_sec,
+                                  eval_hours_before=eval_hours_before)
+
+    return format_mvp_evaluation_report(position_errors, time_errors_sec)
+
+
+# --- PLANEJAMENTO DE QUERIES POR ÔNIBUS ---
+# As queries de um arquivo treino (ou de um dia inteiro, QUERY_PLAN_SCOPE = 'dia') são agrupadas por
+# (ordem, linha): a trajetória de cada ônibus é buscada no índice e fatiada uma única vez, na união das
+# janelas de histórico das suas queries, e as queries de tempo e de chegada são respondidas em lote sobre
+# essa fatia. O resultado é o mesmo de buscar o histórico query a query.
+
+def plan_queries_by_bus(queries, hours_before=None):
+    """
+    Agrupa queries, dadas como pares (query, nome do arquivo treino), por ônibus (ordem, linha).
+    Para cada ônibus devolve as queries de tempo ('posicao') e de chegada ('chegada') como tuplas
+    (posição na lista, início da janela em ms, fim da janela em ms) e a união das janelas ('inicio_ms', 'fim_ms').
+    Queries que não são de nenhum dos dois tipos ficam de fora. hours_before: padrão QUERY_HOURS_BEFORE.
+    """
+    if hours_before is None:
+        hours_before = QUERY_HOURS_BEFORE
+    window_ms = hours_before * 3600 * 1000
+    plan = {}
+    for position, (query, test_filename) in enumerate(queries):
+        if 'datahora' in query and 'latitude' not in query and 'longitude' not in query:
+            kind = 'posicao'
+            end_ms = int(query['datahora'])
+            start_ms = end_ms - window_ms
+        elif 'latitude' in query and 'longitude' in query and 'datahora' not in query:
+            kind = 'chegada'
+            query_datetime = _query_reference_datetime(query, test_filename)
+            end_ms = _datetime_to_ms(query_datetime)
+            start_ms = _datetime_to_ms(query_datetime - timedelta(hours=hours_before), round_up=True)
+        else:
+            continue
+
+        bus_plan = plan.get((query['ordem'], query['linha']))
+        if bus_plan is None:
+            bus_plan = plan[(query['ordem'], query['linha'])] = {'posicao': [], 'chegada': [], 'inicio_ms': start_ms, 'fim_ms': end_ms}
+        bus_plan[kind].append((position, start_ms, end_ms))
+        bus_plan['inicio_ms'] = min(bus_plan['inicio_ms'], start_ms)
+        bus_plan['fim_ms'] = max(bus_plan['fim_ms'], end_ms)
+    return plan
+
+
+def answer_queries_by_bus(queries, hours_before=None, trajectory_index=None):
+    """
+    Responde queries (pares (query, nome do arquivo treino)) com o plano de plan_queries_by_bus.
+    Retorna as previsões na ordem das queries ([id, lat, lon] ou [id, timestamp]) e as estatísticas do
+    plano: buscas no índice e pontos de histórico fatiados com e sem o agrupamento. Queries sem histórico do
+    ônibus na janela são respondidas pelo índice da frota, quando construído.
+    """
+    if trajectory_index is None:
+        trajectory_index = CURRENT_TEST_DAY_TRAJECTORY_INDEX
+    if hours_before is None:
+        hours_before = QUERY_HOURS_BEFORE
+
+    plan = plan_queries_by_bus(queries, hours_before)
+    stats = {'onibus': len(plan), 'queries': 0, 'buscas_por_query': 0, 'buscas_agrupadas': 0,
+             'pontos_por_query': 0, 'pontos_agrupados': 0}
+    predictions = {}
+    bus_slices = {}
+    # Queries sem histórico do ônibus na janela, para o índice da frota: (posição, fim da janela em ms)
+    fleet_arrivals = []
+    fleet_locations = []
+
+    for bus_key, bus_plan in plan.items():
+        bus_queries = bus_plan['posicao'] + bus_plan['chegada']
+        stats['queries'] += len(bus_queries)
+        stats['buscas_por_query'] += len(bus_queries)
+        stats['buscas_agrupadas'] += 1
+        instrumentacao.count('queries_posicao', len(bus_plan['posicao']))
+        instrumentacao.count('queries_chegada', len(bus_plan['chegada']))
+
+        with instrumentacao.stage('busca_historico_onibus', len(bus_queries)):
+            trajectory = trajectory_index.get(bus_key)
+            if trajectory is None:
+                instrumentacao.count('historico_onibus_ausente')
+                instrumentacao.count('queries_chegada_sem_historico', len(bus_plan['chegada']))
+                fleet_arrivals.extend((position, end_ms) for position, _, end_ms in bus_plan['chegada'])
+                continue
+            bus_slice = slice_trajectory(trajectory, bus_plan['inicio_ms'], bus_plan['fim_ms'])
+            slice_timestamps = bus_slice['timestamp_ms']
+
+            # Pontos que a busca query a query teria fatiado, para o relatório do plano
+            _, starts, ends = (np.array(column, dtype=np.int64) for column in zip(*bus_queries))
+            stats['pontos_por_query'] += int((np.searchsorted(slice_timestamps, ends, side='right')
+                                              - np.searchsorted(slice_timestamps, starts, side='left')).sum())
+            stats['pontos_agrupados'] += len(slice_timestamps)
+        if len(slice_timestamps) > 0:
+            bus_slices[bus_key] = bus_slice
+
+        # Queries de chegada com a mesma janela (as de um mesmo arquivo treino) compartilham o histórico
+        arrivals_by_window = {}
+        for position, start_ms, end_ms in bus_plan['chegada']:
+            arrivals_by_window.setdefault((start_ms, end_ms), []).append(position)
+        for (start_ms, end_ms), positions in arrivals_by_window.items():
+            bus_history = slice_trajectory(bus_slice, start_ms, end_ms)
+            if len(bus_history['timestamp_ms']) == 0:
+                instrumentacao.count('historico_janela_vazia')
+                instrumentacao.count('queries_chegada_sem_historico', len(positions))
+                fleet_arrivals.extend((position, end_ms) for position in positions)
+                continue
+            timestamps = predict_arrival_times_with_route_batch(
+                bus_history,
+                [queries[position][0]['latitude'] for position in positions],
+                [queries[position][0]['longitude'] for position in positions],
+                bus_key[1]
+            )
+            for position, timestamp in zip(positions, timestamps):
+                if timestamp is not None:
+                    predictions[position] = [queries[position][0]['id'], timestamp]
+                else:
+                    fleet_arrivals.append((position, end_ms))
+
+    # Queries de tempo de todos os ônibus em um único lote, sobre as fatias já recortadas
+    time_queries = [(bus_key, position) for bus_key, bus_plan in plan.items() for position, _, _ in bus_plan['posicao']]
+    if time_queries:
+        batch_lats, batch_lons = predict_locations_batch(
+            [bus_key for bus_key, _ in time_queries],
+            [queries[position][0]['datahora'] for _, position in time_queries],
+            hours_before=hours_before,
+            trajectory_index=bus_slices
+        )
+        instrumentacao.count('queries_posicao_sem_historico', int(np.isnan(batch_lats).sum()))
+        for (_, position), pred_lat, pred_lon in zip(time_queries, batch_lats, batch_lons):
+            if not np.isnan(pred_lat) and not np.isnan(pred_lon):
+                predictions[position] = [queries[position][0]['id'], round(float(pred_lat), 5), round(float(pred_lon), 5)]
+            else:
+                fleet_locations.append(position)
+
+    stats['fallback_frota'] = answer_from_fleet_index(queries, fleet_locations, fleet_arrivals, predictions)
+
+    instrumentacao.count('historico_buscas_por_query', stats['buscas_por_query'])
+    instrumentacao.count('historico_buscas_agrupadas', stats['buscas_agrupadas'])
+    instrumentacao.count('historico_pontos_por_query', stats['pontos_por_query'])
+    instrumentacao.count('historico_pontos_agrupados', stats['pontos_agrupados'])
+    return [predictions[position] for position in sorted(predictions)], stats
+
+
+def answer_from_fleet_index(queries, location_positions, arrival_items, predictions):
+    """
+    Responde pelo índice da frota as queries sem histórico do ônibus: location_positions são posições de
+    queries de tempo e arrival_items pares (posição, instante de referência em ms) de queries de chegada.
+    Preenche predictions in-place e retorna quantas queries foram respondidas (0 sem índice).
+    """
+    if not location_positions and not arrival_items:
+        return 0
+    answered = 0
+    if location_positions:
+        lats_lons = fleet_fallback_positions([(queries[position][0]['ordem'], queries[position][0]['linha'])
+                                              for position in location_positions],
+                                             [queries[position][0]['datahora'] for position in location_positions])
+        if lats_lons is None:
+            return 0
+        for position, pred_lat, pred_lon in zip(location_positions, *lats_lons):
+            if not np.isnan(pred_lat):
+                predictions[position] = [queries[position][0]['id'], round(float(pred_lat), 5), round(float(pred_lon), 5)]
+                answered += 1
+    if arrival_items:
+        timestamps = fleet_fallback_arrival_times([queries[position][0]['linha'] for position, _ in arrival_items],
+                                                  [queries[position][0]['latitude'] for position, _ in arrival_items],
+                                                  [queries[position][0]['longitude'] for position, _ in arrival_items],
+                                                  [reference_ms for _, reference_ms in arrival_items])
+        if timestamps is None:
+            return answered
+        for (position, _), timestamp in zip(arrival_items, timestamps):
+            if not np.isnan(timestamp):
+                predictions[position] = [queries[position][0]['id'], int(timestamp)]
+                answered += 1
+    instrumentacao.count('queries_fallback_frota', answered)
+    return answered
+
+
+def format_query_plan_stats(stats):
+    """Linha de log com a economia do agrupamento por ônibus (e as queries respondidas pelo índice da frota)."""
+    saved = 1 - stats['pontos_agrupados'] / stats['pontos_por_query'] if stats['pontos_por_query'] else 0.0
+    fallback = f" {stats['fallback_frota']} queries sem histórico respondidas pelo índice da frota." if stats.get('fallback_frota') else ""
+    return (f"INFO_PLANO: {stats['queries']} queries de {stats['onibus']} ônibus; {stats['buscas_agrupadas']} buscas no índice "
+            f"em vez de {stats['buscas_por_query']}; {stats['pontos_agrupados']} pontos de histórico fatiados em vez de "
+            f"{stats['pontos_por_query']} ({saved:.1%} a menos).{fallback}")
+
+
+# --- CHECKPOINTS POR ARQUIVO TREINO ---
+# Um shard por arquivo treino: a primeira linha é o cabeçalho (assinatura do arquivo treino e da
+# configuração), as demais são as previsões, uma por linha. O shard é gravado de uma vez (arquivo
+# temporário + rename) quando as queries do arquivo terminam, então um shard existente está completo.
+
+def _checkpoint_fingerprint():
+    """
+    Identifica o que muda as previsões além do arquivo treino: linhas de interesse, compressão, dead reckoning
+    e as rotas, perfis e índice da frota construídos (nome, tamanho e mtime de cada arquivo).
+    """
+    offline_files = []
+    for folder in (ROUTES_PATH, PROFILES_PATH) + ((FLEET_INDEX_PATH,) if FLEET_FALLBACK_ENABLED else ()):
+        if os.path.isdir(folder):
+            for name in sorted(os.listdir(folder)):
+                stat = os.stat(os.path.join(folder, name))
+                offline_files.append([name, stat.st_size, stat.st_mtime_ns])
+    configuration = [CHECKPOINT_VERSION, _linhas_interesse_fingerprint(),
+                     [COMPRESSION_TOLERANCE_M, COMPRESSION_STATIONARY_RADIUS_M] if TRAJECTORY_COMPRESSION else None,
+                     _dead_reckoning_fingerprint(), offline_files]
+    return hashlib.sha1(json.dumps(configuration).encode('utf-8')).hexdigest()
+
+
+def _dead_reckoning_fingerprint():
+    if not DEAD_RECKONING_ENABLED:
+        return None
+    return [DEAD_RECKONING_WINDOW_MS, DEAD_RECKONING_MIN_DISPLACEMENT_M, DEAD_RECKONING_MAX_SPEED_MS,
+            DEAD_RECKONING_MAX_MS, DEAD_RECKONING_SNAP_TO_ROUTE]
+
+
+def checkpoint_shard_path(day_folder, test_file_path):
+    return os.path.join(CHECKPOINT_PATH, day_folder, os.path.splitext(os.path.basename(test_file_path))[0] + '.jsonl')
+
+
+def _checkpoint_header(test_file_path, fingerprint):
+    stat = os.stat(test_file_path)
+    return {'arquivo_treino': os.path.abspath(test_file_path), 'mtime_ns': stat.st_mtime_ns,
+            'tamanho': stat.st_size, 'configuracao': fingerprint}
+
+
+def read_checkpoint_shard(day_folder, test_file_path, fingerprint):
+    """Previsões gravadas para o arquivo treino, ou None se não há shard ou ele não vale mais."""
+    shard_path = checkpoint_shard_path(day_folder, test_file_path)
+    if not os.path.isfile(shard_path):
+        return None
+    try:
+        with open(shard_path, 'r', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            if any(header.get(k) != v for k, v in _checkpoint_header(test_file_path, fingerprint).items()):
+                return None
+            previsoes = [json.loads(line) for line in f if line.strip()]
+        if len(previsoes) != header.get('previsoes'):
+            return None
+        return previsoes
+    except Exception as e:
+        print(f"AVISO_CHECKPOINT: Shard inválido {shard_path}, reprocessando. Erro: {e}")
+        return None
+
+
+def write_checkpoint_shards(day_folder, queries, previsoes, fingerprint):
+    """
+    Grava um shard por arquivo treino presente em queries (pares (query, nome do arquivo treino)), inclusive
+    os que não tiveram previsão. As previsões são atribuídas ao arquivo pelo id da query.
+    """
+    file_of_query_id = {query['id']: query['id_arquivo_teste'] for query, _ in queries}
+    previsoes_by_file = {query['id_arquivo_teste']: [] for query, _ in queries}
+    for previsao in previsoes:
+        previsoes_by_file[file_of_query_id[previsao[0]]].append(previsao)
+
+    for test_file_path, file_previsoes in previsoes_by_file.items():
+        shard_path = checkpoint_shard_path(day_folder, test_file_path)
+        try:
+            os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+            header = dict(_checkpoint_header(test_file_path, fingerprint), previsoes=len(file_previsoes))
+            with open(shard_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(json.dumps(header, ensure_ascii=False) + '\n')
+                for previsao in file_previsoes:
+                    f.write(json.dumps(previsao, ensure_ascii=False) + '\n')
+            os.replace(shard_path + '.tmp', shard_path)
+        except Exception as e:
+            print(f"AVISO_CHECKPOINT: Não foi possível gravar o shard de {os.path.basename(test_file_path)}: {e}")
+
+
+def write_response_file(file_path, previsoes, datahora):
+    """
+    Grava o resposta.json em streaming, previsão a previsão, no mesmo formato de json.dump(..., indent=2)
+    (o mesmo arquivo, byte a byte), sem montar o documento em memória. A gravação é atômica (temporário + rename).
+    """
+    with open(file_path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write('{\n')
+        f.write(f'  "aluno": {json.dumps(ALUNO_NOME, ensure_ascii=False)},\n')
+        f.write(f'  "datahora": {json.dumps(datahora, ensure_ascii=False)},\n')
+        f.write('  "previsoes": [')
+        separator = '\n'
+        for previsao in previsoes:
+            f.write(separator + '    [\n      ' + ',\n      '.join(json.dumps(value, ensure_ascii=False) for value in previsao) + '\n    ]')
+            separator = ',\n'
+        f.write('\n  ],\n' if separator == ',\n' else '],\n')
+        f.write(f'  "senha": {json.dumps(SENHA_API, ensure_ascii=False)}\n')
+        f.write('}')
+    os.replace(file_path + '.tmp', file_path)
+
+
+# --- EXECUÇÃO DOS DIAS DE TESTE ---
+def process_test_day(day_folder):
+    """
+    Processa uma pasta de teste (um dia): carrega a janela histórica do dia e responde todas as
+    queries dos arquivos treino-*.json. Retorna (previsões, queries do dia para avaliação).
+    """
+    previsoes_finais = []
+    all_test_queries_for_eval = [] 
+
+    current_test_day_path = os.path.join(BASE_DATA_PATH, 'test', day_folder)
+    
+    test_day_base_datetime = None
+    try:
+        test_day_base_datetime = datetime.strptime(day_folder, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except Exception as e:
+        print(f"  ERRO_MAIN: Não foi possível inferir data base da pasta de teste {day_folder}. Pulando. Erro: {e}")
+        return previsoes_finais, all_test_queries_for_eval
+
+    print(f"\nProcessando dados para o dia de teste: {day_folder}")
+
+    test_query_files = sorted([f for f in os.listdir(current_test_day_path) if f.startswith('treino-') and f.endswith('.json')])
+
+    # Arquivos treino já concluídos em uma execução anterior (--checkpoint) não são reprocessados
+    completed_files = {}
+    checkpoint_fingerprint = _checkpoint_fingerprint() if CHECKPOINT_ENABLED else None
+    if CHECKPOINT_ENABLED:
+        for test_filename in test_query_files:
+            shard = read_checkpoint_shard(day_folder, os.path.join(current_test_day_path, test_filename), checkpoint_fingerprint)
+            if shard is not None:
+                completed_files[test_filename] = shard
+        print(f"  INFO_CHECKPOINT: {len(completed_files)} de {len(test_query_files)} arquivos de query já concluídos.")
+
+    # PASSO 2: Pré-carregar DataFrames brutos relevantes para ESTE DIA de teste no cache de dia
+    # Esta função populará o CURRENT_TEST_DAY_DATA_CACHE para o arquivo de teste atual
+    if len(completed_files) < len(test_query_files):
+        load_historical_data_for_test_day_window(test_day_base_datetime, hours_before=QUERY_HOURS_BEFORE)
+
+    pending_queries = []
+    for test_filename in test_query_files:
+        test_file_path = os.path.join(current_test_day_path, test_filename)
+        print(f"  Processando arquivo de query: {os.path.basename(test_file_path)}")
+        
+        test_queries = load_test_queries_file(test_file_path)
+        
+        for query in test_queries:
+            query['id_arquivo_teste'] = test_file_path 
+            all_test_queries_for_eval.append(query) 
+        if test_filename in completed_files:
+            previsoes_finais.extend(completed_files[test_filename])
+        else:
+            pending_queries.extend((query, test_filename) for query in test_queries)
+
+        # Queries agrupadas por ônibus: um recorte de histórico por (ordem, linha) do arquivo (ou do dia)
+        if pending_queries and (QUERY_PLAN_SCOPE != 'dia' or test_filename == test_query_files[-1]):
+            predictions, plan_stats = answer_queries_by_bus(pending_queries, hours_before=QUERY_HOURS_BEFORE)
+            previsoes_finais.extend(predictions)
+            print(f"  {format_query_plan_stats(plan_stats)}")
+            if CHECKPOINT_ENABLED:
+                write_checkpoint_shards(day_folder, pending_queries, predictions, checkpoint_fingerprint)
+            pending_queries = []
+
+    return previsoes_finais, all_test_queries_for_eval
+
+
+# Configurações do processo principal repassadas aos workers de run_test_days (que podem ter sido
+# alteradas por flags ou pelo arquivo de configuração do cli.py)
+PARALLEL_WORKER_SETTINGS = [
+    'BASE_DATA_PATH', 'LINHAS_INTERESSE', 'QUERY_HOURS_BEFORE', 'EVAL_HOURS_BEFORE', 'LOG_EACH_FILE', 'QUERY_PLAN_SCOPE',
+    'TRAJECTORY_COMPRESSION', 'COMPRESSION_TOLERANCE_M', 'COMPRESSION_STATIONARY_RADIUS_M', 'CHECKPOINT_ENABLED',
+    'DEAD_RECKONING_ENABLED', 'FLEET_FALLBACK_ENABLED', 'CACHE_PATH', 'CHECKPOINT_PATH', 'HISTORICAL_MANIFEST_PATH',
+    'ROUTES_PATH', 'PROFILES_PATH', 'FLEET_INDEX_PATH', 'PREPROCESSED_CACHE_PATH',
+]
+
+
+def _init_parallel_worker(historical_path_cache, profile_enabled=False, settings=None):
+    """
+    Inicializa um processo worker com o cache de caminhos já construído pelo processo principal e os
+    valores de PARALLEL_WORKER_SETTINGS do processo principal.
+    """
+    globals().update(settings or {})
+    HISTORICAL_RAW_FILE_PATH_CACHE.clear()
+    HISTORICAL_RAW_FILE_PATH_CACHE.update(historical_path_cache)
+    instrumentacao.enable(profile_enabled)
+    instrumentacao.reset()
+
+
+def _process_test_day_in_worker(day_folder):
+    """process_test_day em um worker; devolve também as medições da instrumentação e da compressão desse dia."""
+    instrumentacao.reset()
+    COMPRESSION_STATS.update(compressao.new_compression_stats())
+    return process_test_day(day_folder), instrumentacao.snapshot(), dict(COMPRESSION_STATS)
+
+
+def _test_day_datetime(day_folder):
+    try:
+        return datetime.strptime(day_folder, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def _run_test_days_with_prefetch(test_days_folders):
+    """
+    Processa os dias em sequência; enquanto as queries de um dia são previstas, o HourPrefetcher já
+    pré-processa as horas da janela do dia seguinte que não são compartilhadas com o dia atual.
+    """
+    global HOUR_PREFETCHER
+    HOUR_PREFETCHER = HourPrefetcher(workers=PREFETCH_WORKERS)
+    day_results = []
+    batch = None
+    try:
+        for position, day_folder in enumerate(test_days_folders):
+            next_day = _test_day_datetime(test_days_folders[position + 1]) if position + 1 < len(test_days_folders) else None
+            next_batch = None
+            if next_day is not None:
+                current_day = _test_day_datetime(day_folder)
+                current_files = set(historical_files_for_day_window(current_day, QUERY_HOURS_BEFORE)) if current_day is not None else set()
+                next_batch = HOUR_PREFETCHER.prefetch([path for path in historical_files_for_day_window(next_day, QUERY_HOURS_BEFORE) if path not in current_files])
+            day_results.append(process_test_day(day_folder))
+            if batch is not None:
+                # O que foi pré-carregado para este dia e não foi usado (ex.: arquivos já feitos no checkpoint) libera as vagas
+                HOUR_PREFETCHER.discard(batch)
+            batch = next_batch
+    finally:
+        HOUR_PREFETCHER.close()
+        HOUR_PREFETCHER = None
+    return day_results
+
+
+def run_test_days(test_days_folders, workers=1):
+    """
+    Processa as pastas de teste em sequência (workers=1) ou distribuídas entre processos.
+    Em sequência, com PREFETCH_WORKERS > 0, a carga das horas do dia seguinte acontece em paralelo com as
+    previsões do dia atual. Cada processo tem seus próprios caches de dia. As previsões de todos os dias
+    são unidas e ordenadas por id, então o resultado não depende do número de workers.
+    """
+    if workers <= 1 and PREFETCH_WORKERS > 0 and len(test_days_folders) > 1:
+        day_results = _run_test_days_with_prefetch(test_days_folders)
+    elif workers <= 1:
+        day_results = [process_test_day(day_folder) for day_folder in test_days_folders]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_parallel_worker,
+                                 initargs=(dict(HISTORICAL_RAW_FILE_PATH_CACHE), instrumentacao.ENABLED,
+                                           {name: globals()[name] for name in PARALLEL_WORKER_SETTINGS})) as executor:
+            day_results = []
+            for day_result, worker_measurements, worker_compression in executor.map(_process_test_day_in_worker, test_days_folders):
+                day_results.append(day_result)
+                instrumentacao.merge(worker_measurements)
+                for name, value in worker_compression.items():
+                    COMPRESSION_STATS[name] += value
+
+    previsoes_finais = []
+    all_test_queries_for_eval = []
+    for day_previsoes, day_queries in day_results:
+        previsoes_finais.extend(day_previsoes)
+        all_test_queries_for_eval.extend(day_queries)
+    previsoes_finais.sort(key=lambda pred: pred[0])
+    return previsoes_finais, all_test_queries_for_eval
+
+
 # --- INÍCIO DO SCRIPT PRINCIPAL ---
-if __name__ == "__main__":
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Gera o resposta.json com as previsões para as pastas de teste.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Número de processos para processar os dias de teste em paralelo (padrão: 1).")
+    parser.add_argument('--build-routes', action='store_true',
+                        help="Estágio offline: constrói as rotas de referência por linha a partir do histórico e sai.")
+    parser.add_argument('--build-profiles', action='store_true',
+                        help="Estágio offline: constrói os perfis de tempo de viagem por linha (requer rotas) e sai.")
+    parser.add_argument('--profile', action='store_true',
+                        help=f"Mede o tempo de cada etapa e conta registros, acertos de cache e queries sem histórico; "
+                             f"grava '{PROFILE_REPORT_FILE}' e imprime a tabela no final.")
+    parser.add_argument('--profile-flamegraph', action='store_true',
+                        help=f"Com --profile, amostra as pilhas durante a execução e grava '{PROFILE_FLAMEGRAPH_FILE}' "
+                             f"e '{PROFILE_COLLAPSED_STACKS_FILE}' (formato collapsed).")
+    parser.add_argument('--prefetch-workers', type=int, default=PREFETCH_WORKERS,
+                        help=f"Threads que pré-carregam as horas do próximo dia de teste durante as previsões do atual; "
+                             f"0 desliga (padrão: {PREFETCH_WORKERS}).")
+    parser.add_argument('--query-plan-scope', choices=['arquivo', 'dia'], default=QUERY_PLAN_SCOPE,
+                        help=f"Agrupa as queries por ônibus em cada arquivo treino ou no dia inteiro (padrão: {QUERY_PLAN_SCOPE}).")
+    parser.add_argument('--compress', action='store_true',
+                        help="Comprime as trajetórias na ingestão (duplicatas, pings parados e Douglas-Peucker temporal).")
+    parser.add_argument('--compression-tolerance-m', type=float, default=COMPRESSION_TOLERANCE_M,
+                        help=f"Tolerância em metros do Douglas-Peucker temporal de --compress (padrão: {COMPRESSION_TOLERANCE_M}).")
+    parser.add_argument('--build-fleet-index', action='store_true',
+                        help=f"Constrói o índice histórico da frota por (linha, dia da semana, hora) em '{FLEET_INDEX_PATH}' e sai.")
+    parser.add_argument('--no-fleet-fallback', action='store_true',
+                        help="Não usa o índice da frota para as queries sem histórico do ônibus (ficam sem previsão).")
+    parser.add_argument('--no-dead-reckoning', action='store_true',
+                        help="Desliga a extrapolação por dead reckoning das queries posteriores ao último ping "
+                             "(sem perfil aplicável, a previsão volta a ser o último ping).")
+    parser.add_argument('--checkpoint', action='store_true',
+                        help=f"Grava as previsões de cada arquivo treino concluído em '{CHECKPOINT_PATH}' e, ao reexecutar, "
+                             f"pula os arquivos já concluídos.")
+    parser.add_argument('--reset-checkpoints', action='store_true',
+                        help="Apaga os checkpoints antes de começar (com --checkpoint, reprocessa tudo).")
+    parser.add_argument('--quiet', action='store_true',
+                        help="Omite as mensagens por arquivo horário (INFO_LOADED_FILE, INFO_MEMORY).")
+    return parser
+
+
+def run(args):
+    """Execução completa (argumentos de build_arg_parser): previsões, resposta.json e avaliação interna."""
+    global LOG_EACH_FILE, PREFETCH_WORKERS, QUERY_PLAN_SCOPE, TRAJECTORY_COMPRESSION, COMPRESSION_TOLERANCE_M, CHECKPOINT_ENABLED
+    global DEAD_RECKONING_ENABLED, FLEET_FALLBACK_ENABLED
+    if args.quiet:
+        LOG_EACH_FILE = False
+    PREFETCH_WORKERS = args.prefetch_workers
+    QUERY_PLAN_SCOPE = args.query_plan_scope
+    TRAJECTORY_COMPRESSION = args.compress
+    COMPRESSION_TOLERANCE_M = args.compression_tolerance_m
+    CHECKPOINT_ENABLED = args.checkpoint
+    if args.no_dead_reckoning:
+        DEAD_RECKONING_ENABLED = False
+    if args.no_fleet_fallback:
+        FLEET_FALLBACK_ENABLED = False
+    if args.reset_checkpoints and os.path.isdir(CHECKPOINT_PATH):
+        shutil.rmtree(CHECKPOINT_PATH)
+    run_start = time.perf_counter()
+    sampling_profiler = None
+    if args.profile or args.profile_flamegraph:
+        instrumentacao.enable()
+        if args.profile_flamegraph:
+            sampling_profiler = instrumentacao.SamplingProfiler().start()
+
     print("Iniciando o processamento principal...")
 
     # PASSO 1: Construir o cache de caminhos de arquivos históricos (de toda a pasta historical/)
     latest_hist_date = build_historical_file_path_cache(os.path.join(BASE_DATA_PATH, 'historical'))
 
-    previsoes_finais = []
-    all_test_queries_for_eval = [] 
-    
+    if args.build_routes or args.build_profiles or args.build_fleet_index:
+        if args.build_routes:
+            build_route_geometries()
+        if args.build_profiles:
+            build_travel_time_profiles()
+        if args.build_fleet_index:
+            build_fleet_index()
+        save_historical_manifest()
+        return
+
     test_days_folders = sorted([d for d in os.listdir(os.path.join(BASE_DATA_PATH, 'test')) if os.path.isdir(os.path.join(BASE_DATA_PATH, 'test', d))])
 
     # AVISO: VERIFICAÇÃO CRÍTICA DE DADOS
@@ -444,84 +2396,19 @@ if __name__ == "__main__":
             print(f"Os testes começam em {earliest_test_date.strftime('%Y-%m-%d')}.")
             print("Não há sobreposição de datas. O modelo não encontrará histórico para as previsões.")
             print("Por favor, adicione arquivos de dados históricos na pasta 'data/historical/' para cobrir as datas dos seus testes.")
-            exit() 
-
+            return
 
-    for day_folder in test_days_folders:
-        current_test_day_path = os.path.join(BASE_DATA_PATH, 'test', day_folder)
-        
-        test_day_base_datetime = None
-        try:
-            test_day_base_datetime = datetime.strptime(day_folder, "%Y-%m-%d").replace(tzinfo=timezone.utc)
-        except Exception as e:
-            print(f"  ERRO_MAIN: Não foi possível inferir data base da pasta de teste {day_folder}. Pulando. Erro: {e}")
-            continue
-
-        print(f"\nProcessando dados para o dia de teste: {day_folder}")
 
-        # PASSO 2: Pré-carregar DataFrames brutos relevantes para ESTE DIA de teste no cache de dia
-        # Esta função populará o CURRENT_TEST_DAY_DATA_CACHE para o arquivo de teste atual
-        # Aumentei a janela de busca para a carga inicial para 5 horas
-        load_historical_data_for_test_day_window(test_day_base_datetime, hours_before=5) 
+    previsoes_finais, all_test_queries_for_eval = run_test_days(test_days_folders, workers=args.workers)
 
-        test_query_files = sorted([f for f in os.listdir(current_test_day_path) if f.startswith('treino-') and f.endswith('.json')])
+    # Persiste as estatísticas por arquivo (registros, timestamps) coletadas durante a carga
+    save_historical_manifest()
 
-        for test_filename in test_query_files:
-            test_file_path = os.path.join(current_test_day_path, test_filename)
-            print(f"  Processando arquivo de query: {os.path.basename(test_file_path)}")
-            
-            test_queries = load_test_queries_file(test_file_path)
-            
-            for query in test_queries:
-                query['id_arquivo_teste'] = test_file_path 
-                all_test_queries_for_eval.append(query) 
-
-            for query in test_queries:
-                query_id = query['id']
-                ordem_bus = query['ordem']
-                linha_bus = query['linha']
-                query_datetime = query.get('datahora_dt') 
-
-                if query_datetime is None:
-                    try:
-                        parts = os.path.splitext(os.path.basename(test_filename))[0].split('_') 
-                        date_part = parts[0].replace('treino-', '') 
-                        hour_part = parts[1]
-                        query_datetime = datetime.strptime(f"{date_part}_{hour_part}", "%Y-%m-%d_%H").replace(tzinfo=timezone.utc)
-                    except Exception as e:
-                        query_datetime = datetime.now(timezone.utc)
-
-                bus_history = get_recent_historical_data_for_query_from_cache(
-                    ordem_bus, linha_bus, query_datetime, hours_before=5
-                ) 
-                
-                if not bus_history:
-                    continue 
-                
-                if 'datahora' in query and 'latitude' not in query and 'longitude' not in query:
-                    target_timestamp_ms = query['datahora']
-                    pred_lat, pred_lon = predict_location(bus_history, target_timestamp_ms)
-                    
-                    if pred_lat is not None and pred_lon is not None:
-                        previsoes_finais.append([query_id, round(pred_lat, 5), round(pred_lon, 5)])
-
-                elif 'latitude' in query and 'longitude' in query and 'datahora' not in query:
-                    target_location = {'latitude': query['latitude'], 'longitude': query['longitude']}
-                    pred_timestamp = predict_arrival_time(bus_history, target_location)
-                    
-                    if pred_timestamp is not None:
-                        previsoes_finais.append([query_id, pred_timestamp])
+    if TRAJECTORY_COMPRESSION:
+        print(f"\nINFO_COMPRESSION: Horas carregadas na execução: {compressao.format_compression_stats(COMPRESSION_STATS)}.")
 
     # --- GERAÇÃO DO ARQUIVO resposta.json ---
-    final_response = {
-        "aluno": ALUNO_NOME,
-        "datahora": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC"), 
-        "previsoes": previsoes_finais,
-        "senha": SENHA_API
-    }
-
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(final_response, f, ensure_ascii=False, indent=2)
+    write_response_file(OUTPUT_FILE, previsoes_finais, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC"))
 
     print(f"\nArquivo '{OUTPUT_FILE}' gerado com sucesso! Total de previsões: {len(previsoes_finais)}")
     print("Previsões geradas (primeiras 5):")
@@ -539,6 +2426,17 @@ if __name__ == "__main__":
     print(f"Relatório de avaliação salvo em '{EVAL_REPORT_FILE}'.")
     print(evaluation_report_str)
 
+    if instrumentacao.ENABLED:
+        total_seconds = time.perf_counter() - run_start
+        instrumentacao.write_report(PROFILE_REPORT_FILE, total_seconds)
+        print("\n" + instrumentacao.format_report(total_seconds=total_seconds))
+        print(f"Perfil de execução salvo em '{PROFILE_REPORT_FILE}'.")
+        if sampling_profiler is not None:
+            sampling_profiler.stop()
+            sampling_profiler.write_collapsed(PROFILE_COLLAPSED_STACKS_FILE)
+            sampling_profiler.write_flamegraph_svg(PROFILE_FLAMEGRAPH_FILE)
+            print(f"Flamegraph ({sampling_profiler.samples} amostras) salvo em '{PROFILE_FLAMEGRAPH_FILE}' e '{PROFILE_COLLAPSED_STACKS_FILE}'.")
+
 
     # --- INSTRUÇÕES PARA ENVIO À API ---
     print("\n--- PRÓXIMO PASSO: ENVIAR O ARQUIVO PARA A API ---")
@@ -549,4 +2447,8 @@ if __name__ == "__main__":
     print(f"  -H 'Content-Type: application/json' \\")
     print(f"  -d @{OUTPUT_FILE}")
     print("\nCertifique-se de que o 'resposta.json' esteja na mesma pasta onde você executa o 'curl'.")
-    print("Boa sorte com o trabalho!")
\ No newline at end of file
+    print("Boa sorte com o trabalho!")
+
+
+if __name__ == "__main__":
+    run(build_arg_parser().parse_args())
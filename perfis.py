@@ -0,0 +1,186 @@
+import numpy as np
+
+import rotas
+
+# --- PERFIS DE TEMPO DE VIAGEM POR LINHA ---
+# Um perfil resume o histórico de uma linha em tabelas compactas indexadas por (dia da semana, hora do dia,
+# trecho da rota). Os trechos são intervalos de PROFILE_BIN_M metros da distância acumulada da rota
+# (rotas.py). Para cada célula guarda-se a velocidade típica de avanço ao longo da rota e, a partir dela,
+# o tempo acumulado de viagem do início da rota até cada borda de trecho; assim o tempo entre dois pontos
+# da rota (ou a distância percorrida em um dado tempo) sai de uma consulta à tabela, sem varrer o histórico.
+
+PROFILE_BIN_M = 500.0
+
+# Amostras mínimas para uma célula (dia, hora, trecho) ser usada diretamente; abaixo disso vale o agregado
+PROFILE_MIN_SAMPLES = 3
+
+# Passos entre pings consecutivos considerados na medição do avanço
+PROFILE_MAX_STEP_MS = 5 * 60 * 1000
+PROFILE_MAX_SPEED_MS = 25.0
+
+# Velocidade usada quando a linha não tem nenhuma amostra
+PROFILE_DEFAULT_SPEED_MS = 5.0
+
+HOURS_PER_DAY = 24
+DAYS_PER_WEEK = 7
+
+
+def profile_bin_edges(route, bin_m=PROFILE_BIN_M):
+    """Bordas (em metros ao longo da rota) dos trechos do perfil; o último trecho termina no fim da rota."""
+    length = rotas.route_length(route)
+    n_bins = max(1, int(np.ceil(length / bin_m)))
+    return np.minimum(np.arange(n_bins + 1) * bin_m, length)
+
+
+def weekday_and_hour(timestamps_ms):
+    """Dia da semana (segunda=0, como datetime.weekday) e hora do dia (UTC) de timestamps em ms."""
+    timestamps_ms = np.asarray(timestamps_ms, dtype=np.int64)
+    days = timestamps_ms // (24 * 3600 * 1000)
+    # 1970-01-01 foi uma quinta-feira (weekday 3)
+    return (days + 3) % DAYS_PER_WEEK, (timestamps_ms // (3600 * 1000)) % HOURS_PER_DAY
+
+
+def new_profile_accumulator(route, bin_m=PROFILE_BIN_M):
+    """Somatórios vazios de um perfil: distância e tempo de avanço medidos e velocidade reportada, por célula."""
+    n_bins = len(profile_bin_edges(route, bin_m)) - 1
+    shape = (DAYS_PER_WEEK, HOURS_PER_DAY, n_bins)
+    return {
+        'bin_m': bin_m,
+        'distancia_m': np.zeros(shape),
+        'tempo_s': np.zeros(shape),
+        'amostras': np.zeros(shape, dtype=np.int64),
+        'velocidade_reportada_soma': np.zeros(shape),
+        'velocidade_reportada_amostras': np.zeros(shape, dtype=np.int64),
+    }
+
+
+def accumulate_trajectory(accumulator, route, timestamps_ms, lats, lons, speeds_kmh, max_snap_distance_m):
+    """
+    Soma ao perfil a trajetória de um ônibus (arrays ordenados no tempo). Cada par de pings consecutivos na
+    rota contribui com o avanço ao longo dela e o tempo decorrido, na célula do primeiro ping; a velocidade
+    reportada (velocidade, km/h) de cada ping na rota é somada à parte.
+    """
+    lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+    along, snap_distance = rotas.project_onto_route(route, lats, lons, np.r_[lats[:1], lats[:-1]], np.r_[lons[:1], lons[:-1]])
+    on_route = snap_distance <= max_snap_distance_m
+    if not on_route.any():
+        return
+
+    timestamps_ms = np.asarray(timestamps_ms, dtype=np.int64)[on_route]
+    along = along[on_route]
+    speeds_kmh = np.asarray(speeds_kmh, dtype=np.float64)[on_route]
+    n_bins = accumulator['amostras'].shape[2]
+    bins = np.minimum((along // accumulator['bin_m']).astype(np.int64), n_bins - 1)
+    weekdays, hours = weekday_and_hour(timestamps_ms)
+
+    reported = speeds_kmh > 0
+    np.add.at(accumulator['velocidade_reportada_soma'], (weekdays[reported], hours[reported], bins[reported]), speeds_kmh[reported] / 3.6)
+    np.add.at(accumulator['velocidade_reportada_amostras'], (weekdays[reported], hours[reported], bins[reported]), 1)
+
+    if len(timestamps_ms) < 2:
+        return
+    steps_m = rotas.forward_distance(route, along[:-1], along[1:])
+    elapsed_s = np.diff(timestamps_ms) / 1000
+    with np.errstate(invalid='ignore', divide='ignore'):
+        valid = ((elapsed_s > 0) & (elapsed_s * 1000 <= PROFILE_MAX_STEP_MS) & ~np.isnan(steps_m)
+                 & (steps_m < rotas.route_length(route) / 2) & (steps_m / elapsed_s <= PROFILE_MAX_SPEED_MS))
+    cell = (weekdays[:-1][valid], hours[:-1][valid], bins[:-1][valid])
+    np.add.at(accumulator['distancia_m'], cell, steps_m[valid])
+    np.add.at(accumulator['tempo_s'], cell, elapsed_s[valid])
+    np.add.at(accumulator['amostras'], cell, 1)
+
+
+def _speed_where_enough(distance_m, time_s, samples):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where((samples >= PROFILE_MIN_SAMPLES) & (distance_m > 0) & (time_s > 0), distance_m / time_s, np.nan)
+
+
+def finalize_profile(accumulator, route):
+    """
+    Converte os somatórios em tabelas de consulta. A velocidade de cada célula vem, em ordem de preferência:
+    do avanço medido na célula, da velocidade reportada na célula, do avanço medido no trecho naquela hora
+    (qualquer dia), no trecho (qualquer hora), na linha inteira, ou PROFILE_DEFAULT_SPEED_MS.
+    """
+    distance_m, time_s, samples = accumulator['distancia_m'], accumulator['tempo_s'], accumulator['amostras']
+    speed = _speed_where_enough(distance_m, time_s, samples)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        reported = np.where(accumulator['velocidade_reportada_amostras'] >= PROFILE_MIN_SAMPLES,
+                            accumulator['velocidade_reportada_soma'] / accumulator['velocidade_reportada_amostras'], np.nan)
+    by_hour = _speed_where_enough(distance_m.sum(axis=0), time_s.sum(axis=0), samples.sum(axis=0))[np.newaxis]
+    by_bin = _speed_where_enough(distance_m.sum(axis=(0, 1)), time_s.sum(axis=(0, 1)), samples.sum(axis=(0, 1)))[np.newaxis, np.newaxis]
+    overall = _speed_where_enough(distance_m.sum(), time_s.sum(), samples.sum())
+    for fallback in (reported, by_hour, by_bin, overall, PROFILE_DEFAULT_SPEED_MS):
+        speed = np.where(np.isnan(speed), fallback, speed)
+
+    edges = profile_bin_edges(route, accumulator['bin_m'])
+    bin_times = np.diff(edges) / speed
+    cumulative_time = np.concatenate([np.zeros(speed.shape[:2] + (1,)), np.cumsum(bin_times, axis=2)], axis=2)
+    return {
+        'bordas_m': edges,
+        'velocidade_ms': speed.astype(np.float32),
+        'tempo_acumulado_s': cumulative_time,
+        'amostras': samples.astype(np.uint32),
+        'fechada': np.array(bool(route['fechada'])),
+    }
+
+
+def _time_at(profile, along, weekdays, hours):
+    """Tempo acumulado (s) desde o início da rota até 'along', na tabela de (dia, hora) de cada ponto."""
+    edges = profile['bordas_m']
+    along = np.clip(along, 0.0, edges[-1])
+    k = np.clip(np.searchsorted(edges, along, side='right') - 1, 0, len(edges) - 2)
+    rows = profile['tempo_acumulado_s'][weekdays, hours]
+    t0 = np.take_along_axis(rows, k[:, np.newaxis], axis=1)[:, 0]
+    t1 = np.take_along_axis(rows, k[:, np.newaxis] + 1, axis=1)[:, 0]
+    width = edges[k + 1] - edges[k]
+    fraction = np.where(width > 0, (along - edges[k]) / np.where(width > 0, width, 1.0), 0.0)
+    return t0 + fraction * (t1 - t0), rows
+
+
+def travel_time_s(profile, along_from, along_to, timestamps_ms):
+    """
+    Tempo típico de viagem (s) de along_from até along_to ao longo da rota, partindo nos instantes dados.
+    Em rotas fechadas dá a volta; em rotas abertas é NaN quando o destino já ficou para trás.
+    """
+    along_from = np.atleast_1d(np.asarray(along_from, dtype=np.float64))
+    along_to = np.atleast_1d(np.asarray(along_to, dtype=np.float64))
+    weekdays, hours = weekday_and_hour(np.atleast_1d(timestamps_ms))
+    time_from, rows = _time_at(profile, along_from, weekdays, hours)
+    time_to, _ = _time_at(profile, along_to, weekdays, hours)
+    delta = time_to - time_from
+    if bool(profile['fechada']):
+        return np.where(delta >= 0, delta, delta + rows[:, -1])
+    return np.where(along_to >= along_from, delta, np.nan)
+
+
+def distance_after_s(profile, along_from, elapsed_s, timestamps_ms):
+    """
+    Posição ao longo da rota (m) alcançada depois de elapsed_s segundos partindo de along_from nos instantes
+    dados, segundo o perfil. Em rotas fechadas dá a volta; em rotas abertas para no fim da rota.
+    """
+    along_from = np.atleast_1d(np.asarray(along_from, dtype=np.float64))
+    elapsed_s = np.atleast_1d(np.asarray(elapsed_s, dtype=np.float64))
+    weekdays, hours = weekday_and_hour(np.atleast_1d(timestamps_ms))
+    time_from, rows = _time_at(profile, along_from, weekdays, hours)
+    total = rows[:, -1]
+    target_time = time_from + elapsed_s
+    if bool(profile['fechada']):
+        target_time = np.mod(target_time, total)
+    else:
+        target_time = np.minimum(target_time, total)
+
+    edges = profile['bordas_m']
+    k = np.clip((rows <= target_time[:, np.newaxis]).sum(axis=1) - 1, 0, len(edges) - 2)
+    t0 = np.take_along_axis(rows, k[:, np.newaxis], axis=1)[:, 0]
+    t1 = np.take_along_axis(rows, k[:, np.newaxis] + 1, axis=1)[:, 0]
+    fraction = np.where(t1 > t0, (target_time - t0) / np.where(t1 > t0, t1 - t0, 1.0), 0.0)
+    return edges[k] + fraction * (edges[k + 1] - edges[k])
+
+
+def save_profile(profile, file_path):
+    rotas.save_arrays(profile, file_path)
+
+
+def load_profile(file_path):
+    return rotas.load_arrays(file_path)
@@ -0,0 +1,315 @@
+import os
+import numpy as np
+
+import distancias
+
+# --- GEOMETRIA DE ROTAS POR LINHA ---
+# Uma rota é uma polilinha de referência (um ciclo completo de um ônibus da linha), guardada como um
+# dicionário de arrays NumPy: vértices (lat/lon e x/y em metros num plano local), distância acumulada
+# ao longo da rota e um índice espacial em grade sobre os segmentos (formato CSR: chaves de célula
+# ordenadas + offsets + ids de segmento), que permite projetar um ponto na rota em O(log n).
+
+EARTH_RADIUS_M = distancias.EARTH_RADIUS_M
+
+# Distância mínima entre vértices consecutivos da rota (pings mais próximos que isso são descartados)
+ROUTE_MIN_SPACING_M = 30.0
+
+# Um ciclo fecha quando o ônibus volta a menos de ROUTE_CLOSE_RADIUS_M do início, no mesmo sentido,
+# depois de ter percorrido pelo menos ROUTE_MIN_CYCLE_LENGTH_M
+ROUTE_CLOSE_RADIUS_M = 150.0
+ROUTE_MIN_CYCLE_LENGTH_M = 2000.0
+
+# Lado da célula da grade do índice espacial de segmentos
+ROUTE_GRID_CELL_M = 250.0
+
+# Rotas de ida e volta passam duas vezes pela mesma rua: segmentos até ROUTE_DIRECTION_TOLERANCE_M mais
+# longe que o mais próximo também são candidatos, e o sentido de movimento decide entre eles
+ROUTE_DIRECTION_TOLERANCE_M = 30.0
+
+# Pontos projetados por bloco em project_onto_route
+ROUTE_PROJECTION_CHUNK_SIZE = 50_000
+
+_GRID_KEY_OFFSET = 1 << 20
+_NEIGHBOUR_DX = np.repeat(np.arange(-1, 2), 3)
+_NEIGHBOUR_DY = np.tile(np.arange(-1, 2), 3)
+
+
+def to_local_xy(lats, lons, origin):
+    """Projeta (lat, lon) em metros num plano equiretangular centrado em origin = (lat0, lon0)."""
+    lat0, lon0 = origin
+    meters_per_rad = EARTH_RADIUS_M
+    x = np.radians(np.asarray(lons, dtype=np.float64) - lon0) * np.cos(np.radians(lat0)) * meters_per_rad
+    y = np.radians(np.asarray(lats, dtype=np.float64) - lat0) * meters_per_rad
+    return x, y
+
+
+def from_local_xy(x, y, origin):
+    """Inverso de to_local_xy."""
+    lat0, lon0 = origin
+    lats = lat0 + np.degrees(np.asarray(y, dtype=np.float64) / EARTH_RADIUS_M)
+    lons = lon0 + np.degrees(np.asarray(x, dtype=np.float64) / (EARTH_RADIUS_M * np.cos(np.radians(lat0))))
+    return lats, lons
+
+
+def extract_route_cycle(lats, lons, min_spacing_m=ROUTE_MIN_SPACING_M, close_radius_m=ROUTE_CLOSE_RADIUS_M,
+                        min_cycle_length_m=ROUTE_MIN_CYCLE_LENGTH_M):
+    """
+    A partir da trajetória de um ônibus (ordenada no tempo), extrai um ciclo completo da rota:
+    descarta pings a menos de min_spacing_m do último vértice mantido e corta a trajetória na primeira
+    volta ao ponto inicial no mesmo sentido. Retorna (lats, lons, fechada); fechada=False se o ônibus não
+    completou um ciclo (nesse caso a trajetória inteira, decimada, é usada como rota aberta).
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if len(lats) < 2:
+        return lats, lons, False
+
+    origin = (float(lats[0]), float(lons[0]))
+    x, y = to_local_xy(lats, lons, origin)
+
+    kept = [0]
+    for i in range(1, len(x)):
+        if np.hypot(x[i] - x[kept[-1]], y[i] - y[kept[-1]]) >= min_spacing_m:
+            kept.append(i)
+    kept = np.asarray(kept)
+    x, y = x[kept], y[kept]
+    if len(x) < 3:
+        return lats[kept], lons[kept], False
+
+    # Os pings são esparsos: a volta ao início é medida pela distância do ponto inicial a cada segmento
+    start_direction = np.array([x[1] - x[0], y[1] - y[0]])
+    travelled = np.r_[0.0, np.cumsum(np.hypot(np.diff(x), np.diff(y)))]
+    for i in range(1, len(x) - 1):
+        if travelled[i] < min_cycle_length_m:
+            continue
+        direction = np.array([x[i + 1] - x[i], y[i + 1] - y[i]])
+        length_sq = float(np.dot(direction, direction))
+        t = np.clip(-(x[i] * direction[0] + y[i] * direction[1]) / length_sq, 0.0, 1.0) if length_sq > 0 else 0.0
+        if np.hypot(x[i] + t * direction[0], y[i] + t * direction[1]) <= close_radius_m and np.dot(direction, start_direction) > 0:
+            return lats[kept[:i + 1]], lons[kept[:i + 1]], True
+    return lats[kept], lons[kept], False
+
+
+def _grid_key(cell_x, cell_y):
+    return (np.asarray(cell_x, dtype=np.int64) + _GRID_KEY_OFFSET) * (2 * _GRID_KEY_OFFSET) + (np.asarray(cell_y, dtype=np.int64) + _GRID_KEY_OFFSET)
+
+
+def build_route(lats, lons, closed=False, cell_m=ROUTE_GRID_CELL_M):
+    """
+    Monta a estrutura de uma rota a partir dos vértices: coordenadas locais, distância acumulada e
+    índice espacial em grade dos segmentos. Em uma rota fechada, o último vértice se liga ao primeiro.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if closed and len(lats) > 2:
+        lats = np.r_[lats, lats[0]]
+        lons = np.r_[lons, lons[0]]
+
+    origin = np.array([lats.mean(), lons.mean()])
+    x, y = to_local_xy(lats, lons, origin)
+    segment_lengths = np.hypot(np.diff(x), np.diff(y))
+    cumulative = np.r_[0.0, np.cumsum(segment_lengths)]
+
+    cell_keys, cell_segments = [], []
+    for segment in range(len(segment_lengths)):
+        min_cx, max_cx = int(np.floor(min(x[segment], x[segment + 1]) / cell_m)), int(np.floor(max(x[segment], x[segment + 1]) / cell_m))
+        min_cy, max_cy = int(np.floor(min(y[segment], y[segment + 1]) / cell_m)), int(np.floor(max(y[segment], y[segment + 1]) / cell_m))
+        for cell_x in range(min_cx, max_cx + 1):
+            for cell_y in range(min_cy, max_cy + 1):
+                cell_keys.append(int(_grid_key(cell_x, cell_y)))
+                cell_segments.append(segment)
+
+    cell_keys = np.asarray(cell_keys, dtype=np.int64)
+    cell_segments = np.asarray(cell_segments, dtype=np.int64)
+    order = np.argsort(cell_keys, kind='stable')
+    cell_keys, cell_segments = cell_keys[order], cell_segments[order]
+    unique_keys, offsets = np.unique(cell_keys, return_index=True)
+
+    return {
+        'latitude': lats,
+        'longitude': lons,
+        'x': x,
+        'y': y,
+        'origem': origin,
+        'distancia_acumulada': cumulative,
+        'fechada': np.array(bool(closed)),
+        'celula_m': np.array(float(cell_m)),
+        'grade_chaves': unique_keys,
+        'grade_offsets': np.r_[offsets, len(cell_keys)].astype(np.int64),
+        'grade_segmentos': cell_segments,
+    }
+
+
+def route_length(route):
+    return float(route['distancia_acumulada'][-1])
+
+
+def _project_onto_segments(route, px, py, segments):
+    """Projeta um ponto (px, py) nos segmentos dados; retorna arrays (distância ao longo da rota, distância à rota)."""
+    x, y, cumulative = route['x'], route['y'], route['distancia_acumulada']
+    ax, ay = x[segments], y[segments]
+    dx, dy = x[segments + 1] - ax, y[segments + 1] - ay
+    length_sq = dx * dx + dy * dy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(length_sq > 0, ((px - ax) * dx + (py - ay) * dy) / length_sq, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    distances = np.hypot(ax + t * dx - px, ay + t * dy - py)
+    return cumulative[segments] + t * np.sqrt(length_sq), distances
+
+
+def _candidate_segments(route, point_x, point_y):
+    """Segmentos registrados nas 3x3 células da grade ao redor do ponto (busca binária nas chaves); todos se nenhum."""
+    cell_m = float(route['celula_m'])
+    keys, offsets, grid_segments = route['grade_chaves'], route['grade_offsets'], route['grade_segmentos']
+    cell_x, cell_y = int(np.floor(point_x / cell_m)), int(np.floor(point_y / cell_m))
+    neighbour_keys = _grid_key(np.repeat(np.arange(cell_x - 1, cell_x + 2), 3), np.tile(np.arange(cell_y - 1, cell_y + 2), 3))
+    positions = np.searchsorted(keys, neighbour_keys)
+    found = (positions < len(keys)) & (keys[np.minimum(positions, len(keys) - 1)] == neighbour_keys)
+    candidates = [grid_segments[offsets[p]:offsets[p + 1]] for p in positions[found]]
+    return np.unique(np.concatenate(candidates)) if candidates else np.arange(len(route['x']) - 1)
+
+
+def project_onto_route(route, lats, lons, previous_lats=None, previous_lons=None):
+    """
+    Projeta pontos (lat, lon) na rota. Para cada ponto, só os segmentos registrados nas 3x3 células da
+    grade ao redor são avaliados (busca binária nas chaves da grade); se nenhum estiver por perto, todos
+    os segmentos são avaliados. Com as posições anteriores de cada ponto (previous_lats/previous_lons), entre
+    os segmentos quase tão próximos quanto o mais próximo vence o de sentido mais alinhado ao movimento.
+    Todos os pares (ponto, segmento candidato) são avaliados de uma vez, em blocos de ROUTE_PROJECTION_CHUNK_SIZE
+    pontos. Retorna (distância ao longo da rota, distância do ponto à rota), em metros.
+    """
+    px, py = to_local_xy(np.atleast_1d(lats), np.atleast_1d(lons), route['origem'])
+    if previous_lats is not None:
+        prev_x, prev_y = to_local_xy(np.atleast_1d(previous_lats), np.atleast_1d(previous_lons), route['origem'])
+        heading_x, heading_y = px - prev_x, py - prev_y
+    else:
+        heading_x, heading_y = np.zeros(len(px)), np.zeros(len(px))
+
+    along = np.full(len(px), np.nan)
+    distance = np.full(len(px), np.inf)
+    if len(route['x']) < 2:
+        return along, distance
+
+    for start in range(0, len(px), ROUTE_PROJECTION_CHUNK_SIZE):
+        chunk = slice(start, start + ROUTE_PROJECTION_CHUNK_SIZE)
+        along[chunk], distance[chunk] = _project_chunk(route, px[chunk], py[chunk], heading_x[chunk], heading_y[chunk])
+    return along, distance
+
+
+def _project_chunk(route, px, py, heading_x, heading_y):
+    x, y, cumulative = route['x'], route['y'], route['distancia_acumulada']
+    cell_m = float(route['celula_m'])
+    keys, offsets, grid_segments = route['grade_chaves'], route['grade_offsets'], route['grade_segmentos']
+    n_points = len(px)
+
+    # Chaves das 3x3 células vizinhas de cada ponto e, para as que existem na grade, o intervalo de segmentos
+    cell_x = np.floor(px / cell_m).astype(np.int64)
+    cell_y = np.floor(py / cell_m).astype(np.int64)
+    neighbour_keys = _grid_key((cell_x[:, np.newaxis] + _NEIGHBOUR_DX).ravel(), (cell_y[:, np.newaxis] + _NEIGHBOUR_DY).ravel())
+    positions = np.searchsorted(keys, neighbour_keys)
+    found = (positions < len(keys)) & (keys[np.minimum(positions, len(keys) - 1)] == neighbour_keys)
+    range_starts = np.where(found, offsets[np.minimum(positions, len(keys) - 1)], 0)
+    range_lengths = np.where(found, offsets[np.minimum(positions, len(keys) - 1) + 1] - range_starts, 0)
+
+    # Pontos sem segmento nas células vizinhas são comparados com todos os segmentos
+    point_lengths = range_lengths.reshape(n_points, 9).sum(axis=1)
+    isolated = np.flatnonzero(point_lengths == 0)
+    total_pairs = int(range_lengths.sum())
+    pair_cell = np.repeat(np.arange(len(neighbour_keys)), range_lengths)
+    within_range = np.arange(total_pairs) - np.repeat(np.cumsum(range_lengths) - range_lengths, range_lengths)
+    pair_point = np.r_[pair_cell // 9, np.repeat(isolated, len(x) - 1)]
+    pair_segment = np.r_[grid_segments[range_starts[pair_cell] + within_range], np.tile(np.arange(len(x) - 1), len(isolated))]
+
+    ax, ay = x[pair_segment], y[pair_segment]
+    dx, dy = x[pair_segment + 1] - ax, y[pair_segment + 1] - ay
+    length_sq = dx * dx + dy * dy
+    ppx, ppy = px[pair_point], py[pair_point]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(length_sq > 0, ((ppx - ax) * dx + (ppy - ay) * dy) / length_sq, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    pair_distance = np.hypot(ax + t * dx - ppx, ay + t * dy - ppy)
+    pair_along = cumulative[pair_segment] + t * np.sqrt(length_sq)
+
+    nearest = np.full(n_points, np.inf)
+    np.minimum.at(nearest, pair_point, pair_distance)
+    use_heading = (heading_x != 0) | (heading_y != 0)
+    alignment = dx * heading_x[pair_point] + dy * heading_y[pair_point]
+    near = pair_distance <= nearest[pair_point] + ROUTE_DIRECTION_TOLERANCE_M
+    heading_rank = np.where(use_heading[pair_point], np.where(near, -alignment, np.inf), 0.0)
+
+    # Por ponto: melhor alinhamento entre os segmentos próximos (com sentido) ou o mais próximo (sem sentido)
+    order = np.lexsort((pair_segment, pair_distance, heading_rank, pair_point))
+    first = order[np.r_[True, pair_point[order][1:] != pair_point[order][:-1]]]
+    along = np.full(n_points, np.nan)
+    distance = np.full(n_points, np.inf)
+    along[pair_point[first]] = pair_along[first]
+    distance[pair_point[first]] = pair_distance[first]
+    return along, distance
+
+
+def route_positions_near(route, lat, lon, max_distance_m):
+    """
+    Todas as posições ao longo da rota (m) em que ela passa a até max_distance_m do ponto, uma por passagem
+    (segmentos contíguos são agrupados). Um ponto em rua percorrida nos dois sentidos tem duas posições.
+    """
+    px, py = to_local_xy(np.atleast_1d(lat), np.atleast_1d(lon), route['origem'])
+    if len(route['x']) < 2:
+        return np.array([])
+    segments = _candidate_segments(route, px[0], py[0])
+    segment_along, segment_distance = _project_onto_segments(route, px[0], py[0], segments)
+    close = segment_distance <= max_distance_m
+    segments, segment_along, segment_distance = segments[close], segment_along[close], segment_distance[close]
+    if len(segments) == 0:
+        return np.array([])
+
+    positions = []
+    run_start = 0
+    for k in range(1, len(segments) + 1):
+        if k == len(segments) or segments[k] != segments[k - 1] + 1:
+            run = slice(run_start, k)
+            positions.append(segment_along[run][np.argmin(segment_distance[run])])
+            run_start = k
+    return np.asarray(positions)
+
+
+def position_at_distance(route, along):
+    """Posição (lat, lon) na rota a uma distância 'along' do início (com volta, se a rota for fechada)."""
+    cumulative = route['distancia_acumulada']
+    along = np.asarray(along, dtype=np.float64)
+    if bool(route['fechada']) and cumulative[-1] > 0:
+        along = np.mod(along, cumulative[-1])
+    else:
+        along = np.clip(along, 0.0, cumulative[-1])
+    return np.interp(along, cumulative, route['latitude']), np.interp(along, cumulative, route['longitude'])
+
+
+def forward_distance(route, along_from, along_to):
+    """
+    Distância a percorrer ao longo da rota de along_from até along_to. Em rotas fechadas dá a volta;
+    em rotas abertas é NaN quando o destino já ficou para trás.
+    """
+    delta = np.asarray(along_to, dtype=np.float64) - np.asarray(along_from, dtype=np.float64)
+    if bool(route['fechada']):
+        return np.mod(delta, route_length(route))
+    return np.where(delta >= 0, delta, np.nan)
+
+
+def save_arrays(arrays, file_path):
+    """Grava um dicionário de arrays em .npz de forma atômica (arquivo temporário + rename)."""
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    with open(file_path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(file_path + '.tmp', file_path)
+
+
+def load_arrays(file_path):
+    with np.load(file_path, allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
+
+
+def save_route(route, file_path):
+    save_arrays(route, file_path)
+
+
+def load_route(file_path):
+    return load_arrays(file_path)
@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import argparse
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+import main
+
+# --- SERVIÇO LOCAL DE PREVISÃO ---
+# Mantém em memória, entre requisições, o cache de caminhos, o cache LRU de horas e o índice de trajetórias
+# do dia carregado (os mesmos globais de main.py), e responde previsões em lote por HTTP no localhost.
+#
+#   POST /predict_location      {"queries": [{"id", "ordem", "linha", "datahora" (ms)}]}
+#                               -> {"previsoes": [[id, lat, lon], ...]}  (lat/lon null sem histórico)
+#   POST /predict_arrival_time  {"queries": [{"id", "ordem", "linha", "latitude", "longitude", "datahora" (ms, opcional)}]}
+#                               -> {"previsoes": [[id, timestamp_ms], ...]}  (datahora = instante de referência; padrão: agora)
+#   POST /reload                ingere na hora os arquivos novos de data/historical/
+#   GET  /metrics               latências p50/p99 por endpoint, cache de horas e janela carregada
+#   GET  /health
+#
+# A pasta de dados, os caches em disco, as linhas e as horas de histórico são as de main.py; com
+# 'python cli.py [--config ...] [--data-path ...] [--cache-path ...] serve' vêm da mesma configuração dos
+# demais comandos.
+
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+
+# Intervalo entre reescaneamentos de data/historical/ (0 desliga o recarregamento automático); arquivos
+# horários novos ficam disponíveis para consulta em até esse tempo
+HOT_RELOAD_INTERVAL_S = 15
+
+# Latências guardadas por endpoint para o cálculo dos percentis
+LATENCY_WINDOW = 10_000
+
+
+class PredictionService:
+    """
+    Estado quente do serviço. Os caches de main.py são globais e não são thread-safe, então toda previsão
+    e todo recarregamento acontecem sob o mesmo lock; as requisições em lote amortizam esse custo.
+    """
+
+    def __init__(self, base_data_path=None, hours_before=None):
+        self.base_historical_path = os.path.join(base_data_path or main.BASE_DATA_PATH, 'historical')
+        self.hours_before = hours_before if hours_before is not None else main.QUERY_HOURS_BEFORE
+        self.lock = threading.RLock()
+        self.latencies_ms = {}
+        self.request_counts = {}
+        self.query_counts = {}
+        self.error_counts = {}
+        self.file_stats = {}
+        self.started_at = time.time()
+        self.last_reload = None
+        self.last_ingest = None
+
+    def start(self):
+        with self.lock:
+            main.HISTORICAL_RAW_FILE_PATH_CACHE.clear()
+            main.build_historical_file_path_cache(self.base_historical_path)
+            self.last_reload = time.time()
+
+    # --- Janela do dia ---
+
+    def _ensure_day_loaded(self, day):
+        """Carrega a janela do dia (via cache LRU de horas) se ela não for a que já está em memória."""
+        if main.CURRENT_TEST_DAY_WINDOW != (day, self.hours_before):
+            main.load_historical_data_for_test_day_window(day, hours_before=self.hours_before)
+            self._record_file_stats()
+
+    def _record_file_stats(self):
+        for file_path in main.HOUR_DATA_LRU_CACHE:
+            if file_path not in self.file_stats and os.path.isfile(file_path):
+                stat = os.stat(file_path)
+                self.file_stats[file_path] = (stat.st_size, stat.st_mtime_ns)
+
+    def reload_historical_files(self, quiet=False):
+        """
+        Ingestão incremental (main.ingest_new_historical_files): arquivos horários novos são pré-processados e,
+        se caírem na janela carregada, anexados ao índice de trajetórias sem recarregar o dia. Arquivos já
+        carregados que foram reescritos no lugar são descartados do cache LRU e, se estiverem na janela,
+        invalidam a janela, que é recarregada na próxima consulta. Retorna o número de arquivos novos ou alterados.
+        quiet: omite as mensagens informativas de main.py (usado pelo reescaneamento periódico).
+        """
+        with self.lock:
+            ingest = main.ingest_new_historical_files(self.base_historical_path, quiet)
+            self.last_reload = time.time()
+
+            changed_paths = set()
+            for file_path, (size, mtime_ns) in list(self.file_stats.items()):
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    stat = None
+                if stat is None or (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                    changed_paths.add(file_path)
+                    del self.file_stats[file_path]
+                    main.evict_hour_file(file_path)
+            self._record_file_stats()
+
+            if ingest['novos']:
+                # Atraso entre o arquivo aparecer no disco e estar disponível para consulta
+                delays = [self.last_reload - os.stat(path).st_mtime for path in ingest['novos'] if os.path.isfile(path)]
+                self.last_ingest = {
+                    'arquivos': len(ingest['novos']),
+                    'registros_anexados': ingest['registros_anexados'],
+                    'atraso_max_s': round(max(delays), 1) if delays else None,
+                    'em': datetime.fromtimestamp(self.last_reload, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC"),
+                }
+            return len(ingest['novos']) + len(changed_paths)
+
+    # --- Previsões ---
+
+    def predict_locations(self, queries):
+        """Previsão de posição em lote; as queries são agrupadas pelo dia do instante alvo."""
+        results = [None] * len(queries)
+        by_day = {}
+        for position, query in enumerate(queries):
+            query_dt = datetime.fromtimestamp(int(query['datahora']) / 1000, tz=timezone.utc)
+            by_day.setdefault(query_dt.replace(hour=0, minute=0, second=0, microsecond=0), []).append(position)
+
+        with self.lock:
+            for day, positions in sorted(by_day.items()):
+                self._ensure_day_loaded(day)
+                lats, lons = main.predict_locations_batch(
+                    [(str(queries[i]['ordem']), str(queries[i]['linha'])) for i in positions],
+                    [int(queries[i]['datahora']) for i in positions],
+                    hours_before=self.hours_before
+                )
+                # Ônibus sem histórico na janela: posição de reserva do índice da frota, se construído
+                missing = np.flatnonzero(np.isnan(lats))
+                missing_queries = [queries[positions[k]] for k in missing]
+                fallback = main.fleet_fallback_positions([(str(q['ordem']), str(q['linha'])) for q in missing_queries],
+                                                         [int(q['datahora']) for q in missing_queries]) if len(missing) else None
+                if fallback is not None:
+                    lats[missing], lons[missing] = fallback
+                for i, lat, lon in zip(positions, lats, lons):
+                    results[i] = [queries[i].get('id'),
+                                  None if np.isnan(lat) else round(float(lat), 5),
+                                  None if np.isnan(lon) else round(float(lon), 5)]
+        return results
+
+    def predict_arrival_times(self, queries):
+        """
+        Previsão de chegada em lote pelo plano por ônibus de main.answer_queries_by_bus: as queries de um mesmo
+        ônibus e mesmo instante de referência compartilham o histórico e a projeção na rota, e as sem histórico
+        caem juntas no índice da frota.
+        """
+        now_ms = int(time.time() * 1000)
+        by_day = {}
+        for position, query in enumerate(queries):
+            reference_dt = datetime.fromtimestamp(int(query.get('datahora', now_ms)) / 1000, tz=timezone.utc)
+            # No formato de main.py: o id é a posição (para casar as respostas) e datahora_dt o instante de referência
+            planned = {'id': position, 'ordem': str(query['ordem']), 'linha': str(query['linha']),
+                       'latitude': _query_coordinate(query, 'latitude'), 'longitude': _query_coordinate(query, 'longitude'),
+                       'datahora_dt': reference_dt}
+            by_day.setdefault(reference_dt.replace(hour=0, minute=0, second=0, microsecond=0), []).append((planned, None))
+
+        results = [[query.get('id'), None] for query in queries]
+        with self.lock:
+            for day, day_queries in sorted(by_day.items()):
+                self._ensure_day_loaded(day)
+                previsoes, _ = main.answer_queries_by_bus(day_queries, hours_before=self.hours_before)
+                for position, pred_timestamp in previsoes:
+                    results[position][1] = pred_timestamp
+        return results
+
+    # --- Métricas ---
+
+    def record(self, endpoint, elapsed_ms, n_queries=0, failed=False):
+        with self.lock:
+            self.latencies_ms.setdefault(endpoint, deque(maxlen=LATENCY_WINDOW)).append(elapsed_ms)
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+            self.query_counts[endpoint] = self.query_counts.get(endpoint, 0) + n_queries
+            if failed:
+                self.error_counts[endpoint] = self.error_counts.get(endpoint, 0) + 1
+
+    def metrics(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, latencies in self.latencies_ms.items():
+                values = np.fromiter(latencies, dtype=np.float64)
+                endpoints[endpoint] = {
+                    'requisicoes': self.request_counts[endpoint],
+                    'queries': self.query_counts[endpoint],
+                    'erros': self.error_counts.get(endpoint, 0),
+                    'latencia_p50_ms': round(float(np.percentile(values, 50)), 3),
+                    'latencia_p99_ms': round(float(np.percentile(values, 99)), 3),
+                    'latencia_media_ms': round(float(values.mean()), 3),
+                }
+            window = main.CURRENT_TEST_DAY_WINDOW
+            return {
+                'endpoints': endpoints,
+                'cache_de_horas': dict(main.HOUR_CACHE_STATS, horas_em_memoria=len(main.HOUR_DATA_LRU_CACHE)),
+                'horas_mapeadas': len(main.HISTORICAL_RAW_FILE_PATH_CACHE),
+                'janela_carregada': window[0].strftime('%Y-%m-%d') if window else None,
+                'onibus_no_indice': len(main.CURRENT_TEST_DAY_TRAJECTORY_INDEX),
+                'ativo_ha_s': round(time.time() - self.started_at, 1),
+                'ultima_ingestao': self.last_ingest,
+                'ultimo_reescaneamento': datetime.fromtimestamp(self.last_reload, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC") if self.last_reload else None,
+            }
+
+
+def _query_coordinate(query, field):
+    """Coordenada de uma query, aceitando o formato dos arquivos de teste ('-22,91234') ou número."""
+    value = main._parse_coordinate(query[field])
+    if value is None:
+        raise ValueError(f"{field} inválida na query {query.get('id')}: {query[field]!r}")
+    return value
+
+
+def make_request_handler(service, verbose=False):
+    class PredictionRequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            elif self.path == '/metrics':
+                self._send_json(200, service.metrics())
+            else:
+                self._send_json(404, {'erro': f"Rota desconhecida: {self.path}"})
+
+        def do_POST(self):
+            handlers = {
+                '/predict_location': service.predict_locations,
+                '/predict_arrival_time': service.predict_arrival_times,
+            }
+            if self.path == '/reload':
+                start = time.perf_counter()
+                try:
+                    changed = service.reload_historical_files()
+                except Exception as e:
+                    service.record(self.path, (time.perf_counter() - start) * 1000, failed=True)
+                    self._send_json(500, {'erro': f"Falha ao reescanear os arquivos históricos: {e}"})
+                    return
+                service.record(self.path, (time.perf_counter() - start) * 1000)
+                self._send_json(200, {'arquivos_alterados': changed})
+                return
+            if self.path not in handlers:
+                self._send_json(404, {'erro': f"Rota desconhecida: {self.path}"})
+                return
+
+            start = time.perf_counter()
+            queries = []
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                queries = payload.get('queries', []) if isinstance(payload, dict) else payload
+                previsoes = handlers[self.path](queries)
+            except (ValueError, KeyError, TypeError, OverflowError, OSError) as e:
+                # OverflowError/OSError: datahora fora do intervalo representável (datetime.fromtimestamp)
+                service.record(self.path, (time.perf_counter() - start) * 1000, len(queries), failed=True)
+                reason = f"campo obrigatório ausente: {e}" if isinstance(e, KeyError) else str(e)
+                self._send_json(400, {'erro': f"Requisição inválida: {reason}"})
+                return
+            except Exception as e:
+                service.record(self.path, (time.perf_counter() - start) * 1000, len(queries), failed=True)
+                self._send_json(500, {'erro': f"Falha ao prever: {type(e).__name__}: {e}"})
+                return
+            service.record(self.path, (time.perf_counter() - start) * 1000, len(queries))
+            self._send_json(200, {'previsoes': previsoes})
+
+        def log_message(self, format, *args):
+            if verbose:
+                super().log_message(format, *args)
+
+    return PredictionRequestHandler
+
+
+def _hot_reload_loop(service, interval_s, stop_event):
+    while not stop_event.wait(interval_s):
+        try:
+            # O reescaneamento periódico não repete as mensagens informativas de main.py; as do serviço, sim
+            changed = service.reload_historical_files(quiet=True)
+            if changed:
+                print(f"INFO_SERVICO: {changed} arquivos históricos novos ou alterados.")
+        except Exception as e:
+            # Uma falha não pode derrubar a thread: o próximo reescaneamento tenta de novo
+            print(f"ERRO_SERVICO: Falha ao reescanear os arquivos históricos: {type(e).__name__}: {e}")
+
+
+def serve(host=SERVICE_HOST, port=SERVICE_PORT, reload_interval_s=HOT_RELOAD_INTERVAL_S, verbose=False):
+    service = PredictionService()
+    service.start()
+    server = ThreadingHTTPServer((host, port), make_request_handler(service, verbose))
+
+    stop_event = threading.Event()
+    if reload_interval_s > 0:
+        threading.Thread(target=_hot_reload_loop, args=(service, reload_interval_s, stop_event), daemon=True).start()
+
+    print(f"INFO_SERVICO: Servindo previsões em http://{host}:{port} (recarregamento a cada {reload_interval_s}s).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nINFO_SERVICO: Encerrando.")
+    finally:
+        stop_event.set()
+        server.server_close()
+        main.save_historical_manifest()
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Serviço local de previsão com caches mantidos em memória.")
+    parser.add_argument('--host', default=SERVICE_HOST, help=f"Endereço de escuta (padrão: {SERVICE_HOST}).")
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help=f"Porta (padrão: {SERVICE_PORT}).")
+    parser.add_argument('--reload-interval', type=float, default=HOT_RELOAD_INTERVAL_S,
+                        help=f"Segundos entre reescaneamentos de data/historical/; 0 desliga (padrão: {HOT_RELOAD_INTERVAL_S}).")
+    parser.add_argument('--verbose', action='store_true', help="Registra cada requisição no terminal.")
+    return parser
+
+
+def run(args):
+    serve(args.host, args.port, args.reload_interval, args.verbose)
+
+
+# --- INÍCIO DO SERVIÇO ---
+if __name__ == "__main__":
+    run(build_arg_parser().parse_args())
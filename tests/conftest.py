@@ -0,0 +1,16 @@
+import os
+import sys
+
+import numpy as np
+
+# Os módulos do projeto ficam na raiz do repositório (sem pacote)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rotas
+
+ORIGIN = (-22.90, -43.30)
+
+
+def latlon(x, y, origin=ORIGIN):
+    """Coordenadas (lat, lon) de pontos dados em metros no plano local em torno de origin."""
+    return rotas.from_local_xy(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64), origin)
@@ -0,0 +1,99 @@
+import json
+import os
+
+import pytest
+
+import main
+
+# 2024-05-13 10:00 UTC
+HOUR_START_MS = 1715594400000
+
+
+def raw_record(ordem, linha, minute, lat='-22,90000', lon='-43,30000'):
+    timestamp = str(HOUR_START_MS + minute * 60_000)
+    return {'ordem': ordem, 'latitude': lat, 'longitude': lon, 'datahora': timestamp, 'velocidade': '20',
+            'linha': linha, 'datahoraenvio': timestamp, 'datahoraservidor': timestamp}
+
+
+def write_raw_hour(path, records):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(records, f)
+
+
+@pytest.fixture
+def hour_file(tmp_path, monkeypatch):
+    """Arquivo bruto de uma hora com pings das linhas 100 e 864, e o cache em disco numa pasta temporária."""
+    monkeypatch.setattr(main, 'PREPROCESSED_CACHE_PATH', str(tmp_path / 'horas'))
+    monkeypatch.setattr(main, 'LOG_EACH_FILE', False)
+    monkeypatch.setattr(main, 'LINHAS_INTERESSE', ['100', '864'])
+    monkeypatch.setattr(main, 'TRAJECTORY_COMPRESSION', False)
+    path = str(tmp_path / '2024-05-13_10.json')
+    write_raw_hour(path, [raw_record('A1', '100', m) for m in range(5)] + [raw_record('B1', '864', m) for m in range(3)])
+    return path
+
+
+@pytest.fixture
+def preprocess_calls(monkeypatch):
+    """Conta as vezes em que o JSON bruto foi de fato processado (falta no cache em disco)."""
+    calls = []
+    original = main._preprocess_hour
+
+    def counting(file_path):
+        calls.append(file_path)
+        return original(file_path)
+
+    monkeypatch.setattr(main, '_preprocess_hour', counting)
+    return calls
+
+
+def test_second_load_reads_the_cache(hour_file, preprocess_calls):
+    first = main.load_preprocessed_raw_file(hour_file)
+    second = main.load_preprocessed_raw_file(hour_file)
+    assert len(preprocess_calls) == 1
+    assert len(first) == len(second) == 8
+    assert os.path.isfile(os.path.join(main._preprocessed_cache_dir_for(hour_file), 'timestamp_ms.npy'))
+    for col in main.PREPROCESSED_COLUMNS:
+        assert first[col].tolist() == second[col].tolist()
+
+
+def test_source_size_change_invalidates(hour_file, preprocess_calls):
+    main.load_preprocessed_raw_file(hour_file)
+    stat = os.stat(hour_file)
+    write_raw_hour(hour_file, [raw_record('A1', '100', m) for m in range(6)])
+    # Mesmo mtime: só o tamanho mudou
+    os.utime(hour_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    df = main.load_preprocessed_raw_file(hour_file)
+    assert len(preprocess_calls) == 2
+    assert len(df) == 6
+
+
+def test_source_mtime_change_invalidates(hour_file, preprocess_calls):
+    main.load_preprocessed_raw_file(hour_file)
+    stat = os.stat(hour_file)
+    os.utime(hour_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    main.load_preprocessed_raw_file(hour_file)
+    assert len(preprocess_calls) == 2
+    main.load_preprocessed_raw_file(hour_file)
+    assert len(preprocess_calls) == 2
+
+
+def test_linhas_interesse_change_invalidates(hour_file, preprocess_calls, monkeypatch):
+    assert len(main.load_preprocessed_raw_file(hour_file)) == 8
+    monkeypatch.setattr(main, 'LINHAS_INTERESSE', ['864'])
+    df = main.load_preprocessed_raw_file(hour_file)
+    assert len(preprocess_calls) == 2
+    assert set(df['linha']) == {'864'}
+
+
+def test_compression_settings_change_invalidates(hour_file, preprocess_calls, monkeypatch):
+    main.load_preprocessed_raw_file(hour_file)
+    monkeypatch.setattr(main, 'TRAJECTORY_COMPRESSION', True)
+    main.load_preprocessed_raw_file(hour_file)
+    main.load_preprocessed_raw_file(hour_file)
+    assert len(preprocess_calls) == 2
+    monkeypatch.setattr(main, 'COMPRESSION_TOLERANCE_M', main.COMPRESSION_TOLERANCE_M + 5.0)
+    main.load_preprocessed_raw_file(hour_file)
+    assert len(preprocess_calls) == 3
+    monkeypatch.setattr(main, 'COMPRESSION_STATIONARY_RADIUS_M', main.COMPRESSION_STATIONARY_RADIUS_M + 5.0)
+    main.load_preprocessed_raw_file(hour_file)
+    assert len(preprocess_calls) == 4
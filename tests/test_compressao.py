@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+import compressao
+from conftest import latlon
+
+
+def test_stationary_run_keeps_first_and_last_ping():
+    x = np.array([0.0, 1.0, 2.0, 1.0, 0.0, 100.0, 200.0])
+    keep = compressao.stationary_runs_mask(x, np.zeros(7), np.zeros(7, dtype=np.int64), radius_m=5.0)
+    assert keep.tolist() == [True, False, False, False, True, True, True]
+
+
+def test_slow_drift_is_not_stationary():
+    # Passos de 4 m (dentro do raio), mas 16 m do primeiro ping: o ônibus está andando
+    x = np.array([0.0, 4.0, 8.0, 12.0, 16.0, 100.0])
+    keep = compressao.stationary_runs_mask(x, np.zeros(6), np.zeros(6, dtype=np.int64), radius_m=5.0)
+    assert keep.all()
+
+
+def test_stationary_runs_do_not_cross_buses():
+    x = np.array([0.0, 1.0, 2.0, 2.0, 3.0, 4.0])
+    bus_ids = np.array([0, 0, 0, 1, 1, 1])
+    keep = compressao.stationary_runs_mask(x, np.zeros(6), bus_ids, radius_m=5.0)
+    assert keep.tolist() == [True, False, True, True, False, True]
+
+
+def test_time_aware_douglas_peucker():
+    # Em linha reta, mas parado entre t=2 s e t=3 s: no espaço tudo é colinear, no tempo não.
+    # Trecho 0-4: em t=3 a posição interpolada é 30 m e a real 20 m (erro 10 m > 5 m), o ping 3 fica.
+    # Trecho 0-3: em t=2 a interpolada é 13.3 m e a real 20 m (erro 6.7 m), o ping 2 fica.
+    # Trechos 0-2 e 3-4 não têm erro.
+    timestamps_ms = np.array([0, 1000, 2000, 3000, 4000])
+    x = np.array([0.0, 10.0, 20.0, 20.0, 40.0])
+    keep = compressao.time_aware_douglas_peucker_mask(timestamps_ms, x, np.zeros(5), np.zeros(5, dtype=np.int64), 5.0)
+    assert keep.tolist() == [True, False, True, True, True]
+
+    # Velocidade constante: só as extremidades
+    keep = compressao.time_aware_douglas_peucker_mask(timestamps_ms, 10.0 * np.arange(5), np.zeros(5),
+                                                      np.zeros(5, dtype=np.int64), 5.0)
+    assert keep.tolist() == [True, False, False, False, True]
+
+
+def hour_dataframe(ordens, x, y, timestamps_ms):
+    lats, lons = latlon(x, y)
+    return pd.DataFrame({
+        'ordem': pd.Series(ordens, dtype='category'),
+        'linha': pd.Series(['100'] * len(ordens), dtype='category'),
+        'latitude_e7': np.round(lats * compressao.COORDINATE_SCALE).astype(np.int32),
+        'longitude_e7': np.round(lons * compressao.COORDINATE_SCALE).astype(np.int32),
+        'velocidade': np.zeros(len(ordens), dtype=np.uint8),
+        'timestamp_ms': np.asarray(timestamps_ms, dtype=np.int64),
+    })
+
+
+def test_compress_hour_dataframe():
+    # Ônibus A: 50 m a cada 5 s em linha reta, com o ping de t=10 s duplicado
+    # Ônibus B: quatro pings parados no mesmo ponto
+    df = hour_dataframe(
+        ['A', 'B', 'A', 'A', 'B', 'A', 'A', 'B', 'A', 'B'],
+        [0.0, 500.0, 50.0, 100.0, 500.0, 100.0, 150.0, 500.0, 200.0, 500.0],
+        [0.0, 500.0, 0.0, 0.0, 500.0, 0.0, 0.0, 500.0, 0.0, 500.0],
+        [0, 0, 5000, 10000, 60000, 10000, 15000, 120000, 20000, 180000],
+    )
+    compressed, stats = compressao.compress_hour_dataframe(df, tolerance_m=10.0, stationary_radius_m=5.0)
+    assert stats == {'entrada': 10, 'duplicatas': 1, 'parados': 2, 'simplificados': 3, 'saida': 4}
+    # Ficam o primeiro e o último ping de cada ônibus, na ordem original
+    assert compressed['ordem'].tolist() == ['A', 'B', 'A', 'B']
+    assert compressed['timestamp_ms'].tolist() == [0, 0, 20000, 180000]
+    assert compressao.format_compression_stats(stats) == \
+        "10 pings -> 4 (2.50:1; 1 duplicatas, 2 parados, 3 simplificados)"
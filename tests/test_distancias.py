@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from geopy.distance import geodesic
+
+import distancias
+from conftest import latlon
+
+
+def test_geodesic_matches_geopy():
+    lats_1, lons_1 = latlon(np.array([0.0, 10.0, -500.0, 2500.0]), np.array([0.0, 0.0, 300.0, -40000.0]))
+    lats_2, lons_2 = latlon(np.array([0.0, 15.0, 800.0, 1.0e6]), np.array([0.0, 3.0, -900.0, 2.0e5]))
+    distances = distancias.geodesic_meters(lats_1, lons_1, lats_2, lons_2)
+    for lat_1, lon_1, lat_2, lon_2, distance in zip(lats_1, lons_1, lats_2, lons_2, distances):
+        assert distance == pytest.approx(geodesic((lat_1, lon_1), (lat_2, lon_2)).meters, abs=1e-3)
+    assert distances[0] == 0.0
+
+
+def test_geodesic_falls_back_to_geopy_near_antipodes():
+    distance = distancias.geodesic_meters([0.0], [0.0], [0.5], [179.7])[0]
+    assert distance == pytest.approx(geodesic((0.0, 0.0), (0.5, 179.7)).meters, abs=1e-3)
+
+
+def test_haversine_broadcasts_and_stays_close_to_geodesic():
+    lats, lons = latlon(np.array([100.0, 2000.0, -3000.0]), np.array([0.0, 500.0, 1200.0]))
+    origin_lat, origin_lon = latlon(0.0, 0.0)
+    approx = distancias.haversine_meters(origin_lat, origin_lon, lats, lons)
+    exact = distancias.geodesic_meters(origin_lat, origin_lon, lats, lons)
+    assert approx.shape == (3,)
+    np.testing.assert_allclose(approx, exact, rtol=0.01)
@@ -0,0 +1,104 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import distancias
+import frota
+import rotas
+from conftest import latlon
+
+# Rota reta de 3000 m ao longo do eixo x
+ROUTE = rotas.build_route(*latlon([0.0, 1000.0, 2000.0, 3000.0], [0.0, 0.0, 0.0, 0.0]))
+
+MONDAYS = [datetime(2024, month, day, tzinfo=timezone.utc) for month, day in ((5, 13), (5, 20), (5, 27), (6, 3))]
+
+
+def hour_ms(day, hour=10, minute=0):
+    return int(day.replace(hour=hour, minute=minute).timestamp() * 1000)
+
+
+def scheduled_hour(day, ordem='A', linha='100', speed_m_per_min=40.0):
+    """Uma hora (10h) de um ônibus com horário fixo: no minuto m está a speed_m_per_min * m metros do início."""
+    minutes = np.arange(60)
+    lats, lons = latlon(speed_m_per_min * minutes, np.zeros(60))
+    return pd.DataFrame({
+        'ordem': pd.Series([ordem] * 60, dtype='category'),
+        'linha': pd.Series([linha] * 60, dtype='category'),
+        'latitude_e7': np.round(lats * frota.COORDINATE_SCALE).astype(np.int32),
+        'longitude_e7': np.round(lons * frota.COORDINATE_SCALE).astype(np.int32),
+        'velocidade': np.full(60, 9, dtype=np.uint8),
+        'timestamp_ms': hour_ms(day) + minutes * 60_000,
+    })
+
+
+def build_index(days, tmp_path):
+    accumulator = frota.new_fleet_accumulator()
+    for day in days:
+        frota.accumulate_hour(accumulator, scheduled_hour(day), lambda linha: ROUTE)
+    index = frota.finalize_fleet_index(accumulator)
+    folder = str(tmp_path / 'frota')
+    frota.save_fleet_index(index, {'linhas': list(accumulator['linhas']), 'onibus': list(accumulator['onibus']),
+                                   'origem': accumulator['origem'], 'dias': [], 'pings': accumulator['pings']}, folder)
+    return frota.load_fleet_index(folder)
+
+
+def assert_at_x(lats, lons, x):
+    expected_lat, expected_lon = latlon(x, 0.0)
+    assert distancias.haversine_meters(np.asarray(lats), np.asarray(lons), expected_lat, expected_lon).max() < 1.0
+
+
+def test_grouped_route_median_wraps_on_closed_routes():
+    groups = np.zeros(3, dtype=np.int64)
+    along = np.array([3900.0, 100.0, 3950.0])
+    lengths = np.full(3, 4000.0)
+    _, medians, sizes = frota._grouped_route_median(groups, along, lengths, np.ones(3, dtype=bool))
+    # 3900, 4100 (= 100 depois da volta) e 3950: mediana 3950
+    assert medians == pytest.approx([3950.0])
+    assert sizes.tolist() == [3]
+    _, medians, _ = frota._grouped_route_median(groups, along, lengths, np.zeros(3, dtype=bool))
+    assert medians == pytest.approx([3900.0])
+
+
+def test_single_day_answers_the_line_centroid(tmp_path):
+    index = build_index(MONDAYS[:1], tmp_path)
+    # Um ping por faixa de 5 min: 0, 200, ..., 2200 m; a mediana das 12 posições é 1100 m. Sem um segundo
+    # dia nenhuma faixa é validada e a resposta é o centroide
+    lats, lons = frota.fleet_positions(index, [('A', '100')], [hour_ms(MONDAYS[3], minute=12)])
+    assert_at_x(lats, lons, 1100.0)
+    assert np.isnan(index['validacao'][0]) and index['validacao'][2] == 0
+
+
+def test_regular_schedule_answers_along_the_route(tmp_path):
+    index = build_index(MONDAYS[:2], tmp_path)
+    # 10:12 cai na faixa 10:10-10:15, cujo primeiro ping está a 40 * 10 = 400 m do início
+    lats, lons = frota.fleet_positions(index, [('A', '100'), ('Z', '100'), ('A', '999')],
+                                       [hour_ms(MONDAYS[3], minute=12)] * 3)
+    assert_at_x(lats[:2], lons[:2], 400.0)
+    assert np.isnan(lats[2]) and np.isnan(lons[2])
+
+    # A validação do último dia usa um índice montado só com o primeiro, que ainda não tem faixas validadas:
+    # índice e centroide (1100 m) erram em média |0 - 1100|, |200 - 1100|, ..., |2200 - 1100| = 600 m
+    index_error_m, centroid_error_m, samples = index['validacao']
+    assert samples == 12
+    assert index_error_m == pytest.approx(600.0, abs=1.0)
+    assert centroid_error_m == pytest.approx(600.0, abs=1.0)
+
+
+def test_validation_with_three_days(tmp_path):
+    # Com dois dias antes do último, as faixas do horário fixo já são validadas e o índice acerta o último dia
+    index = build_index(MONDAYS[:3], tmp_path)
+    index_error_m, centroid_error_m, samples = index['validacao']
+    assert samples == 12
+    assert index_error_m < 1.0
+    assert centroid_error_m == pytest.approx(600.0, abs=1.0)
+    lats, lons = frota.fleet_positions(index, [('A', '100')], [hour_ms(MONDAYS[3], minute=57)])
+    assert_at_x(lats, lons, 40.0 * 55)
+
+
+def test_route_points_wrap_on_closed_routes(tmp_path):
+    index = build_index(MONDAYS[:1], tmp_path)
+    index = dict(index, rotas_fechada=np.array([True]))
+    lats, lons = frota.route_points(index, np.array([0]), np.array([3000.0 + 500.0]))
+    assert_at_x(lats, lons, 500.0)
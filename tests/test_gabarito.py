@@ -0,0 +1,96 @@
+import json
+import os
+
+import pytest
+
+import evaluate
+
+
+def write_true_results(path, previsoes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'previsoes': previsoes}, f)
+
+
+@pytest.fixture
+def final_path(tmp_path, monkeypatch):
+    """Dois dias de gabarito e o índice binário numa pasta temporária."""
+    monkeypatch.setattr(evaluate, 'TRUE_RESULTS_INDEX_PATH', str(tmp_path / 'gabarito'))
+    monkeypatch.setattr(evaluate, 'USE_TRUE_RESULTS_INDEX', True)
+    base = tmp_path / 'final'
+    write_true_results(str(base / 'final-2024-05-13' / 'resposta-2024-05-13_10.json'),
+                       [[1, -22.9, -43.3], [2, 1715594400000]])
+    write_true_results(str(base / 'final-2024-05-13' / 'resposta-2024-05-13_11.json'), [[3, -22.8, -43.2]])
+    write_true_results(str(base / 'final-2024-05-14' / 'resposta-2024-05-14_10.json'), [[4, 1715680800000]])
+    return str(base)
+
+
+@pytest.fixture
+def parse_calls(monkeypatch):
+    """Registra os arquivos de gabarito que foram de fato lidos do JSON."""
+    calls = []
+    original = evaluate.parse_true_results_file
+
+    def counting(file_path):
+        calls.append(os.path.basename(file_path))
+        return original(file_path)
+
+    monkeypatch.setattr(evaluate, 'parse_true_results_file', counting)
+    return calls
+
+
+def as_records(table):
+    return sorted(table.fillna(0).itertuples(index=False, name=None))
+
+
+def manifest_files():
+    with open(os.path.join(evaluate.TRUE_RESULTS_INDEX_PATH, 'manifest.json'), encoding='utf-8') as f:
+        return json.load(f)['arquivos']
+
+
+def test_second_load_reads_the_index(final_path, parse_calls):
+    first = evaluate.load_all_true_results(final_path, workers=1)
+    assert len(parse_calls) == 3
+    second = evaluate.load_all_true_results(final_path, workers=1)
+    assert len(parse_calls) == 3
+    assert as_records(first) == as_records(second)
+    assert list(second['id']) == [1, 2, 3, 4]
+
+
+def test_modified_file_is_reparsed_alone(final_path, parse_calls):
+    evaluate.load_all_true_results(final_path, workers=1)
+    modified = os.path.join(final_path, 'final-2024-05-13', 'resposta-2024-05-13_11.json')
+    write_true_results(modified, [[3, -22.7, -43.1], [5, 1715598000000]])
+    stat = os.stat(modified)
+    os.utime(modified, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    table = evaluate.load_all_true_results(final_path, workers=1)
+    assert parse_calls[3:] == ['resposta-2024-05-13_11.json']
+    row = table.set_index('id').loc[3]
+    assert (row['lat'], row['lon']) == (-22.7, -43.1)
+    assert set(table['id']) == {1, 2, 3, 4, 5}
+    evaluate.load_all_true_results(final_path, workers=1)
+    assert len(parse_calls) == 4
+
+
+def test_deleted_file_leaves_the_index(final_path, parse_calls):
+    evaluate.load_all_true_results(final_path, workers=1)
+    removed = os.path.join(final_path, 'final-2024-05-14', 'resposta-2024-05-14_10.json')
+    index_file = manifest_files()[os.path.abspath(removed)]['indice']
+    assert os.path.isfile(index_file)
+    os.remove(removed)
+
+    table = evaluate.load_all_true_results(final_path, workers=1)
+    assert len(parse_calls) == 3
+    assert set(table['id']) == {1, 2, 3}
+    assert os.path.abspath(removed) not in manifest_files()
+    assert not os.path.exists(index_file)
+
+
+def test_empty_file_is_indexed(final_path, parse_calls):
+    write_true_results(os.path.join(final_path, 'final-2024-05-14', 'resposta-2024-05-14_11.json'), [])
+    evaluate.load_all_true_results(final_path, workers=1)
+    table = evaluate.load_all_true_results(final_path, workers=1)
+    assert len(parse_calls) == 4
+    assert len(manifest_files()) == 4
+    assert len(table) == 4
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+import main
+
+RECORDS = [
+    {'ordem': 'A1', 'linha': '100', 'latitude': '-22,90000', 'velocidade': 0},
+    {'ordem': 'B7', 'linha': '864', 'nested': {'lista': [1, 2.5, None, True], 'texto': 'ônibus "expresso" \\ ]}'}},
+    {},
+    {'ordem': 'C3', 'escape': 'é中\U0001f68c', 'numero': 12345678901234567890},
+]
+
+
+def write_text(tmp_path, text, name='hora.json'):
+    path = tmp_path / name
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 1 << 20])
+@pytest.mark.parametrize('text', [
+    json.dumps(RECORDS),
+    json.dumps(RECORDS, indent=2, ensure_ascii=False),
+    '\n\n   \t' + json.dumps(RECORDS, separators=(',', ':')) + '\n',
+    '[]',
+    ' [ \n ] ',
+])
+def test_records_match_json_load(tmp_path, chunk_size, text):
+    path = write_text(tmp_path, text)
+    with open(path, encoding='utf-8') as f:
+        expected = json.load(f)
+    assert list(main.iter_json_array_records(path, chunk_size=chunk_size)) == expected
+
+
+@pytest.mark.parametrize('chunk_size', [1, 1 << 20])
+@pytest.mark.parametrize('text', [
+    '[{"ordem": "A1"}, {"ordem": "B7"',
+    '[{"ordem": "A1"}, ',
+    '[{"ordem": "A1"}',
+    '[',
+    '[{"ordem": "A1"} {"ordem": "B7"}]',
+    '[{"ordem": "A1"},, {"ordem": "B7"}]',
+    '[, {"ordem": "A1"}]',
+    '[{"ordem": "A1"},]',
+    '[{"ordem": A1}]',
+])
+def test_truncated_or_malformed_list_raises(tmp_path, chunk_size, text):
+    path = write_text(tmp_path, text)
+    with pytest.raises(json.JSONDecodeError):
+        list(main.iter_json_array_records(path, chunk_size=chunk_size))
+
+
+@pytest.mark.parametrize('text', ['', '   ', '{"ordem": "A1"}', ',[{"ordem": "A1"}]'])
+def test_non_list_content_raises_value_error(tmp_path, text):
+    path = write_text(tmp_path, text)
+    with pytest.raises(ValueError):
+        list(main.iter_json_array_records(path, chunk_size=1))
+
+
+def test_records_before_a_truncation_are_yielded(tmp_path):
+    path = write_text(tmp_path, '[{"ordem": "A1"}, {"ordem": "B7"}, {"ordem"')
+    records = main.iter_json_array_records(path, chunk_size=4)
+    assert next(records) == {'ordem': 'A1'}
+    assert next(records) == {'ordem': 'B7'}
+    with pytest.raises(json.JSONDecodeError):
+        next(records)
@@ -0,0 +1,72 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+import perfis
+import rotas
+from conftest import latlon
+
+# Segunda-feira, 2024-05-13 10:00 UTC
+MONDAY_10H_MS = int(datetime(2024, 5, 13, 10, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def test_weekday_and_hour():
+    weekdays, hours = perfis.weekday_and_hour([0, MONDAY_10H_MS, MONDAY_10H_MS + 25 * 3600 * 1000])
+    # 1970-01-01 foi uma quinta-feira; a segunda às 10h, e a terça às 11h
+    assert weekdays.tolist() == [3, 0, 1]
+    assert hours.tolist() == [0, 10, 11]
+
+
+def constant_speed_profile(route, length_m, speed_ms=10.0, step_s=10):
+    """Perfil de um ônibus que percorre a rota inteira a speed_ms, com um ping a cada step_s segundos."""
+    elapsed_s = np.arange(0, int(length_m / speed_ms) + 1, step_s)
+    along = elapsed_s * speed_ms
+    accumulator = perfis.new_profile_accumulator(route)
+    lats, lons = rotas.position_at_distance(route, along)
+    perfis.accumulate_trajectory(accumulator, route, MONDAY_10H_MS + elapsed_s * 1000, lats, lons,
+                                 np.full(len(along), speed_ms * 3.6), max_snap_distance_m=50.0)
+    return perfis.finalize_profile(accumulator, route)
+
+
+def test_straight_route_profile():
+    route = rotas.build_route(*latlon([0.0, 1900.0], [0.0, 0.0]))
+    profile = constant_speed_profile(route, 1900.0)
+
+    # Trechos de 500 m (o último com 400 m) e passos de 100 m em 10 s: 10 m/s em todos
+    assert profile['bordas_m'] == pytest.approx([0.0, 500.0, 1000.0, 1500.0, 1900.0])
+    assert profile['amostras'][0, 10].tolist() == [5, 5, 5, 4]
+    assert profile['velocidade_ms'][0, 10] == pytest.approx([10.0] * 4, rel=1e-4)
+
+    assert perfis.travel_time_s(profile, 250.0, 1750.0, MONDAY_10H_MS)[0] == pytest.approx(150.0, rel=1e-4)
+    assert np.isnan(perfis.travel_time_s(profile, 1750.0, 250.0, MONDAY_10H_MS)[0])
+    assert perfis.distance_after_s(profile, 250.0, 60.0, MONDAY_10H_MS)[0] == pytest.approx(850.0, rel=1e-4)
+    # Numa rota aberta a distância para no fim da rota
+    assert perfis.distance_after_s(profile, 1500.0, 600.0, MONDAY_10H_MS)[0] == pytest.approx(1900.0)
+
+
+def test_other_hours_fall_back_to_the_segment_speed():
+    route = rotas.build_route(*latlon([0.0, 1900.0], [0.0, 0.0]))
+    profile = constant_speed_profile(route, 1900.0)
+    tuesday_18h_ms = MONDAY_10H_MS + 32 * 3600 * 1000
+    assert profile['amostras'][1, 18].sum() == 0
+    assert perfis.travel_time_s(profile, 0.0, 1000.0, tuesday_18h_ms)[0] == pytest.approx(100.0, rel=1e-4)
+
+
+def test_closed_loop_profile_wraps_around():
+    route = rotas.build_route(*latlon([0.0, 1000.0, 1000.0, 0.0], [0.0, 0.0, 1000.0, 1000.0]), closed=True)
+    profile = constant_speed_profile(route, rotas.route_length(route))
+
+    # De 3500 m a 500 m dá a volta: 1000 m a 10 m/s
+    assert perfis.travel_time_s(profile, 3500.0, 500.0, MONDAY_10H_MS)[0] == pytest.approx(100.0, rel=1e-3)
+    assert perfis.distance_after_s(profile, 3500.0, 100.0, MONDAY_10H_MS)[0] == pytest.approx(500.0, abs=1.0)
+
+
+def test_save_and_load_profile(tmp_path):
+    route = rotas.build_route(*latlon([0.0, 1900.0], [0.0, 0.0]))
+    profile = constant_speed_profile(route, 1900.0)
+    file_path = str(tmp_path / 'perfis' / 'linha.npz')
+    perfis.save_profile(profile, file_path)
+    loaded = perfis.load_profile(file_path)
+    for name in profile:
+        np.testing.assert_array_equal(loaded[name], profile[name])
@@ -0,0 +1,78 @@
+import json
+from collections import OrderedDict
+
+import pytest
+
+import main
+
+# 2024-05-13 10:00 UTC
+HOUR_START_MS = 1715594400000
+
+
+def write_raw_hour(path, minutes):
+    records = []
+    for minute in minutes:
+        timestamp = str(HOUR_START_MS + minute * 60_000)
+        records.append({'ordem': 'A1', 'latitude': '-22,90000', 'longitude': '-43,30000', 'datahora': timestamp,
+                        'velocidade': '20', 'linha': '100', 'datahoraenvio': timestamp, 'datahoraservidor': timestamp})
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(records, f)
+
+
+@pytest.fixture
+def hour_files(tmp_path, monkeypatch):
+    """Três arquivos horários, cache LRU vazio e um prefetcher ativo."""
+    monkeypatch.setattr(main, 'PREPROCESSED_CACHE_PATH', str(tmp_path / 'horas'))
+    monkeypatch.setattr(main, 'LOG_EACH_FILE', False)
+    monkeypatch.setattr(main, 'LINHAS_INTERESSE', ['100'])
+    monkeypatch.setattr(main, 'HOUR_DATA_LRU_CACHE', OrderedDict())
+    monkeypatch.setattr(main, 'HOUR_CACHE_STATS', {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0})
+    paths = []
+    for hour in (10, 11, 12):
+        path = str(tmp_path / f'2024-05-13_{hour}.json')
+        write_raw_hour(path, range(hour - 7))
+        paths.append(path)
+    prefetcher = main.HourPrefetcher(workers=2, max_pending=4)
+    monkeypatch.setattr(main, 'HOUR_PREFETCHER', prefetcher)
+    yield paths
+    prefetcher.close()
+
+
+def wait_for_producers(prefetcher):
+    for producer in prefetcher.producers:
+        producer.join()
+
+
+def test_claim_ends_once_the_hour_is_cached(hour_files):
+    prefetcher = main.HOUR_PREFETCHER
+    main.get_hour_dataframe(hour_files[0])
+    prefetcher.prefetch(hour_files)
+    wait_for_producers(prefetcher)
+    assert prefetcher.claimed == set()
+    # A hora já no cache LRU não ocupa vaga; as demais são agendadas
+    assert set(prefetcher.pending) == set(hour_files[1:])
+
+    assert len(main.get_hour_dataframe(hour_files[1])) == 4
+    assert prefetcher.claimed == set()
+    assert set(prefetcher.pending) == {hour_files[2]}
+
+
+def test_evicted_hour_can_be_prefetched_again(hour_files):
+    prefetcher = main.HOUR_PREFETCHER
+    main.get_hour_dataframe(hour_files[0])
+    main.evict_hour_file(hour_files[0])
+    prefetcher.prefetch([hour_files[0]])
+    wait_for_producers(prefetcher)
+    assert set(prefetcher.pending) == {hour_files[0]}
+    assert len(main.get_hour_dataframe(hour_files[0])) == 3
+    assert main.HOUR_CACHE_STATS['misses'] == 2
+
+
+def test_failed_load_releases_the_claim(hour_files, monkeypatch):
+    def failing(file_path):
+        raise OSError('disco indisponível')
+
+    monkeypatch.setattr(main, 'load_preprocessed_raw_file', failing)
+    with pytest.raises(OSError):
+        main.get_hour_dataframe(hour_files[0])
+    assert main.HOUR_PREFETCHER.claimed == set()
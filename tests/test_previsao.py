@@ -0,0 +1,84 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+from conftest import latlon
+
+# 2024-05-13 10:00 UTC
+HOUR_START_MS = 1715594400000
+
+
+def hour_dataframe(rows):
+    """Hora no layout compacto a partir de linhas (ordem, linha, x em metros, y em metros, segundos, km/h)."""
+    ordens, linhas, x, y, seconds, speeds = zip(*rows)
+    lats, lons = latlon(np.array(x), np.array(y))
+    return pd.DataFrame({
+        'ordem': pd.Categorical(ordens),
+        'linha': pd.Categorical(linhas),
+        'latitude_e7': main.encode_coordinates(lats),
+        'longitude_e7': main.encode_coordinates(lons),
+        'velocidade': main.encode_speeds(speeds),
+        'timestamp_ms': HOUR_START_MS + np.array(seconds, dtype=np.int64) * 1000,
+    })
+
+
+@pytest.fixture
+def trajectory_index(tmp_path, monkeypatch):
+    """Índice de duas horas com dois ônibus, sem rotas nem perfis construídos."""
+    monkeypatch.setattr(main, 'ROUTES_PATH', str(tmp_path / 'rotas'))
+    monkeypatch.setattr(main, 'PROFILES_PATH', str(tmp_path / 'perfis'))
+    monkeypatch.setattr(main, 'ROUTE_CACHE', {})
+    monkeypatch.setattr(main, 'PROFILE_CACHE', {})
+    first_hour = hour_dataframe([
+        ('A1', '100', 0.0, 0.0, 0, 30), ('A1', '100', 300.0, 0.0, 60, 30), ('A1', '100', 300.0, 0.0, 60, 0),
+        ('A1', '100', 700.0, 50.0, 150, 25), ('B7', '864', 0.0, 500.0, 30, 0), ('B7', '864', -200.0, 500.0, 400, 0),
+    ])
+    second_hour = hour_dataframe([
+        ('A1', '100', 1500.0, 120.0, 3700, 40), ('A1', '100', 1800.0, 120.0, 3760, 40),
+        ('B7', '864', -200.0, 900.0, 3900, 12),
+    ])
+    index = main.build_trajectory_index([first_hour, second_hour])
+    monkeypatch.setattr(main, 'CURRENT_TEST_DAY_TRAJECTORY_INDEX', index)
+    return index
+
+
+# Antes do primeiro ping, em um ping, entre pings, em timestamps repetidos, logo depois e muito depois do
+# último ping (dead reckoning e janela vazia) e um ônibus sem histórico
+QUERIES = [(('A1', '100'), s) for s in (-30, 0, 45, 60, 61, 150, 1000, 3730, 3760, 3800, 4300, 3760 + 6 * 3600)]
+QUERIES += [(('B7', '864'), s) for s in (30, 200, 400, 2000, 3900, 4000)]
+QUERIES += [(('Z9', '100'), 60)]
+
+
+@pytest.mark.parametrize('dead_reckoning', [True, False])
+def test_batch_matches_per_query_prediction(trajectory_index, monkeypatch, dead_reckoning):
+    monkeypatch.setattr(main, 'DEAD_RECKONING_ENABLED', dead_reckoning)
+    keys = [key for key, _ in QUERIES]
+    targets = np.array([HOUR_START_MS + seconds * 1000 for _, seconds in QUERIES], dtype=np.int64)
+
+    batch_lats, batch_lons = main.predict_locations_batch(keys, targets, hours_before=5, trajectory_index=trajectory_index)
+
+    for (ordem, linha), target, batch_lat, batch_lon in zip(keys, targets, batch_lats, batch_lons):
+        query_datetime = datetime.fromtimestamp(target / 1000, tz=timezone.utc)
+        history = main.get_recent_historical_data_for_query_from_cache(ordem, linha, query_datetime, hours_before=5)
+        lat, lon = main.predict_location(history, int(target), linha)
+        if lat is None:
+            assert np.isnan(batch_lat) and np.isnan(batch_lon)
+        else:
+            assert batch_lat == pytest.approx(lat, abs=1e-9) and batch_lon == pytest.approx(lon, abs=1e-9)
+
+    # A janela vazia e o ônibus desconhecido ficam sem previsão; os demais têm
+    assert np.isnan(batch_lats).sum() == 3
+
+
+def test_hours_before_defaults_follow_the_configuration(trajectory_index, monkeypatch):
+    monkeypatch.setattr(main, 'QUERY_HOURS_BEFORE', 1)
+    query_datetime = datetime.fromtimestamp((HOUR_START_MS + 3760 * 1000) / 1000, tz=timezone.utc)
+    history = main.get_recent_historical_data_for_query_from_cache('A1', '100', query_datetime)
+    assert len(history['timestamp_ms']) == 2
+    assert len(main.get_recent_historical_data_for_query_from_cache('A1', '100', query_datetime, hours_before=5)['timestamp_ms']) == 6
+
+    plan = main.plan_queries_by_bus([({'id': 1, 'ordem': 'A1', 'linha': '100', 'datahora': HOUR_START_MS + 3760 * 1000}, None)])
+    assert plan[('A1', '100')]['inicio_ms'] == HOUR_START_MS + 160 * 1000
@@ -0,0 +1,127 @@
+import json
+import os
+from collections import OrderedDict
+
+import pytest
+
+import main
+from conftest import latlon
+
+# 2024-05-13 10:00 UTC
+HOUR_START_MS = 1715594400000
+DATAHORA = '2024-05-13 23:00:00 UTC'
+CACHE_PATH_GLOBALS = ['CACHE_PATH', 'CHECKPOINT_PATH', 'HISTORICAL_MANIFEST_PATH', 'ROUTES_PATH', 'PROFILES_PATH',
+                      'FLEET_INDEX_PATH', 'PREPROCESSED_CACHE_PATH']
+
+
+def expected_bytes(previsoes):
+    document = {'aluno': main.ALUNO_NOME, 'datahora': DATAHORA, 'previsoes': previsoes, 'senha': main.SENHA_API}
+    return json.dumps(document, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def written_bytes(path, previsoes):
+    main.write_response_file(str(path), previsoes, DATAHORA)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('previsoes', [
+    [],
+    [[1, -22.91234, -43.30001], [2, 1715594400000], [3, 0.0, -0.0], [4, 1e-05, 12], [5, None]],
+    [['é', -22.9, -43.3], ['ônibus 7', 1715594400000]],
+])
+def test_writer_matches_json_dump(tmp_path, monkeypatch, previsoes):
+    monkeypatch.setattr(main, 'ALUNO_NOME', 'José Conceição')
+    assert written_bytes(tmp_path / 'resposta.json', previsoes) == expected_bytes(previsoes)
+    assert not os.path.exists(str(tmp_path / 'resposta.json') + '.tmp')
+
+
+def write_json(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(content, f)
+
+
+def raw_pings(ordem, linha, pings):
+    """Registros brutos a partir de (x em metros, y em metros, segundos desde 10:00 UTC)."""
+    records = []
+    for x, y, seconds in pings:
+        lat, lon = latlon(x, y)
+        timestamp = str(HOUR_START_MS + seconds * 1000)
+        records.append({'ordem': ordem, 'latitude': f"{lat:.6f}".replace('.', ','), 'longitude': f"{lon:.6f}".replace('.', ','),
+                        'datahora': timestamp, 'velocidade': '30', 'linha': linha,
+                        'datahoraenvio': timestamp, 'datahoraservidor': timestamp})
+    return records
+
+
+@pytest.fixture
+def test_day(tmp_path, monkeypatch):
+    """Um dia de teste com dois arquivos treino, o histórico das 10h e os caches de main.py numa pasta temporária."""
+    for name in CACHE_PATH_GLOBALS:
+        monkeypatch.setattr(main, name, getattr(main, name))
+    main.set_cache_path(str(tmp_path / 'cache'))
+    monkeypatch.setattr(main, 'BASE_DATA_PATH', str(tmp_path / 'data'))
+    monkeypatch.setattr(main, 'CHECKPOINT_ENABLED', True)
+    monkeypatch.setattr(main, 'FLEET_FALLBACK_ENABLED', False)
+    monkeypatch.setattr(main, 'LOG_EACH_FILE', False)
+    monkeypatch.setattr(main, 'LINHAS_INTERESSE', ['100'])
+    monkeypatch.setattr(main, 'HOUR_DATA_LRU_CACHE', OrderedDict())
+    monkeypatch.setattr(main, 'HOUR_CACHE_STATS', {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0})
+    monkeypatch.setattr(main, 'HISTORICAL_RAW_FILE_PATH_CACHE', {})
+    monkeypatch.setattr(main, 'HISTORICAL_FILE_MANIFEST', {})
+    monkeypatch.setattr(main, 'CURRENT_TEST_DAY_DATA_CACHE', {})
+    monkeypatch.setattr(main, 'CURRENT_TEST_DAY_TRAJECTORY_INDEX', {})
+    monkeypatch.setattr(main, 'CURRENT_TEST_DAY_WINDOW', None)
+
+    data = tmp_path / 'data'
+    write_json(str(data / 'historical' / '2024-05-13' / '2024-05-13_10.json'),
+               raw_pings('A1', '100', [(100.0 * i, 0.0, 300 * i) for i in range(12)]))
+    target_lat, target_lon = latlon(650.0, 10.0)
+    test_path = data / 'test' / '2024-05-13'
+    write_json(str(test_path / 'treino-2024-05-13_10.json'), [
+        {'id': 1, 'ordem': 'A1', 'linha': '100', 'datahora': HOUR_START_MS + 450_000},
+        {'id': 'é', 'ordem': 'A1', 'linha': '100', 'datahora': HOUR_START_MS + 1_000_000},
+    ])
+    write_json(str(test_path / 'treino-2024-05-13_11.json'), [
+        {'id': 3, 'ordem': 'A1', 'linha': '100', 'latitude': f"{target_lat:.5f}".replace('.', ','), 'longitude': f"{target_lon:.5f}".replace('.', ',')},
+        {'id': 4, 'ordem': 'Z9', 'linha': '100', 'datahora': HOUR_START_MS + 450_000},
+    ])
+    main.build_historical_file_path_cache(str(data / 'historical'), quiet=True)
+    return str(test_path)
+
+
+@pytest.fixture
+def answered_files(monkeypatch):
+    """Arquivos treino efetivamente respondidos (não servidos por um checkpoint)."""
+    answered = []
+    original = main.answer_queries_by_bus
+
+    def recording(queries, *args, **kwargs):
+        answered.extend(sorted({test_filename for _, test_filename in queries}))
+        return original(queries, *args, **kwargs)
+
+    monkeypatch.setattr(main, 'answer_queries_by_bus', recording)
+    return answered
+
+
+def test_resume_from_checkpoint_writes_the_same_response(test_day, tmp_path, answered_files):
+    first, _ = main.process_test_day('2024-05-13')
+    assert answered_files == ['treino-2024-05-13_10.json', 'treino-2024-05-13_11.json']
+    assert sorted(os.listdir(os.path.join(main.CHECKPOINT_PATH, '2024-05-13'))) == ['treino-2024-05-13_10.jsonl', 'treino-2024-05-13_11.jsonl']
+    assert [previsao[0] for previsao in first] == [1, 'é', 3]
+
+    second, queries = main.process_test_day('2024-05-13')
+    assert len(answered_files) == 2
+    assert len(queries) == 4
+    assert written_bytes(tmp_path / 'segunda.json', second) == written_bytes(tmp_path / 'primeira.json', first)
+
+
+def test_changed_test_file_is_answered_again(test_day, tmp_path, answered_files):
+    first, _ = main.process_test_day('2024-05-13')
+    changed = os.path.join(test_day, 'treino-2024-05-13_11.json')
+    stat = os.stat(changed)
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    second, _ = main.process_test_day('2024-05-13')
+    assert answered_files[2:] == ['treino-2024-05-13_11.json']
+    assert written_bytes(tmp_path / 'segunda.json', second) == written_bytes(tmp_path / 'primeira.json', first)
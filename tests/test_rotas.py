@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+import rotas
+from conftest import latlon
+
+
+def straight_route():
+    """Rota aberta em linha reta de 2000 m ao longo do eixo x."""
+    return rotas.build_route(*latlon([0.0, 1000.0, 2000.0], [0.0, 0.0, 0.0]))
+
+
+def square_loop():
+    """Volta fechada num quadrado de 1000 m de lado (4000 m), começando em (0, 0) no sentido +x."""
+    return rotas.build_route(*latlon([0.0, 1000.0, 1000.0, 0.0], [0.0, 0.0, 1000.0, 1000.0]), closed=True)
+
+
+def out_and_back():
+    """Ida e volta por ruas paralelas a 10 m: ida em y=0 (0 -> 2000 m), volta em y=10 (2010 -> 4010 m)."""
+    return rotas.build_route(*latlon([0.0, 2000.0, 2000.0, 0.0], [0.0, 0.0, 10.0, 10.0]))
+
+
+def test_straight_route_projection():
+    route = straight_route()
+    assert rotas.route_length(route) == pytest.approx(2000.0, abs=1e-6)
+
+    along, distance = rotas.project_onto_route(route, *latlon([700.0, -50.0], [30.0, 0.0]))
+    assert along == pytest.approx([700.0, 0.0], abs=1e-6)
+    assert distance == pytest.approx([30.0, 50.0], abs=1e-6)
+
+
+def test_straight_route_positions_and_forward_distance():
+    route = straight_route()
+    lat, lon = rotas.position_at_distance(route, [1500.0, 2500.0])
+    expected_lat, expected_lon = latlon([1500.0, 2000.0], [0.0, 0.0])
+    assert lat == pytest.approx(expected_lat, abs=1e-9)
+    assert lon == pytest.approx(expected_lon, abs=1e-9)
+
+    forward = rotas.forward_distance(route, [200.0, 500.0], [500.0, 200.0])
+    assert forward[0] == pytest.approx(300.0)
+    assert np.isnan(forward[1])
+
+
+def test_closed_loop_wraps_around():
+    route = square_loop()
+    assert bool(route['fechada'])
+    assert rotas.route_length(route) == pytest.approx(4000.0, abs=0.5)
+
+    assert rotas.forward_distance(route, 3500.0, 500.0) == pytest.approx(1000.0, abs=0.5)
+    lat, lon = rotas.position_at_distance(route, 4500.0)
+    expected_lat, expected_lon = latlon(500.0, 0.0)
+    assert lat == pytest.approx(expected_lat, abs=1e-5)
+    assert lon == pytest.approx(expected_lon, abs=1e-5)
+
+
+def test_heading_picks_the_leg_in_the_direction_of_travel():
+    route = out_and_back()
+    lats, lons = latlon([500.0, 500.0], [5.0, 5.0])
+    previous_lats, previous_lons = latlon([400.0, 600.0], [5.0, 5.0])
+
+    along, distance = rotas.project_onto_route(route, lats, lons, previous_lats, previous_lons)
+    assert along == pytest.approx([500.0, 3510.0], abs=1e-2)
+    assert distance == pytest.approx([5.0, 5.0], abs=1e-2)
+
+    passes = rotas.route_positions_near(route, lats[0], lons[0], 20.0)
+    assert np.sort(passes) == pytest.approx([500.0, 3510.0], abs=1e-2)
+
+
+def test_extract_route_cycle():
+    # Pings a cada 100 m numa volta e meia do quadrado: o ciclo fecha no ping 40, de volta ao início
+    perimeter = np.arange(0.0, 6000.0, 100.0) % 4000.0
+    side, offset = perimeter // 1000.0, perimeter % 1000.0
+    x = np.select([side == 0, side == 1, side == 2], [offset, 1000.0, 1000.0 - offset], 0.0)
+    y = np.select([side == 0, side == 1, side == 2], [0.0, offset, 1000.0], 1000.0 - offset)
+    lats, lons, closed = rotas.extract_route_cycle(*latlon(x, y))
+    assert closed
+    assert len(lats) == 41
+
+    lats, lons, closed = rotas.extract_route_cycle(*latlon(np.arange(0.0, 3000.0, 100.0), np.zeros(30)))
+    assert not closed
+    assert len(lats) == 30
+
+
+def test_save_and_load_route(tmp_path):
+    route = square_loop()
+    file_path = str(tmp_path / 'rotas' / 'linha.npz')
+    rotas.save_route(route, file_path)
+    loaded = rotas.load_route(file_path)
+    assert set(loaded) == set(route)
+    for name in route:
+        np.testing.assert_array_equal(loaded[name], route[name])
@@ -0,0 +1,208 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import numpy as np
+import pytest
+
+import main
+import servico
+from conftest import latlon
+
+# 2024-05-13 10:00 UTC
+HOUR_START_MS = 1715594400000
+CACHE_PATH_GLOBALS = ['CACHE_PATH', 'CHECKPOINT_PATH', 'HISTORICAL_MANIFEST_PATH', 'ROUTES_PATH', 'PROFILES_PATH',
+                      'FLEET_INDEX_PATH', 'PREPROCESSED_CACHE_PATH']
+
+
+def raw_records(ordem, linha, pings):
+    """Registros brutos a partir de (x em metros, y em metros, segundos desde 10:00 UTC)."""
+    records = []
+    for x, y, seconds in pings:
+        lat, lon = latlon(x, y)
+        timestamp = str(HOUR_START_MS + seconds * 1000)
+        records.append({'ordem': ordem, 'latitude': f"{lat:.6f}".replace('.', ','), 'longitude': f"{lon:.6f}".replace('.', ','),
+                        'datahora': timestamp, 'velocidade': '30', 'linha': linha,
+                        'datahoraenvio': timestamp, 'datahoraservidor': timestamp})
+    return records
+
+
+def write_hour(historical_path, hour, records):
+    path = os.path.join(historical_path, '2024-05-13', f'2024-05-13_{hour}.json')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(records, f)
+    return path
+
+
+@pytest.fixture
+def historical_path(tmp_path, monkeypatch):
+    """Duas horas de pings de dois ônibus e todos os caches de main.py isolados numa pasta temporária."""
+    for name in CACHE_PATH_GLOBALS:
+        monkeypatch.setattr(main, name, getattr(main, name))
+    main.set_cache_path(str(tmp_path / 'cache'))
+    monkeypatch.setattr(main, 'HOUR_DATA_LRU_CACHE', OrderedDict())
+    monkeypatch.setattr(main, 'HOUR_CACHE_STATS', {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0})
+    monkeypatch.setattr(main, 'HISTORICAL_RAW_FILE_PATH_CACHE', {})
+    monkeypatch.setattr(main, 'HISTORICAL_FILE_MANIFEST', {})
+    monkeypatch.setattr(main, 'CURRENT_TEST_DAY_DATA_CACHE', {})
+    monkeypatch.setattr(main, 'CURRENT_TEST_DAY_TRAJECTORY_INDEX', {})
+    monkeypatch.setattr(main, 'CURRENT_TEST_DAY_WINDOW', None)
+    monkeypatch.setattr(main, 'FLEET_FALLBACK_ENABLED', False)
+    monkeypatch.setattr(main, 'LOG_EACH_FILE', False)
+    monkeypatch.setattr(main, 'LINHAS_INTERESSE', ['100', '864'])
+
+    historical = str(tmp_path / 'historical')
+    write_hour(historical, 10, raw_records('A1', '100', [(100.0 * i, 0.0, 300 * i) for i in range(12)])
+               + raw_records('B7', '864', [(0.0, 500.0 + 50.0 * i, 600 * i) for i in range(6)]))
+    write_hour(historical, 11, raw_records('A1', '100', [(1200.0 + 100.0 * i, 0.0, 3600 + 300 * i) for i in range(6)]))
+    return historical
+
+
+@pytest.fixture
+def service(historical_path):
+    service = servico.PredictionService(os.path.dirname(historical_path), hours_before=5)
+    service.start()
+    return service
+
+
+@pytest.fixture
+def base_url(service):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), servico.make_request_handler(service))
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def post(url, body):
+    data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+    request = Request(url, data=data, method='POST', headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(request) as response:
+            return response.status, json.load(response)
+    except HTTPError as e:
+        return e.code, json.load(e)
+
+
+LOCATION_QUERIES = [
+    {'id': 'q1', 'ordem': 'A1', 'linha': '100', 'datahora': HOUR_START_MS + 450_000},
+    {'id': 'q2', 'ordem': 'A1', 'linha': '100', 'datahora': HOUR_START_MS + 4_000_000},
+    {'id': 'q3', 'ordem': 'B7', 'linha': '864', 'datahora': HOUR_START_MS + 1_500_000},
+    {'id': 'q4', 'ordem': 'Z9', 'linha': '100', 'datahora': HOUR_START_MS + 450_000},
+]
+
+
+def test_location_answers_match_predict_locations_batch(base_url):
+    status, body = post(base_url + '/predict_location', {'queries': LOCATION_QUERIES})
+    assert status == 200
+
+    lats, lons = main.predict_locations_batch([(q['ordem'], q['linha']) for q in LOCATION_QUERIES],
+                                              [q['datahora'] for q in LOCATION_QUERIES], hours_before=5)
+    expected = [[q['id'], None if np.isnan(lat) else round(float(lat), 5), None if np.isnan(lon) else round(float(lon), 5)]
+                for q, lat, lon in zip(LOCATION_QUERIES, lats, lons)]
+    assert body['previsoes'] == expected
+    assert body['previsoes'][3] == ['q4', None, None]
+
+
+def test_arrival_answers_match_per_query_prediction(base_url):
+    target_lat, target_lon = latlon(650.0, 10.0)
+    queries = [{'id': i, 'ordem': ordem, 'linha': linha, 'latitude': f"{target_lat:.6f}".replace('.', ','),
+                'longitude': target_lon, 'datahora': HOUR_START_MS + seconds * 1000}
+               for i, (ordem, linha, seconds) in enumerate([('A1', '100', 3000), ('A1', '100', 3000), ('A1', '100', 5400),
+                                                            ('B7', '864', 3000), ('Z9', '100', 3000)])]
+    status, body = post(base_url + '/predict_arrival_time', {'queries': queries})
+    assert status == 200
+
+    expected = []
+    for query in queries:
+        reference_dt = datetime.fromtimestamp(query['datahora'] / 1000, tz=timezone.utc)
+        history = main.get_recent_historical_data_for_query_from_cache(query['ordem'], query['linha'], reference_dt, hours_before=5)
+        target = {'latitude': main._parse_coordinate(query['latitude']), 'longitude': float(query['longitude'])}
+        expected.append([query['id'], main.predict_arrival_time_with_route(history, target, query['linha']) if history else None])
+    assert body['previsoes'] == expected
+    assert body['previsoes'][0][1] is not None and body['previsoes'][4][1] is None
+
+
+@pytest.mark.parametrize('body', [
+    {'queries': [{'id': 1, 'ordem': 'A1', 'linha': '100', 'datahora': 10 ** 20}]},
+    {'queries': [{'id': 1, 'linha': '100', 'datahora': HOUR_START_MS}]},
+    {'queries': [{'id': 1, 'ordem': 'A1', 'linha': '100', 'datahora': 'ontem'}]},
+    b'{"queries": [',
+])
+def test_bad_location_input_returns_400(base_url, service, body):
+    status, payload = post(base_url + '/predict_location', body)
+    assert status == 400
+    assert payload['erro'].startswith('Requisição inválida')
+    assert service.error_counts['/predict_location'] == 1
+
+
+def test_bad_arrival_coordinate_returns_400(base_url):
+    query = {'id': 1, 'ordem': 'A1', 'linha': '100', 'latitude': 'norte', 'longitude': '-43,3', 'datahora': HOUR_START_MS}
+    status, payload = post(base_url + '/predict_arrival_time', {'queries': [query]})
+    assert status == 400
+    assert 'latitude' in payload['erro']
+
+
+def test_unexpected_failure_returns_500(base_url, service, monkeypatch):
+    def failing(*args, **kwargs):
+        raise RuntimeError('índice corrompido')
+
+    monkeypatch.setattr(main, 'predict_locations_batch', failing)
+    status, payload = post(base_url + '/predict_location', {'queries': LOCATION_QUERIES})
+    assert status == 500
+    assert 'índice corrompido' in payload['erro']
+    assert service.error_counts['/predict_location'] == 1
+    assert service.metrics()['endpoints']['/predict_location']['erros'] == 1
+
+
+def test_rewritten_hour_in_window_invalidates_the_window(base_url, historical_path):
+    query = {'id': 'q1', 'ordem': 'A1', 'linha': '100', 'datahora': HOUR_START_MS + 450_000}
+    _, before = post(base_url + '/predict_location', {'queries': [query]})
+    assert main.CURRENT_TEST_DAY_WINDOW is not None
+
+    # A hora das 10h é reescrita no lugar com o ônibus 2 km ao norte
+    path = write_hour(historical_path, 10, raw_records('A1', '100', [(100.0 * i, 2000.0, 300 * i) for i in range(12)]))
+    assert path in main.HOUR_DATA_LRU_CACHE
+    status, reload = post(base_url + '/reload', {})
+    assert (status, reload) == (200, {'arquivos_alterados': 1})
+    assert main.CURRENT_TEST_DAY_WINDOW is None
+    assert path not in main.HOUR_DATA_LRU_CACHE
+
+    _, after = post(base_url + '/predict_location', {'queries': [query]})
+    assert after['previsoes'][0][1] > before['previsoes'][0][1]
+    assert main.CURRENT_TEST_DAY_WINDOW is not None
+
+
+def test_evict_hour_file_outside_the_window_keeps_it(service, historical_path):
+    service.predict_locations([LOCATION_QUERIES[0]])
+    outside = os.path.join(historical_path, '2024-05-12', '2024-05-12_10.json')
+    assert not main.evict_hour_file(outside)
+    assert main.CURRENT_TEST_DAY_WINDOW is not None
+    inside = os.path.join(historical_path, '2024-05-13', '2024-05-13_11.json')
+    bytes_before = main.HOUR_CACHE_STATS['bytes']
+    assert main.evict_hour_file(inside)
+    assert main.CURRENT_TEST_DAY_WINDOW is None
+    assert main.HOUR_CACHE_STATS['bytes'] < bytes_before
+
+
+def test_serve_command_applies_the_shared_configuration(tmp_path, monkeypatch):
+    import cli
+    for name in CACHE_PATH_GLOBALS + ['BASE_DATA_PATH', 'QUERY_HOURS_BEFORE']:
+        monkeypatch.setattr(main, name, getattr(main, name))
+    started = []
+    monkeypatch.setattr(servico, 'serve', lambda *args: started.append((args, servico.PredictionService())))
+
+    cli.run_cli(['--data-path', str(tmp_path / 'dados'), '--hours-before', '3', 'serve', '--port', '9000'])
+    (host, port, _, _), service = started[0]
+    assert (host, port) == (servico.SERVICE_HOST, 9000)
+    assert service.hours_before == 3
+    assert service.base_historical_path == os.path.join(str(tmp_path / 'dados'), 'historical')
+    assert main.PREPROCESSED_CACHE_PATH == os.path.join(str(tmp_path / 'dados'), 'cache', 'horas/')